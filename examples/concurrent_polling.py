@@ -0,0 +1,88 @@
+"""
+Concurrency benchmark: poll the detector from several threads while an
+acquisition is streaming frames.
+
+Start a simulator first (see README) and run:
+
+$ python concurrent_polling.py --nb-threads=4 localhost
+"""
+
+import time
+import argparse
+import threading
+
+from sls.client import Detector
+
+
+def poll(detector, stop_event, stats, index):
+    nb_calls, errors = 0, 0
+    while not stop_event.is_set():
+        try:
+            detector.run_status
+            detector.exposure_time_left
+            detector.nb_frames_left
+            nb_calls += 3
+        except Exception:
+            errors += 1
+    stats[index] = nb_calls, errors
+
+
+def acquire(detector, exposure_time, nb_frames, result):
+    start = time.time()
+    nb_received = 0
+    for frame in detector.acquire():
+        nb_received += 1
+    result['nb_frames'] = nb_received
+    result['duration'] = time.time() - start
+
+
+def run(options):
+    detector = Detector(options.host, ctrl_port=options.ctrl_port,
+                        stop_port=options.stop_port,
+                        pool_size=options.pool_size)
+    detector.exposure_time = options.exposure_time
+    detector.nb_frames = options.nb_frames
+    detector.nb_cycles = 1
+
+    stop_event = threading.Event()
+    stats = options.nb_threads * [None]
+    acq_result = {}
+    pollers = [threading.Thread(target=poll,
+                                args=(detector, stop_event, stats, i))
+               for i in range(options.nb_threads)]
+    acq_thread = threading.Thread(
+        target=acquire, args=(detector, options.exposure_time,
+                              options.nb_frames, acq_result))
+    start = time.time()
+    acq_thread.start()
+    for poller in pollers:
+        poller.start()
+    acq_thread.join()
+    stop_event.set()
+    for poller in pollers:
+        poller.join()
+    elapsed = time.time() - start
+
+    nb_calls = sum(s[0] for s in stats)
+    nb_errors = sum(s[1] for s in stats)
+    print('acquired {}/{} frames in {:.3f}s'.format(
+        acq_result['nb_frames'], options.nb_frames, acq_result['duration']))
+    print('{} threads: {} polling calls ({:.1f} calls/s), {} errors'.format(
+        options.nb_threads, nb_calls, nb_calls / elapsed, nb_errors))
+
+
+def main(args=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('--nb-frames', default=50, type=int)
+    p.add_argument('--exposure-time', default=0.05, type=float)
+    p.add_argument('--nb-threads', default=4, type=int)
+    p.add_argument('--pool-size', default=8, type=int)
+    p.add_argument('--ctrl-port', default=1952, type=int)
+    p.add_argument('--stop-port', default=1953, type=int)
+    p.add_argument('host')
+    opts = p.parse_args(args)
+    run(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Frame decoding throughput for each dynamic range.
+
+Decodes random frames (native dtype and widened into a preallocated
+'<i4' buffer) and, with --loopback, acquires frames from an in-process
+simulated detector at each dynamic range.
+
+$ python decode_benchmark.py --nb-frames 10000 --loopback
+"""
+
+import time
+import argparse
+
+import numpy
+
+from sls.protocol import decode_data
+
+DYNAMIC_RANGES = 4, 8, 16, 24
+NB_CHANNELS = 6 * 10 * 128
+
+
+def frame_bytes(dynamic_range, nb_channels=NB_CHANNELS):
+    bits = 32 if dynamic_range == 24 else dynamic_range
+    nb_bytes = nb_channels * bits // 8
+    return numpy.random.randint(0, 256, nb_bytes, dtype='<u1').tobytes()
+
+
+def bench_decode(dynamic_range, nb_frames, dtype=None, out=None):
+    data = frame_bytes(dynamic_range)
+    start = time.perf_counter()
+    for i in range(nb_frames):
+        decode_data(data, dynamic_range, dtype=dtype, out=out)
+    return len(data), time.perf_counter() - start
+
+
+def bench_loopback(dynamic_range, nb_frames):
+    from sls.simulator import detectors
+    from sls.loopback import Loopback
+    with Loopback(detectors({'mythen': {}})) as loopback:
+        detector = loopback.client()
+        with detector.acquisition(dynamic_range=dynamic_range,
+                                  exposure_time=0, nb_frames=nb_frames,
+                                  nb_cycles=1, progress_interval=None) as acq:
+            start = time.perf_counter()
+            for event in acq:
+                pass
+            return time.perf_counter() - start
+
+
+def report(name, nb_frames, duration, nb_bytes=None):
+    msg = '{:>24}: {:>10.1f} frames/s'.format(name, nb_frames / duration)
+    if nb_bytes is not None:
+        msg += ' {:>8.1f} MB/s'.format(nb_frames * nb_bytes / duration / 1E6)
+    print(msg)
+
+
+def run(options):
+    widened = numpy.empty(NB_CHANNELS, dtype='<i4')
+    for dynamic_range in DYNAMIC_RANGES:
+        print('dynamic range {} bits'.format(dynamic_range))
+        nb_bytes, duration = bench_decode(dynamic_range, options.nb_frames)
+        report('decode (native)', options.nb_frames, duration, nb_bytes)
+        nb_bytes, duration = bench_decode(dynamic_range, options.nb_frames,
+                                          dtype='<i4', out=widened)
+        report('decode (into <i4 buffer)', options.nb_frames, duration,
+               nb_bytes)
+        if options.loopback:
+            duration = bench_loopback(dynamic_range, options.nb_acq_frames)
+            report('loopback acquisition', options.nb_acq_frames, duration)
+
+
+def main(args=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('--nb-frames', default=10000, type=int,
+                   help='frames to decode per dynamic range')
+    p.add_argument('--loopback', action='store_true',
+                   help='also acquire from an in-process simulator')
+    p.add_argument('--nb-acq-frames', default=500, type=int,
+                   help='frames to acquire per dynamic range (loopback)')
+    opts = p.parse_args(args)
+    run(opts)
+
+
+if __name__ == '__main__':
+    main()
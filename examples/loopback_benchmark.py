@@ -0,0 +1,51 @@
+"""
+Protocol stack micro-benchmark: run the client against an in-process
+simulated detector (no network, no simulator process).
+
+$ python loopback_benchmark.py --nb-calls 1000 --nb-frames 1000
+"""
+
+import time
+import argparse
+
+from sls.simulator import detectors
+from sls.loopback import Loopback
+
+
+def bench_calls(detector, nb_calls):
+    start = time.perf_counter()
+    for i in range(nb_calls):
+        detector.energy_threshold
+    return time.perf_counter() - start
+
+
+def bench_acquisition(detector, nb_frames):
+    start = time.perf_counter()
+    with detector.acquisition(exposure_time=0, nb_frames=nb_frames,
+                              nb_cycles=1, progress_interval=None) as acq:
+        for event_type, event in acq:
+            pass
+    return time.perf_counter() - start
+
+
+def run(options):
+    with Loopback(detectors({'mythen': {}})) as loopback:
+        detector = loopback.client()
+        duration = bench_calls(detector, options.nb_calls)
+        print('{} calls in {:.3f}s ({:.1f} calls/s)'.format(
+            options.nb_calls, duration, options.nb_calls / duration))
+        duration = bench_acquisition(detector, options.nb_frames)
+        print('{} frames in {:.3f}s ({:.1f} frames/s)'.format(
+            options.nb_frames, duration, options.nb_frames / duration))
+
+
+def main(args=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('--nb-calls', default=1000, type=int)
+    p.add_argument('--nb-frames', default=1000, type=int)
+    opts = p.parse_args(args)
+    run(opts)
+
+
+if __name__ == '__main__':
+    main()
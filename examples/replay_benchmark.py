@@ -0,0 +1,69 @@
+"""
+Record an acquisition and replay it offline to benchmark the client side
+(protocol decoding and acquisition loop) without a detector.
+
+Record (needs a detector or a simulator):
+
+$ python replay_benchmark.py --record session.slsrec --nb-frames 1000 localhost
+
+Replay at full speed:
+
+$ python replay_benchmark.py --nb-frames 1000 session.slsrec
+
+The acquisition options must match the ones used for the recording.
+"""
+
+import time
+import argparse
+
+from sls.client import Detector
+from sls.record import Recorder, Replayer
+
+
+def acquire(detector, options):
+    start = time.perf_counter()
+    nb_frames = 0
+    with detector.acquisition(exposure_time=options.exposure_time,
+                              nb_frames=options.nb_frames, nb_cycles=1,
+                              progress_interval=None) as acq:
+        for event_type, event in acq:
+            nb_frames += 1
+    return nb_frames, time.perf_counter() - start
+
+
+def record(options):
+    with Recorder(options.record) as recorder:
+        detector = Detector(options.target,
+                            connection_factory=recorder.connection)
+        nb_frames, duration = acquire(detector, options)
+    print('recorded {} frames in {:.3f}s'.format(nb_frames, duration))
+
+
+def replay(options):
+    for i in range(options.repeat):
+        replayer = Replayer(options.target, realtime=options.realtime)
+        detector = Detector('127.0.0.1', connection_factory=replayer.connection)
+        nb_frames, duration = acquire(detector, options)
+        print('replayed {} frames in {:.3f}s ({:.1f} frames/s)'
+              .format(nb_frames, duration, nb_frames / duration))
+
+
+def main(args=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('--record', default=None,
+                   help='record session into the given file')
+    p.add_argument('--realtime', action='store_true',
+                   help='replay at the original timing')
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--nb-frames', default=100, type=int)
+    p.add_argument('--exposure-time', default=0.01, type=float)
+    p.add_argument('target', help='detector host (record) or session file')
+    opts = p.parse_args(args)
+    if opts.record:
+        record(opts)
+    else:
+        replay(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,7 @@ setup(
         "console_scripts": [
             "sls-gui=sls.gui:main [gui]",
             "sls-simulator=sls.simulator:main [simulator]",
+            "sls-perf=sls.perf:main",
             "sls-lima=sls.lima.camera:main [lima]",
             "sls-lima-tango-server=sls.lima.tango:main [lima]"
         ],
@@ -1,8 +1,12 @@
+import time
 import queue
 import threading
 
+from . import trace
 
-from .protocol import fetch_frames, start_acquisition, stop_acquisition, SLSError
+from .protocol import (fetch_frame, start_acquisition, stop_acquisition,
+                       ResultType, SLSError)
+from .client import apply_options, get_frame_timeout
 
 
 class StopAcquisition(Exception):
@@ -15,6 +19,9 @@ class BaseAcquisition:
         self.nb_frames = opts.setdefault('nb_frames', 1)
         self.nb_cycles = opts.setdefault('nb_cycles', 1)
         self.exposure_time = opts.setdefault('exposure_time', 1)
+        # time budget (s) for each frame: 'auto' (derived from acquisition
+        # parameters) or None (wait forever)
+        self.frame_timeout = opts.pop('frame_timeout', 'auto')
         self.detector = detector
         self.opts = opts
         self.nb_acquired_frames = 0
@@ -23,11 +30,11 @@ class BaseAcquisition:
         return self.nb_frames * self.nb_cycles
 
     def prepare(self):
-        for key, value in self.opts.items():
-            setattr(self.detector, key, value)
-        self.info = self.detector.update_client()
+        self.info = apply_options(self.detector, self.opts)
         assert self.nb_frames == self.info['nb_frames']
         assert self.nb_cycles == self.info['nb_cycles']
+        if self.frame_timeout == 'auto':
+            self.frame_timeout = get_frame_timeout(self.detector, self.info)
 
     def start(self):
         raise NotImplementedError
@@ -65,15 +72,32 @@ class AcquisitionIter(BaseAcquisition):
         detector, info = self.detector, self.info
         frame_size = info['data_bytes']
         dynamic_range = info['dynamic_range']
-        conn = detector.conn_ctrl
-        with conn:
-            start_acquisition(conn)
+        tracer = trace.tracer
+        with detector.ctrl_pool.acquire() as conn:
+            if tracer is None:
+                start_acquisition(conn)
+            else:
+                with tracer.span('start'):
+                    start_acquisition(conn)
             try:
                 # yield after start to give change for other channels to
                 # start as concurrently as possible
                 yield None
-                for frame in fetch_frames(conn, frame_size, dynamic_range):
-                    yield frame
+                frame_nb = 0
+                while True:
+                    with conn.budget(self.frame_timeout):
+                        result, frame = fetch_frame(conn, frame_size,
+                                                    dynamic_range)
+                    if result != ResultType.OK:
+                        break
+                    if tracer is None:
+                        yield frame
+                    else:
+                        yield_start = time.perf_counter()
+                        yield frame
+                        tracer.add('consumer', yield_start,
+                                   time.perf_counter(), frame_nb)
+                    frame_nb += 1
             except StopAcquisition:
                 detector.stop_acquisition()
                 return
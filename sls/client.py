@@ -14,38 +14,100 @@
 import time
 import select
 import socket
+import types
 import inspect
 import logging
 import functools
+import threading
 import contextlib
+import collections
+import collections.abc
 import numpy
 
-from . import protocol
+from . import metrics, protocol, trace
+from .demux import Accumulator, Demux
+from .event import CheckpointEvent, FrameEvent, ProgressEvent
 from .protocol import (DEFAULT_CTRL_PORT, DEFAULT_STOP_PORT, SLSError,
-                       IdParam, Dimension, TimerType, SpeedType, ResultType,
-                       RunStatus)
+                       SLSTimeoutError, IdParam, Dimension, TimerType,
+                       SpeedType, ResultType, RunStatus, ReadoutFlag,
+                       ExternalCommunicationMode)
 
 
-TEMPLATE = "SLS Detector at tcp://{o.host}:{o.conn_ctrl.port}/{o.conn_stop.port}\n"
+TEMPLATE = "SLS Detector at tcp://{o.host}:{o.ctrl_pool.port}/{o.stop_pool.port}\n"
+
+DEFAULT_POOL_SIZE = 8
+
+# time budget (s) of a control/stop command (connect, request and reply)
+DEFAULT_TIMEOUT = 10
+
+# extra time (s) given to each frame on top of its exposure/period
+FRAME_TIMEOUT_MARGIN = 2
+
+log = logging.getLogger('SLSClient')
 
 
 class Connection:
 
-    def __init__(self, addr):
+    def __init__(self, addr, timeout=None):
         # since every command reconnects the detector, we try to be nice to the DNS
         # by making sure we use IP instead of hostname. This avoids unnecessary
         # requests to the DNS
         self.host, self.port = addr
         self.addr = socket.gethostbyname(self.host), self.port
         self.sock = None
+        # time budget (s) for a whole session (connect to close). None means
+        # wait forever
+        self.timeout = timeout
+        # absolute deadline (time.monotonic()) for the current I/O
+        self.deadline = None
+        self._sock_timeout = None
         self.log = logging.getLogger('Connection({0[0]}:{0[1]})'.format(addr))
 
-    def connect(self):
+    def open_transport(self, timeout):
+        """
+        Transport hook. Returns a socket connected to the detector with the
+        given timeout (None means blocking).
+
+        Subclasses may override it to provide a different transport. The
+        returned object must support: settimeout, sendall, recv, makefile,
+        fileno and close.
+        """
         sock = socket.socket()
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        sock.connect(self.addr)
-        self.reader = sock.makefile('rb')
-        self.sock = sock
+        try:
+            sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(timeout)
+            sock.connect(self.addr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self):
+        if self.timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + self.timeout
+        self.sock = None
+        timeout = self.time_left()
+        if timeout is not None and timeout <= 0:
+            self._on_timeout('connect')
+        tracer = trace.tracer
+        measure = metrics.enabled or tracer is not None
+        if measure:
+            start = time.perf_counter()
+        try:
+            self.sock = self.open_transport(timeout)
+        except socket.timeout:
+            self._on_timeout('connect')
+        if measure:
+            end = time.perf_counter()
+            if tracer is not None:
+                tracer.add('connect', start, end, self.port)
+            if metrics.enabled:
+                metrics.histogram('connect_seconds', 'connection time') \
+                    .record(end - start)
+        self._sock_timeout = timeout
+        self.reader = self.sock.makefile('rb')
 
     def close(self):
         if self.sock:
@@ -62,12 +124,56 @@ class Connection:
     def __exit__(self, etype, evalue, etb):
         self.close()
 
+    def time_left(self):
+        """time (s) left until the deadline or None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    @contextlib.contextmanager
+    def budget(self, timeout):
+        """
+        Context manager. I/O within the context must finish in timeout
+        seconds (None means no limit)
+        """
+        previous = self.deadline
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            yield self
+        finally:
+            self.deadline = previous
+
+    def _update_timeout(self):
+        timeout = self.time_left()
+        if timeout is not None and timeout <= 0:
+            self._on_timeout('deadline')
+        # avoid the system call when nothing changes
+        if timeout is not None or self._sock_timeout is not None:
+            self.sock.settimeout(timeout)
+            self._sock_timeout = timeout
+
+    def _on_timeout(self, operation):
+        # after a timeout the reader buffer is in an inconsistent state
+        # and the detector reply may still arrive: the only safe state is
+        # to have the connection closed
+        self.close()
+        raise SLSTimeoutError('{} timeout on {!r}'.format(operation, self))
+
     def write(self, buff):
         self.log.debug('send: %r', buff)
-        self.sock.sendall(buff)
+        self._update_timeout()
+        try:
+            self.sock.sendall(buff)
+        except socket.timeout:
+            self._on_timeout('write')
 
     def recv(self, size):
-        data = self.sock.recv(size)
+        self._update_timeout()
+        try:
+            # go through the reader: it may already hold buffered data
+            data = self.reader.read1(size)
+        except socket.timeout:
+            self._on_timeout('recv')
         if not data:
             self.close()
             raise ConnectionError('connection closed')
@@ -77,7 +183,11 @@ class Connection:
     def read(self, size):
         data = b''
         while len(data) < size:
-            buff = self.reader.read(size)
+            self._update_timeout()
+            try:
+                buff = self.reader.read(size)
+            except socket.timeout:
+                self._on_timeout('read')
             if not buff:
                 self.close()
                 raise ConnectionError('connection closed')
@@ -85,23 +195,163 @@ class Connection:
             data += buff
         return data
 
+    def readinto(self, buff):
+        """Read exactly len(buff) bytes into the given writable buffer"""
+        view = memoryview(buff).cast('B')
+        size, nb_read = len(view), 0
+        while nb_read < size:
+            self._update_timeout()
+            try:
+                n = self.reader.readinto(view[nb_read:])
+            except socket.timeout:
+                self._on_timeout('read')
+            if not n:
+                self.close()
+                raise ConnectionError('connection closed')
+            nb_read += n
+        self.log.debug('readinto: %d bytes', size)
+        return size
+
+    def wait_readable(self, timeout=None):
+        """
+        Wait for data to be available for at most timeout seconds (None
+        means until the deadline). Returns True if data is available
+        """
+        time_left = self.time_left()
+        if time_left is not None:
+            if time_left <= 0:
+                self._on_timeout('select')
+            timeout = time_left if timeout is None else min(timeout, time_left)
+        rfds, _, _ = select.select((self,), (), (), timeout)
+        return bool(rfds)
+
     def fileno(self):
         if self.sock is None:
             return -1
         return self.sock.fileno()
 
 
+class ConnectionPool:
+    """
+    Pool of connections to one detector port.
+
+    The detector server closes the socket after each command so sockets
+    cannot be kept open between commands. What the pool shares between calls
+    are the Connection objects (with the host name already resolved) and it
+    guarantees that a Connection is never used by two threads at the same
+    time.
+
+    * `connection()` checks out a Connection for one command and makes it
+      the current connection of the calling thread
+    * `acquire()` checks out a Connection without making it current (ex: to
+      hold it during a whole acquisition)
+    * `current` is the connection made current by the innermost
+      `connection()` of the calling thread
+
+    At most `max_size` connections are checked out at the same time. Extra
+    requests wait for a connection to be returned to the pool.
+
+    `timeout` is the time budget of each checked out connection session.
+    """
+
+    def __init__(self, addr, max_size=DEFAULT_POOL_SIZE, factory=Connection,
+                 timeout=None):
+        self.host, self.port = addr
+        # resolve host only once for all connections in the pool
+        self.addr = socket.gethostbyname(self.host), self.port
+        self.max_size = max_size
+        self.factory = factory
+        self.timeout = timeout
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '{0}({1[0]}:{1[1]}, size={2}/{3})'.format(
+            type(self).__name__, self.addr, self._size, self.max_size)
+
+    def _new_connection(self):
+        return self.factory(self.addr, timeout=self.timeout)
+
+    def _checkout(self, blocking=True):
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                if not blocking:
+                    return None
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+        try:
+            return self._new_connection()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, conn):
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _stack(self):
+        local = self._local
+        try:
+            return local.stack
+        except AttributeError:
+            local.stack = stack = []
+            return stack
+
+    @property
+    def current(self):
+        stack = self._stack()
+        if not stack:
+            raise RuntimeError('no connection to {0[0]}:{0[1]} checked out by '
+                               'this thread (see connection())'
+                               .format(self.addr))
+        return stack[-1]
+
+    @contextlib.contextmanager
+    def acquire(self, blocking=True):
+        """
+        Check out a connection (connected within the context).
+        If not blocking and all connections are in use, yields None
+        """
+        conn = self._checkout(blocking)
+        if conn is None:
+            yield None
+            return
+        conn.timeout = self.timeout
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._checkin(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.acquire() as conn:
+            stack = self._stack()
+            stack.append(conn)
+            try:
+                yield conn
+            finally:
+                stack.pop()
+
+
 def auto_ctrl_connect(f):
     name = f.__name__
     is_update = name == 'update_client'
     @functools.wraps(f)
     def wrapper(self, *args, **kwargs):
-        with self.conn_ctrl:
+        with self.ctrl_pool.connection():
             result, reply = f(self, *args, **kwargs)
-            if not is_update:
-                if result == ResultType.FORCE_UPDATE or self._info is None:
-                    self.update_client()
-            return reply
+        if not is_update:
+            if result == ResultType.FORCE_UPDATE or self._info is None:
+                self.update_client()
+        return reply
     wrapper.wrapped = True
     return wrapper
 
@@ -109,7 +359,7 @@ def auto_ctrl_connect(f):
 def auto_stop_connect(f):
     @functools.wraps(f)
     def wrapper(self, *args, **kwargs):
-        with self.conn_stop:
+        with self.stop_pool.connection():
             result, reply = f(self, *args, **kwargs)
             return reply
     return wrapper
@@ -143,11 +393,40 @@ class Detector:
 
     def __init__(self, host,
                  ctrl_port=DEFAULT_CTRL_PORT,
-                 stop_port=DEFAULT_STOP_PORT):
+                 stop_port=DEFAULT_STOP_PORT,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT,
+                 connection_factory=Connection):
         self._info = None
+        # acquisition parameters as last applied by an AcquisitionPlan
+        self._acq_state = None
         self.host = host
-        self.conn_ctrl = Connection((host, ctrl_port))
-        self.conn_stop = Connection((host, stop_port))
+        self.ctrl_pool = ConnectionPool((host, ctrl_port), max_size=pool_size,
+                                        factory=connection_factory,
+                                        timeout=timeout)
+        self.stop_pool = ConnectionPool((host, stop_port), max_size=pool_size,
+                                        factory=connection_factory,
+                                        timeout=timeout)
+
+    @property
+    def timeout(self):
+        """time budget (s) for each control and stop command"""
+        return self.ctrl_pool.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ctrl_pool.timeout = timeout
+        self.stop_pool.timeout = timeout
+
+    @property
+    def conn_ctrl(self):
+        """control connection checked out by the calling thread"""
+        return self.ctrl_pool.current
+
+    @property
+    def conn_stop(self):
+        """stop connection checked out by the calling thread"""
+        return self.stop_pool.current
 
     @auto_ctrl_connect
     def update_client(self):
@@ -167,6 +446,12 @@ class Detector:
     def get_id(self, mode, mod_nb=None):
         return protocol.get_id(self.conn_ctrl, mode, mod_nb=mod_nb)
 
+    @auto_ctrl_connect
+    def digital_test(self, mode, mod_nb=None):
+        """run a detector self test. Returns its result (for
+        DigitalTestMode.CHIP_TEST, the number of bit errors)"""
+        return protocol.digital_test(self.conn_ctrl, mode, mod_nb=mod_nb)
+
     def get_module_serial_number(self, mod_nb):
         return self.get_id(IdParam.MODULE_SERIAL_NUMBER, mod_nb)
 
@@ -232,10 +517,22 @@ class Detector:
 
     @timing_mode.setter
     def timing_mode(self, value):
+        self._acq_state = None
         return protocol.set_external_communication_mode(self.conn_ctrl, value)
 
     external_communication_mode = timing_mode
 
+    @ctrl_property
+    def rois(self):
+        return protocol.get_rois(self.conn_ctrl)
+
+    @rois.setter
+    def rois(self, rois):
+        # the number of bytes per frame changes with the ROIs
+        result = protocol.set_rois(self.conn_ctrl, rois)
+        self._info = None
+        return result
+
     @ctrl_property
     def detector_type(self):
         return protocol.get_detector_type(self.conn_ctrl)
@@ -278,6 +575,7 @@ class Detector:
 
     @auto_ctrl_connect
     def set_timer(self, timer, value):
+        self._acq_state = None
         return protocol.set_timer(self.conn_ctrl, timer, value)
 
     @auto_ctrl_connect
@@ -316,6 +614,14 @@ class Detector:
     def nb_gates(self, nb_gates):
         self.set_timer(TimerType.NB_GATES, nb_gates)
 
+    @property
+    def nb_probes(self):
+        return self.get_timer(TimerType.NB_PROBES)
+
+    @nb_probes.setter
+    def nb_probes(self, nb_probes):
+        self.set_timer(TimerType.NB_PROBES, nb_probes)
+
     @property
     def delay_after_trigger(self):
         return self.get_timer(TimerType.DELAY_AFTER_TRIGGER)
@@ -355,6 +661,7 @@ class Detector:
         # 24 to the user
         if dynamic_range == 24:
             dynamic_range = 32
+        self._acq_state = None
         return protocol.set_dynamic_range(self.conn_ctrl, dynamic_range)
 
     @auto_ctrl_connect
@@ -396,13 +703,23 @@ class Detector:
         return Acquisition(self, **opts)
 
     def fetch_frame(self, frame_size, dynamic_range):
+        """
+        Read the next frame from the control connection the acquisition was
+        started on. It must be the current one of the calling thread:
+
+            with mythen.ctrl_pool.connection() as conn:
+                protocol.start_acquisition(conn)
+                result, frame = mythen.fetch_frame(frame_size, dynamic_range)
+        """
         return protocol.fetch_frame(self.conn_ctrl, frame_size, dynamic_range)
 
-    @auto_ctrl_connect
+    def burst_acquisition(self, **opts):
+        return BurstAcquisition(self, **opts)
+
     def read_all(self, frame_size, dynamic_range):
-        for event in protocol.read_all(self.conn_ctrl, frame_size,
-                                       dynamic_range):
-            yield event
+        # the connection must stay open while frames are consumed
+        with self.ctrl_pool.acquire() as conn:
+            yield from protocol.read_all(conn, frame_size, dynamic_range)
 
     @auto_ctrl_connect
     def read_frame(self, frame_size, dynamic_range):
@@ -414,6 +731,7 @@ class Detector:
 
     @readout.setter
     def readout(self, value):
+        self._acq_state = None
         return protocol.set_readout(self.conn_ctrl, value)
 
     @auto_ctrl_connect
@@ -468,25 +786,34 @@ class Detector:
     def last_client_ip(self):
         return protocol.get_last_client_ip(self.conn_ctrl)
 
+    def snapshot(self, names=None):
+        """
+        Detector state (all readable properties or only the given names)
+        fetched in one pipelined exchange. Returns an immutable Snapshot
+        """
+        return snapshot(self, names)
+
     def dump(self):
+        s = self.snapshot(DUMP_NAMES)
         return {
-            "Detector type": self.detector_type.name,
-            "Serial number": self.serial_number,
-            "Software version": self.software_version,
-            "Status": self.run_status.name,
-            "Dynamic range": self.dynamic_range,
-            "Energy threshold": self.energy_threshold,
-            "Exposure time": self.exposure_time,
-            "Number of frames": self.nb_frames,
-            "Number of cycles": self.nb_cycles,
-            "Number of gates": self.nb_gates,
-            "Master": self.master_mode.name,
-            "Synchronization": self.synchronization_mode.name,
-            "Timing": self.timing_mode.name,
-            "Delay after triger": self.delay_after_trigger,
-            "Readout": self.readout.name,
-            "Settings": self.settings.name,
-            "External signals": [self.get_external_signal(i).name for i in range(4)]
+            "Detector type": s.detector_type.name,
+            "Serial number": s.serial_number,
+            "Software version": s.software_version,
+            "Status": s.run_status.name,
+            "Dynamic range": s.dynamic_range,
+            "Energy threshold": s.energy_threshold,
+            "Exposure time": s.exposure_time,
+            "Number of frames": s.nb_frames,
+            "Number of cycles": s.nb_cycles,
+            "Number of gates": s.nb_gates,
+            "Master": s.master_mode.name,
+            "Synchronization": s.synchronization_mode.name,
+            "Timing": s.timing_mode.name,
+            "Delay after triger": s.delay_after_trigger,
+            "Readout": s.readout.name,
+            "Settings": s.settings.name,
+            "External signals": [s['external_signal_{}'.format(i)].name
+                                 for i in range(4)]
         }
 
     def __repr__(self):
@@ -498,15 +825,373 @@ class Detector:
         return header + '\n'.join(lines)
 
 
+class _ReplyPending(Exception):
+    pass
+
+
+class _RequestPass:
+    """first pipeline pass: send the request, stop at the first read"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, buff):
+        self.conn.write(buff)
+
+    def read(self, size):
+        raise _ReplyPending
+
+    recv = read
+
+
+class _ReplyPass:
+    """second pipeline pass: request was already sent, read the reply"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, buff):
+        pass
+
+    def read(self, size):
+        return self.conn.read(size)
+
+    def recv(self, size):
+        return self.conn.recv(size)
+
+
+class Pipeline:
+    """
+    Sends several commands in one exchange.
+
+    The detector closes the connection after each command so commands
+    cannot be queued on a single socket. Instead each command gets its own
+    connection and all requests are sent before any reply is read: the
+    detector works on a command while the next ones are being sent. N
+    commands cost N connects plus about one round trip instead of N
+    round trips.
+
+    Connections are checked out of the detector pools: at most the pool
+    size of commands are in flight at once. Commands beyond what the pools
+    have available are sent in further rounds.
+
+    Commands are protocol functions (connection as first argument) which
+    send the whole request before reading the reply. They are run twice:
+    once to send the request and once to read the reply. Commands are
+    sent in the order they were added.
+
+        pipe = Pipeline(mythen)
+        pipe.ctrl(protocol.set_timer, TimerType.NB_FRAMES, 10)
+        pipe.ctrl(protocol.update_client)
+        pipe.stop(protocol.get_run_status)
+        (_, nb_frames), (_, info), (_, status) = pipe.execute()
+    """
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def ctrl(self, func, *args):
+        """Add a control command. Returns its index in the results"""
+        self.commands.append((self.detector.ctrl_pool, func, args))
+        return len(self.commands) - 1
+
+    def stop(self, func, *args):
+        """Add a stop command. Returns its index in the results"""
+        self.commands.append((self.detector.stop_pool, func, args))
+        return len(self.commands) - 1
+
+    def execute(self):
+        """
+        Run all commands. Returns the list of (result, reply) in the order
+        the commands were added. The first command error is raised after
+        all replies have been read.
+        """
+        commands, self.commands = self.commands, []
+        detector = self.detector
+        results, error = [], None
+        while len(results) < len(commands):
+            with contextlib.ExitStack() as stack:
+                conns = []
+                for pool, func, args in commands[len(results):]:
+                    # only wait for the first connection of a round: this
+                    # thread may hold connections of the pool (ex: a
+                    # running acquisition) which it would wait for forever
+                    conn = stack.enter_context(pool.acquire(not conns))
+                    if conn is None:
+                        break
+                    conns.append(conn)
+                    try:
+                        func(_RequestPass(conn), *args)
+                    except _ReplyPending:
+                        pass
+                batch = commands[len(results):len(results) + len(conns)]
+                for conn, (pool, func, args) in zip(conns, batch):
+                    try:
+                        results.append(func(_ReplyPass(conn), *args))
+                    except SLSTimeoutError:
+                        raise
+                    except SLSError as err:
+                        results.append((ResultType.FAIL, None))
+                        error = err if error is None else error
+        if error is not None:
+            raise error
+        # same rules as auto_ctrl_connect: refresh client info if needed
+        force_update, updated = detector._info is None, False
+        for (pool, func, args), (result, reply) in zip(commands, results):
+            if pool is not detector.ctrl_pool:
+                continue
+            if func is protocol.update_client:
+                detector._info, updated = reply, True
+            elif result == ResultType.FORCE_UPDATE:
+                force_update = True
+        if force_update and not updated:
+            detector.update_client()
+        return results
+
+
+def _time_to_raw(value):
+    # same conversion as the detector protocol timers (ns)
+    return int(value * 1E+9)
+
+
+def _dynamic_range_to_raw(value):
+    # detector stores 24bits dynamic range as 32
+    return 32 if value == 24 else int(value)
+
+
+def _field(setter, to_raw):
+    # setter receives the value in detector units
+    return (lambda conn, value: setter(conn, to_raw(value))), to_raw
+
+
+def _timer_field(timer, to_raw=int):
+    # timer setter receives the value in user units (it does the conversion)
+    return (lambda conn, value: protocol.set_timer(conn, timer, value)), to_raw
+
+
+# AcquisitionPlan fields: name: (setter(conn, value), to detector units)
+# in the order they are applied: dynamic range and readout first since
+# they may change what the timers mean
+PLAN_FIELDS = collections.OrderedDict((
+    ('dynamic_range', _field(protocol.set_dynamic_range,
+                             _dynamic_range_to_raw)),
+    ('readout', _field(protocol.set_readout, ReadoutFlag)),
+    ('timing_mode', _field(protocol.set_external_communication_mode,
+                           ExternalCommunicationMode)),
+    ('exposure_time', _timer_field(TimerType.ACQUISITION_TIME, _time_to_raw)),
+    ('frame_period', _timer_field(TimerType.FRAME_PERIOD, _time_to_raw)),
+    ('delay_after_trigger', _timer_field(TimerType.DELAY_AFTER_TRIGGER,
+                                         _time_to_raw)),
+    ('nb_frames', _timer_field(TimerType.NB_FRAMES)),
+    ('nb_cycles', _timer_field(TimerType.NB_CYCLES)),
+    ('nb_gates', _timer_field(TimerType.NB_GATES)),
+    ('nb_probes', _timer_field(TimerType.NB_PROBES)),
+))
+
+# update_client info key for the plan fields it reports
+PLAN_INFO_KEYS = dict(dynamic_range='dynamic_range', exposure_time='acq_time',
+                      frame_period='frame_period',
+                      delay_after_trigger='delay_after_trigger',
+                      nb_frames='nb_frames', nb_cycles='nb_cycles',
+                      nb_gates='nb_gates', nb_probes='nb_probes')
+
+
+class AcquisitionPlan:
+    """
+    Declarative description of the acquisition parameters (same names and
+    units as the Detector properties). Fields left as None are not
+    touched.
+
+    apply() sends only the fields which differ from the detector state
+    cached by the previous apply() together with update_client (and the
+    readout and timing mode reads) in a single pipelined exchange. Back to
+    back scan points sharing most parameters are therefore re-armed in
+    one exchange.
+
+    The cached state may be stale (another client or process, direct
+    sls.protocol calls) so the fields which were not sent are checked
+    against what the same exchange read back. If any of them is off, the
+    cached state is dropped and all fields are sent again.
+
+    Without a cached state (first apply or after a parameter was changed
+    through the Detector properties) all fields are sent: a separate read
+    would cost one more exchange than just writing them.
+    """
+
+    fields = tuple(PLAN_FIELDS)
+
+    def __init__(self, **kwargs):
+        for name in self.fields:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('unknown acquisition parameter(s): {}'
+                            .format(', '.join(kwargs)))
+
+    def __repr__(self):
+        items = ('{}={!r}'.format(name, value)
+                 for name, value in self.items())
+        return '{}({})'.format(type(self).__name__, ', '.join(items))
+
+    def items(self):
+        """(name, value) of the fields which are set"""
+        for name in self.fields:
+            value = getattr(self, name)
+            if value is not None:
+                yield name, value
+
+    def raw(self):
+        """fields which are set in detector units"""
+        return {name: PLAN_FIELDS[name][1](value)
+                for name, value in self.items()}
+
+    def diff(self, state):
+        """fields (in detector units) which differ from the given state"""
+        if state is None:
+            return self.raw()
+        return {name: value for name, value in self.raw().items()
+                if state.get(name) != value}
+
+    def apply(self, detector, refresh=False):
+        """
+        Bring the detector to the plan. Returns the update_client info.
+        refresh: ignore the cached detector state (send all fields)
+        """
+        cached = None if refresh else detector._acq_state
+        changes = self.diff(cached)
+        pipe = Pipeline(detector)
+        indexes = {}
+        for name in changes:
+            setter = PLAN_FIELDS[name][0]
+            indexes[name] = pipe.ctrl(setter, getattr(self, name))
+        # read back what update_client doesn't report
+        for name, getter in (('timing_mode',
+                              protocol.get_external_communication_mode),
+                             ('readout', protocol.get_readout)):
+            if name not in indexes:
+                indexes[name] = pipe.ctrl(getter)
+        info_index = pipe.ctrl(protocol.update_client)
+        results = pipe.execute()
+        info = results[info_index][1]
+        state = dict(cached or {})
+        for name, index in indexes.items():
+            state[name] = PLAN_FIELDS[name][1](results[index][1])
+        for name, key in PLAN_INFO_KEYS.items():
+            state[name] = info[key]
+        if cached is not None:
+            stale = [name for name, value in self.raw().items()
+                     if name not in changes and state[name] != value]
+            if stale:
+                # the detector was changed behind the cached state: the
+                # fields skipped because of it must be sent after all
+                log.info('acquisition state changed behind our back (%s): '
+                         'applying all fields', ', '.join(stale))
+                detector._acq_state = None
+                return self.apply(detector, refresh=True)
+        detector._acq_state = state
+        return info
+
+
+def apply_options(detector, opts):
+    """
+    Apply acquisition options: the AcquisitionPlan fields in one pipelined
+    exchange and any other option as a Detector attribute.
+    Returns the update_client info
+    """
+    plan = {name: value for name, value in opts.items()
+            if name in PLAN_FIELDS}
+    for key, value in opts.items():
+        if key not in PLAN_FIELDS:
+            setattr(detector, key, value)
+    return AcquisitionPlan(**plan).apply(detector)
+
+
+def _readout_option(detector, opts):
+    """readout flags of the acquisition options (current ones if not given)"""
+    readout = opts.get('readout')
+    if readout is None:
+        state = detector._acq_state
+        if state is not None and 'readout' in state:
+            readout = state['readout']
+        else:
+            readout = detector.readout
+    return ReadoutFlag(readout)
+
+
+def _restore_readout(detector, readout):
+    """bring back the readout flags an acquisition changed"""
+    if readout is not None:
+        AcquisitionPlan(readout=readout).apply(detector)
+
+
 class Acquisition:
+    """
+    Iterable over the acquisition events (see sls.event).
+
+    progress_interval: time (s) between progress events (None: no progress)
+    frame_timeout: time budget (s) for each frame: 'auto' (derived from
+                   the acquisition parameters) or None (wait forever)
+    continuous: if True, the detector reads out continuously
+                (CONTINOUS_RO readout flag) and frames are streamed until
+                stop() is called. If False, the flag is cleared. The
+                other readout flags (readout option or the current
+                detector ones) are kept. If None (default), follow the
+                detector readout flags. Readout flags changed by the
+                acquisition (continuous or readout option) are restored
+                when it ends
+    nb_buffers: if given, frames are read into a ring of nb_buffers
+                preallocated buffers instead of a new buffer per frame.
+                The frame data of an event is then only valid until
+                nb_buffers more frames are received. With a sparse
+                readout (READ_HITS, ZERO_COMPRESSION) frames are
+                sparse.SparseFrame unless nb_buffers is given: then they
+                are densified into the buffers
+    checkpoint_interval: time (s) between checkpoint events (None: no
+                         checkpoints)
+    dtype: frame dtype. Defaults to the narrowest holding the counts of
+           the dynamic range (see protocol.decode_data)
+    demux: 'probes' (pump-probe, needs the PUMP_PROBE_MODE readout flag):
+           frame data is a (nb_probes, nb_channels) array of per probe
+           views (see sls.demux). None (default): flat frames
+    accumulate: with demux, sum the frames of each probe in accumulator
+                (a demux.Accumulator)
+    clock: a clock.ClockCorrelator: frame events are stamped with their
+           estimated exposure start and end in host time (internal timing
+           only). The frame step is re-measured on detector progress
+           samples taken every clock.interval. See also exposure_times()
+    opts: acquisition options (see apply_options)
+    """
 
-    def __init__(self, detector, progress_interval=0.25, **opts):
-        opts['progress_interval'] = progress_interval
+    def __init__(self, detector, progress_interval=0.25, frame_timeout='auto',
+                 continuous=None, nb_buffers=None, checkpoint_interval=None,
+                 dtype=None, demux=None, accumulate=False, clock=None,
+                 **opts):
+        if accumulate and demux is None:
+            raise ValueError('accumulate needs a demux mode')
+        if continuous:
+            opts.setdefault('nb_frames', 0)
+        self._continuous = continuous
+        self._progress_interval = progress_interval
+        self._checkpoint_interval = checkpoint_interval
+        self._nb_buffers = nb_buffers
+        self._dtype = dtype
+        self._demux_mode = demux
+        self._accumulate = accumulate
+        self._clock = clock
+        self._clock_start = None
         self._detector = detector
         self._opts = opts
+        self._frame_timeout = frame_timeout
         self._info = None
+        # readout flags to restore at the end (None: not changed)
+        self._previous_readout = None
         self._gen = None
         self._stopped = False
+        self.continuous = None
+        self.accumulator = None
         self.nb_frames = 0
 
     def __iter__(self):
@@ -519,6 +1204,8 @@ class Acquisition:
 
     def __len__(self):
         info = self._prepare()
+        if self.continuous:
+            raise TypeError('continuous acquisition has no length')
         nb_frames = info['nb_frames'] or 1
         nb_cycles = info['nb_cycles'] or 1
         return nb_frames * nb_cycles
@@ -532,39 +1219,257 @@ class Acquisition:
                 self.stop()
         if self._gen is not None:
             self._gen.close()
+        # prepared but never run
+        self._restore_readout()
 
     def _prepare(self):
         if self._info is None:
-            for key, value in self._opts.items():
-                setattr(self._detector, key, value)
-            self._info = self._detector.update_client()
+            opts = self._opts
+            readout = opts.get('readout')
+            if readout is not None or self._continuous is not None:
+                previous = _readout_option(self._detector, {})
+                readout = previous if readout is None else ReadoutFlag(readout)
+                if self._continuous is not None:
+                    flag = ReadoutFlag.CONTINOUS_RO
+                    readout = readout | flag if self._continuous \
+                        else readout & ~flag
+                opts = dict(opts, readout=readout)
+                if readout != previous:
+                    self._previous_readout = previous
+            info = apply_options(self._detector, opts)
+            # shared (not copied) by all events of the acquisition
+            self._info = types.MappingProxyType(dict(info))
+            state = self._detector._acq_state or {}
+            readout = state.get('readout', ReadoutFlag.NORMAL_READOUT)
+            self.continuous = bool(readout & ReadoutFlag.CONTINOUS_RO)
+            if self._frame_timeout == 'auto':
+                self._frame_timeout = get_frame_timeout(self._detector,
+                                                        self._info)
         return self._info
 
     def _run_gen(self):
         self._prepare()
-        progress_interval = self._opts['progress_interval']
+        try:
+            self._prepare_events()
+        except BaseException:
+            self._restore_readout()
+            raise
+        progress_interval = self._progress_interval
         if progress_interval is None:
-            return self._raw_run_gen()
+            gen = self._raw_run_gen()
+        else:
+            gen = self._progress_run_gen(progress_interval)
+        if self._previous_readout is None:
+            return gen
+        return self._restoring_gen(gen)
+
+    def _restoring_gen(self, gen):
+        try:
+            yield from gen
+        finally:
+            self._restore_readout()
+
+    def _restore_readout(self):
+        previous, self._previous_readout = self._previous_readout, None
+        _restore_readout(self._detector, previous)
+
+    def _frame_event(self, frame):
+        index = self.nb_frames
+        self.nb_frames += 1
+        if self.continuous:
+            frame_nb, cycle_nb = index, 0
+        else:
+            frame_nb, cycle_nb = divmod(index, self._frames_per_cycle)[::-1]
+        if self._frame_time is None:
+            detector_time = None
+        else:
+            if self._clock_start is not None:
+                self._sample_progress()
+            detector_time = self._first_frame_end + index * self._frame_time
+        if self._clock_start is None:
+            exposure_start = exposure_end = None
+        else:
+            model = self._clock.model
+            exposure_end = float(model.to_host(self._clock_start +
+                                               detector_time))
+            exposure_start = exposure_end - self._exposure * model.rate
+        if self._demux is not None:
+            frame = self._demux.split(frame)
+            if self.accumulator is not None:
+                self.accumulator.add(frame)
+        return FrameEvent(index, frame_nb, cycle_nb, time.time(),
+                          detector_time, frame, exposure_start, exposure_end)
+
+    def _start_clock(self):
+        """anchor the frame times on the detector clock (just started)"""
+        if self._clock is None or self._frame_time is None:
+            return
+        self._clock_start = self._clock.acquisition_start()
+        self._exposure = self._info['acq_time'] * 1E-9
+        self._progress = []
+        self._next_progress = time.monotonic() + self._clock.interval
+
+    def _sample_progress(self):
+        """
+        every clock interval, measure the frame step on the detector
+        progress: the nominal one drifts by any unaccounted dead time
+        """
+        from .clock import fit_frame_step
+        now = time.monotonic()
+        if self.continuous or now < self._next_progress:
+            return
+        self._next_progress = now + self._clock.interval
+        actual_time, frames_left, cycles_left = \
+            self._clock.acquisition_progress()
+        total = len(self)
+        done = total - frames_left - (cycles_left - 1) * self._frames_per_cycle
+        if 0 < done < total:
+            self._progress.append((actual_time - self._clock_start, done))
+            frame_time = fit_frame_step(self._progress)
+            if frame_time is not None and frame_time > 0:
+                self._frame_time = frame_time
+
+    def exposure_times(self, indexes=None):
+        """
+        Estimated exposure (start, end) host times (arrays) of the frames
+        (default: all frames received so far) with the current clock model.
+        Called after the acquisition it re-stamps all frames with the model
+        fitted on the samples taken along the acquisition
+        """
+        if self._clock_start is None:
+            raise ValueError('acquisition has no clock or is not '
+                             'internally timed')
+        if indexes is None:
+            indexes = numpy.arange(self.nb_frames)
+        return self._clock.exposure_times(self._clock_start, self._info,
+                                          indexes, self._frame_time)
+
+    def _prepare_events(self):
+        info = self._info
+        self._frames_per_cycle = info['nb_frames'] or 1
+        state = self._detector._acq_state or {}
+        # sparse readout flags change the frame encoding
+        self._readout = state.get('readout', ReadoutFlag.NORMAL_READOUT)
+        if state.get('timing_mode') != ExternalCommunicationMode.AUTO_TIMING:
+            # external timing: nominal frame times are meaningless
+            self._frame_time = None
+        else:
+            # exposure plus the readout dead time at the applied dynamic
+            # range and nominal speeds (no detector request). With a
+            # clock, the frame step is then measured
+            from . import perf
+            from .clock import frame_step
+            model = perf.PerfModel() if self._clock is None \
+                else self._clock.perf_model
+            readout_time = model.readout_time(
+                dict(perf.DEFAULT_STATE, dynamic_range=info['dynamic_range']))
+            self._frame_time = frame_step(info, readout_time)
+            self._first_frame_end = (info['delay_after_trigger'] +
+                                     info['acq_time']) * 1E-9
+        if self._demux_mode is None:
+            self._demux = None
+        else:
+            self._demux = Demux.from_info(self._demux_mode, info,
+                                          self._readout)
+            shape, _ = protocol._to_numpy_meta(info['data_bytes'],
+                                               info['dynamic_range'])
+            # frames must hold whole sub-frames
+            nb_channels = self._demux.nb_channels(shape[0])
+            if self._accumulate:
+                self.accumulator = Accumulator(self._demux.nb_slots,
+                                               nb_channels)
+        if self._nb_buffers:
+            # rolling frame buffers: constant memory whatever the length
+            # of the acquisition
+            shape, dtype = protocol._to_numpy_meta(info['data_bytes'],
+                                                   info['dynamic_range'])
+            dtype = dtype if self._dtype is None else self._dtype
+            self._buffers = [numpy.empty(shape, dtype=dtype)
+                             for _ in range(self._nb_buffers)]
         else:
-            return self._progress_run_gen(progress_interval)
+            self._buffers = None
+        self._checkpoint_count = 0
+        self._checkpoint_frames = 0
+        self._start_time = self._checkpoint_time = time.monotonic()
+
+    def _next_buffer(self):
+        buffers = self._buffers
+        if buffers is None:
+            return None
+        return buffers[self.nb_frames % len(buffers)]
+
+    def _checkpoint(self):
+        """Returns a CheckpointEvent if one is due or None"""
+        interval = self._checkpoint_interval
+        if interval is None:
+            return None
+        now = time.monotonic()
+        if now - self._checkpoint_time < interval:
+            return None
+        nb_frames = self.nb_frames - self._checkpoint_frames
+        event = CheckpointEvent(self._checkpoint_count, time.time(),
+                                now - self._start_time, self.nb_frames,
+                                nb_frames,
+                                nb_frames / (now - self._checkpoint_time))
+        self._checkpoint_count += 1
+        self._checkpoint_frames = self.nb_frames
+        self._checkpoint_time = now
+        if metrics.enabled:
+            metrics.gauge('acquisition_frame_rate',
+                          'frames/s of the last acquisition') \
+                .set(event.frame_rate)
+        log.info('acquisition checkpoint #%d: %d frames in %.1fs '
+                 '(%.1f frames/s)', event.index, event.nb_frames,
+                 event.elapsed, event.frame_rate)
+        return event
 
     def _raw_run_gen(self):
         detector, info = self._detector, self._info
-        conn = detector.conn_ctrl
         frame_size = info['data_bytes']
         dynamic_range = info['dynamic_range']
-        with conn:
+        frame_timeout = self._frame_timeout
+        with detector.ctrl_pool.acquire() as conn:
             try:
+                tracer = trace.tracer
+                acq_start = time.perf_counter()
                 protocol.start_acquisition(conn)
-                for event in protocol.fetch_frames(conn,
-                                                   frame_size,
-                                                   dynamic_range):
-                    self.nb_frames += 1
-                    yield 'frame', event
+                if tracer is not None:
+                    tracer.add('start', acq_start, time.perf_counter())
+                self._start_clock()
+                while True:
+                    with conn.budget(frame_timeout):
+                        result, frame = protocol.fetch_frame(
+                            conn, frame_size, dynamic_range,
+                            out=self._next_buffer(), readout=self._readout,
+                            dtype=self._dtype)
+                    if result != ResultType.OK:
+                        break
+                    event = self._frame_event(frame)
+                    if tracer is None:
+                        yield event
+                    else:
+                        yield_start = time.perf_counter()
+                        yield event
+                        tracer.add('consumer', yield_start,
+                                   time.perf_counter(), event.index)
+                    checkpoint = self._checkpoint()
+                    if checkpoint is not None:
+                        yield checkpoint
+                if metrics.enabled:
+                    self._record_metrics(acq_start)
+            except SLSTimeoutError:
+                self.stop()
+                raise
             except SLSError:
                 if self._stopped:
                     return
                 raise
+            except ConnectionError:
+                # the detector may close the connection when stopped
+                if self._stopped:
+                    return
+                self.stop()
+                raise
             except BaseException as err:
                 # make sure acq is stopped before closing the control socket
                 # otherwise detector hangs
@@ -573,40 +1478,77 @@ class Acquisition:
 
     def _progress_run_gen(self, progress_interval):
         detector, info = self._detector, self._info
-        conn = detector.conn_ctrl
         frame_size = info['data_bytes']
         dynamic_range = info['dynamic_range']
-        with conn:
+        frame_timeout = self._frame_timeout
+        with detector.ctrl_pool.acquire() as conn:
             try:
+                tracer = trace.tracer
+                acq_start = time.perf_counter()
                 protocol.start_acquisition(conn)
-                fds = conn,
+                if tracer is not None:
+                    tracer.add('start', acq_start, time.perf_counter())
+                self._start_clock()
                 start = time.time()
                 progress_count = 0
                 while True:
-                    next_progress = start + (progress_count+1)*progress_interval
-                    nap = max(next_progress - time.time(), 0)
-                    rfds, _, _ = select.select(fds, (), (), nap)
-                    if rfds:
-                        result, frame = detector.fetch_frame(frame_size,
-                                                             dynamic_range)
-                        if result != ResultType.OK:
-                            break
-                        self.nb_frames += 1
-                        yield 'frame', frame
+                    with conn.budget(frame_timeout):
+                        while True:
+                            next_progress = start + (progress_count+1)*progress_interval
+                            nap = max(next_progress - time.time(), 0)
+                            if conn.wait_readable(nap):
+                                break
+                            yield progress_report(detector, info)
+                            progress_count += 1
+                        result, frame = protocol.fetch_frame(
+                            conn, frame_size, dynamic_range,
+                            out=self._next_buffer(), readout=self._readout,
+                            dtype=self._dtype)
+                    if result != ResultType.OK:
+                        break
+                    event = self._frame_event(frame)
+                    if tracer is None:
+                        yield event
                     else:
-                        yield 'progress', progress_report(detector, info)
-                        progress_count += 1
-                yield 'progress', progress_report(detector, info)
+                        yield_start = time.perf_counter()
+                        yield event
+                        tracer.add('consumer', yield_start,
+                                   time.perf_counter(), event.index)
+                    checkpoint = self._checkpoint()
+                    if checkpoint is not None:
+                        yield checkpoint
+                if metrics.enabled:
+                    self._record_metrics(acq_start)
+                yield progress_report(detector, info)
+            except SLSTimeoutError:
+                self.stop()
+                raise
             except SLSError:
                 if self._stopped:
                     return
                 raise
+            except ConnectionError:
+                # the detector may close the connection when stopped
+                if self._stopped:
+                    return
+                self.stop()
+                raise
             except BaseException as err:
                 # make sure acq is stopped before closing the control socket
                 # otherwise detector hangs
                 self.stop()
                 raise
 
+    def _record_metrics(self, start):
+        duration = time.perf_counter() - start
+        metrics.counter('acquisitions', 'acquisitions finished').inc()
+        metrics.histogram('acquisition_seconds', 'acquisition duration',
+                          resolution=1e-3).record(duration)
+        if duration > 0:
+            metrics.gauge('acquisition_frame_rate',
+                          'frames/s of the last acquisition') \
+                .set(self.nb_frames / duration)
+
     def stop(self):
         self._stopped = True
         self._detector.stop_acquisition()
@@ -615,25 +1557,304 @@ class Acquisition:
         return list(self)
 
 
+class BurstAcquisition:
+    """
+    Acquisition stored in the detector RAM (STORE_IN_RAM readout flag) and
+    read out in bulk after it finished.
+
+    Frames are not streamed while acquiring so the frame rate is not
+    limited by the network. The acquisition is started without holding a
+    data connection, its end is detected by polling the run status on the
+    stop port and then all frames are drained in one READ_ALL exchange
+    into a single preallocated array.
+
+        with mythen.burst_acquisition(exposure_time=1e-4, nb_frames=1000) as acq:
+            frames = acq.run()   # (nb_frames * nb_cycles, nb_channels) array
+
+    poll_interval: time (s) between run status polls
+    timeout: time budget (s) for the acquisition to finish: 'auto'
+             (performance model estimate, see sls.perf) or None (wait
+             forever, ex: external trigger). Past it, the wait goes on
+             as long as the detector keeps making frames
+    dtype: frame array dtype. Defaults to the narrowest holding the counts
+           of the dynamic range (see protocol.decode_data)
+    opts: acquisition options (see apply_options). The STORE_IN_RAM flag
+          is added to the readout flags (readout option or the current
+          detector ones). The previous readout flags are restored once the
+          frames are read (or on error)
+    """
+
+    def __init__(self, detector, poll_interval=0.01, timeout='auto',
+                 dtype=None, **opts):
+        self._dtype = dtype
+        self._detector = detector
+        self._opts = opts
+        self._poll_interval = poll_interval
+        self._timeout = timeout
+        self._stopped = False
+        self._readout = None
+        self._previous_readout = None
+        self.info = None
+        self.data = None
+        self.nb_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.info is not None:
+            self.stop()
+        self._restore_readout()
+
+    def __len__(self):
+        info = self.prepare()
+        return (info['nb_frames'] or 1) * (info['nb_cycles'] or 1)
+
+    def prepare(self):
+        """Apply the acquisition options and allocate the frame array"""
+        if self.info is None:
+            detector, opts = self._detector, self._opts
+            previous = _readout_option(detector, {})
+            readout = _readout_option(detector, opts) | ReadoutFlag.STORE_IN_RAM
+            info = apply_options(detector, dict(opts, readout=readout))
+            # kept here: the detector cached state may be reset by then
+            self._readout = detector._acq_state['readout']
+            if readout != previous:
+                self._previous_readout = previous
+            self.info = types.MappingProxyType(dict(info))
+            shape, dtype = protocol._to_numpy_meta(info['data_bytes'],
+                                                   info['dynamic_range'])
+            dtype = dtype if self._dtype is None else self._dtype
+            self.data = numpy.empty((len(self),) + shape, dtype=dtype)
+            if self._timeout == 'auto':
+                self._timeout = self._expected_duration()
+        return self.info
+
+    def _expected_duration(self):
+        # performance model estimate (exposure and readout dead time) minus
+        # the bulk transfer, which comes after the wait
+        from . import perf
+        state = perf.plan_state(self._detector)
+        estimate = perf.PerfModel.load(self._detector.host).estimate(state)
+        if estimate.duration is None:
+            return None
+        duration = estimate.duration - estimate.nb_frames * estimate.transfer_time
+        return duration + FRAME_TIMEOUT_MARGIN
+
+    def start(self):
+        """Start the acquisition. Returns as soon as the detector started"""
+        self.prepare()
+        self._stopped = False
+        self.nb_frames = 0
+        tracer = trace.tracer
+        start = time.perf_counter()
+        self._detector.start_acquisition()
+        if tracer is not None:
+            tracer.add('start', start, time.perf_counter())
+
+    def wait(self):
+        """
+        Wait for the acquisition to finish (run status polling).
+        Returns the final run status
+        """
+        detector = self._detector
+        begin = time.monotonic()
+        deadline = None if self._timeout is None else begin + self._timeout
+        frames_left = None
+        tracer = trace.tracer
+        start = time.perf_counter()
+        while True:
+            status = detector.run_status
+            if status == RunStatus.ERROR:
+                raise SLSError('detector error while acquiring in RAM')
+            if status not in (RunStatus.RUNNING, RunStatus.WAITING,
+                              RunStatus.TRANSMITTING):
+                break
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                # slower than expected: only give up once it stalls
+                left = detector.nb_cycles_left, detector.nb_frames_left
+                if left == frames_left:
+                    self.stop()
+                    raise SLSTimeoutError(
+                        'acquisition did not finish in {:.3f}s (stalled at '
+                        '{} cycles, {} frames left)'
+                        .format(now - begin, *left))
+                frames_left = left
+                deadline = now + FRAME_TIMEOUT_MARGIN
+            time.sleep(self._poll_interval)
+        if tracer is not None:
+            tracer.add('burst_wait', start, time.perf_counter())
+        return status
+
+    def read(self):
+        """
+        Drain all frames stored in the detector RAM into the frame array.
+        Returns the frames read (view on the array)
+        """
+        info, data = self.info, self.data
+        frame_size = info['data_bytes']
+        dynamic_range = info['dynamic_range']
+        tracer = trace.tracer
+        start = time.perf_counter()
+        try:
+            with self._detector.ctrl_pool.acquire() as conn:
+                frames = protocol.read_all(conn, frame_size, dynamic_range,
+                                           out=data, readout=self._readout,
+                                           dtype=data.dtype)
+                while True:
+                    # the drain lasts as long as the data volume: the
+                    # command time budget applies to each frame
+                    with conn.budget(conn.timeout):
+                        frame = next(frames, None)
+                    if frame is None:
+                        break
+                    if self.nb_frames == len(data):
+                        raise SLSError('detector sent more than the {} '
+                                       'expected frames'.format(len(data)))
+                    self.nb_frames += 1
+        finally:
+            self._restore_readout()
+        end = time.perf_counter()
+        if tracer is not None:
+            tracer.add('burst_read', start, end)
+        if metrics.enabled:
+            metrics.histogram('burst_read_seconds',
+                              'time draining frames stored in RAM',
+                              resolution=1e-3).record(end - start)
+        if self.nb_frames < len(data) and not self._stopped:
+            log.warning('burst acquisition: got %d frames out of %d',
+                        self.nb_frames, len(data))
+        return data[:self.nb_frames]
+
+    def run(self):
+        """Start, wait for the end and read. Returns the frames"""
+        self.start()
+        try:
+            self.wait()
+        except BaseException:
+            self.stop()
+            self._restore_readout()
+            raise
+        return self.read()
+
+    def stop(self):
+        """
+        Stop the acquisition. Frames acquired until then can still be
+        read()
+        """
+        self._stopped = True
+        self._detector.stop_acquisition()
+
+    def _restore_readout(self):
+        previous, self._previous_readout = self._previous_readout, None
+        _restore_readout(self._detector, previous)
+
+
 @contextlib.contextmanager
 def ensure_state(detector, state=None):
     """
     Context manager. Ensures detector is brought to the initial state after
-    context is finished
+    context is finished.
+
+    Only the properties which changed are restored (see restore_state).
+    Yields a dict which, after the context, holds what was restored
+    ({name: (value found, value restored)})
     """
     if state is None:
-        state = dump_state(detector, 'rw')
+        state = snapshot(detector, state_names(type(detector), 'rw'))
+    changes = {}
     try:
-        yield
+        yield changes
     finally:
-        for key, value in state.items():
-            setattr(detector, key, value)
-
-
-def dump_state(detector, filters='r'):
-    klass = type(detector)
+        changes.update(restore_state(detector, state))
+
+
+def _speed_setter(speed):
+    return lambda conn, value: protocol.set_speed(conn, speed, value)
+
+
+# writable state in restore (dependency) order: what changes the meaning
+# of other parameters (dynamic range, readout, modes) first and the server
+# lock last. name: setter(conn, value) with value in user units
+RESTORE_COMMANDS = collections.OrderedDict((
+    ('dynamic_range', PLAN_FIELDS['dynamic_range'][0]),
+    ('readout', PLAN_FIELDS['readout'][0]),
+    ('rois', protocol.set_rois),
+    ('synchronization_mode', protocol.set_synchronization_mode),
+    ('master_mode', protocol.set_master_mode),
+    ('timing_mode', PLAN_FIELDS['timing_mode'][0]),
+    ('external_communication_mode', PLAN_FIELDS['timing_mode'][0]),
+    ('clock_divider', _speed_setter(SpeedType.CLOCK_DIVIDER)),
+    ('wait_states', _speed_setter(SpeedType.WAIT_STATES)),
+    ('tot_clock_divider', _speed_setter(SpeedType.TOT_CLOCK_DIVIDER)),
+    ('tot_duty_cycle', _speed_setter(SpeedType.TOT_DUTY_CYCLE)),
+    ('signal_length', _speed_setter(SpeedType.SIGNAL_LENGTH)),
+    ('energy_threshold',
+     lambda conn, value: protocol.set_energy_threshold(conn, -1, value)),
+    ('exposure_time', PLAN_FIELDS['exposure_time'][0]),
+    ('frame_period', PLAN_FIELDS['frame_period'][0]),
+    ('delay_after_trigger', PLAN_FIELDS['delay_after_trigger'][0]),
+    ('nb_frames', PLAN_FIELDS['nb_frames'][0]),
+    ('nb_cycles', PLAN_FIELDS['nb_cycles'][0]),
+    ('nb_gates', PLAN_FIELDS['nb_gates'][0]),
+    ('nb_probes', PLAN_FIELDS['nb_probes'][0]),
+    ('lock', lambda conn, value: protocol.set_lock(conn, 1 if value else 0)),
+    ('lock_server', protocol.set_lock_server),
+))
+
+# same detector parameter under two names
+_ALIASES = dict(external_communication_mode='timing_mode')
+
+
+def restore_state(detector, state):
+    """
+    Bring the detector back to the given state (a Snapshot or a dict as
+    returned by dump_state). The current state is read and only the
+    properties which differ are written, in dependency order, in one
+    pipelined exchange. Properties without a protocol command (ex:
+    timeout) are restored with setattr.
+    Returns {name: (value found, value restored)} of what was restored
+    """
+    current = snapshot(detector, tuple(state))
+    changes = collections.OrderedDict()
+    for name in RESTORE_COMMANDS:
+        if name not in state or _ALIASES.get(name) in changes:
+            continue
+        if current[name] != state[name]:
+            changes[name] = current[name], state[name]
+    others = [name for name in state
+              if name not in RESTORE_COMMANDS and current[name] != state[name]]
+    if changes:
+        pipe = Pipeline(detector)
+        for name in changes:
+            pipe.ctrl(RESTORE_COMMANDS[name], state[name])
+        # data size may have changed: refresh client info in the same go
+        pipe.ctrl(protocol.update_client)
+        detector._acq_state = None
+        pipe.execute()
+    for name in others:
+        changes[name] = current[name], state[name]
+        setattr(detector, name, state[name])
+    if changes:
+        log.info('restored %s', ', '.join(
+            '{}: {!r} -> {!r}'.format(name, *change)
+            for name, change in changes.items()))
+    return changes
+
+
+# public properties which are not detector state
+NON_STATE_NAMES = frozenset(('conn_ctrl', 'conn_stop'))
+
+
+@functools.lru_cache(maxsize=None)
+def state_names(klass, filters='r'):
+    """
+    Names of the public properties of the detector class (readable if
+    'r' in filters, writable if 'w' in filters). Computed once per class
+    """
     members = ((name, getattr(klass, name)) for name in dir(klass)
-               if not name.startswith('_'))
+               if not name.startswith('_') and name not in NON_STATE_NAMES)
     descriptors = ((name, member) for name, member in members
                    if inspect.isdatadescriptor(member))
     def filt(m):
@@ -642,27 +1863,198 @@ def dump_state(detector, filters='r'):
         if 'w' in filters and not m[1].fset:
             return False
         return True
-    descriptors = filter(filt, descriptors)
-    return {name:getattr(detector, name) for name,_ in descriptors}
+    return tuple(name for name, _ in filter(filt, descriptors))
+
+
+def dump_state(detector, filters='r'):
+    names = state_names(type(detector), filters)
+    return dict(snapshot(detector, names))
+
+
+def _ctrl_get(func, *args, convert=None):
+    return False, func, args, convert
+
+
+def _stop_get(func, *args, convert=None):
+    return True, func, args, convert
+
+
+def _user_dynamic_range(value):
+    # detector stores 24bits dynamic range as 32. We always present
+    # 24 to the user
+    return 24 if value == 32 else value
+
+
+# state which can be read in a pipeline:
+# name: (stop port?, protocol function, extra args, reply conversion)
+SNAPSHOT_COMMANDS = {
+    'firmware_version': _ctrl_get(protocol.get_id,
+                                  IdParam.DETECTOR_FIRMWARE_VERSION),
+    'serial_number': _ctrl_get(protocol.get_id,
+                               IdParam.DETECTOR_SERIAL_NUMBER),
+    'software_version': _ctrl_get(protocol.get_id,
+                                  IdParam.DETECTOR_SOFTWARE_VERSION),
+    'module_firmware_version': _ctrl_get(protocol.get_id,
+                                         IdParam.MODULE_FIRMWARE_VERSION),
+    'energy_threshold': _ctrl_get(protocol.get_energy_threshold, -1),
+    'lock': _ctrl_get(protocol.get_lock),
+    'synchronization_mode': _ctrl_get(protocol.get_synchronization_mode),
+    'timing_mode': _ctrl_get(protocol.get_external_communication_mode),
+    'external_communication_mode':
+        _ctrl_get(protocol.get_external_communication_mode),
+    'rois': _ctrl_get(protocol.get_rois),
+    'detector_type': _ctrl_get(protocol.get_detector_type),
+    'exposure_time': _ctrl_get(protocol.get_timer,
+                               TimerType.ACQUISITION_TIME),
+    'nb_frames': _ctrl_get(protocol.get_timer, TimerType.NB_FRAMES),
+    'nb_cycles': _ctrl_get(protocol.get_timer, TimerType.NB_CYCLES),
+    'nb_gates': _ctrl_get(protocol.get_timer, TimerType.NB_GATES),
+    'nb_probes': _ctrl_get(protocol.get_timer, TimerType.NB_PROBES),
+    'delay_after_trigger': _ctrl_get(protocol.get_timer,
+                                     TimerType.DELAY_AFTER_TRIGGER),
+    'frame_period': _ctrl_get(protocol.get_timer, TimerType.FRAME_PERIOD),
+    'master_mode': _ctrl_get(protocol.get_master_mode),
+    'dynamic_range': _ctrl_get(protocol.get_dynamic_range,
+                               convert=_user_dynamic_range),
+    'lock_server': _ctrl_get(protocol.get_lock_server),
+    'settings': _ctrl_get(protocol.get_settings),
+    'readout': _ctrl_get(protocol.get_readout),
+    'clock_divider': _ctrl_get(protocol.get_speed, SpeedType.CLOCK_DIVIDER),
+    'wait_states': _ctrl_get(protocol.get_speed, SpeedType.WAIT_STATES),
+    'tot_clock_divider': _ctrl_get(protocol.get_speed,
+                                   SpeedType.TOT_CLOCK_DIVIDER),
+    'tot_duty_cycle': _ctrl_get(protocol.get_speed,
+                                SpeedType.TOT_DUTY_CYCLE),
+    'signal_length': _ctrl_get(protocol.get_speed, SpeedType.SIGNAL_LENGTH),
+    'last_client_ip': _ctrl_get(protocol.get_last_client_ip),
+    'run_status': _stop_get(protocol.get_run_status),
+    'exposure_time_left': _stop_get(protocol.get_time_left,
+                                    TimerType.ACQUISITION_TIME),
+    'nb_cycles_left': _stop_get(protocol.get_time_left, TimerType.NB_CYCLES),
+    'nb_frames_left': _stop_get(protocol.get_time_left, TimerType.NB_FRAMES),
+    'progress': _stop_get(protocol.get_time_left, TimerType.PROGRESS),
+    'measurement_time': _stop_get(protocol.get_time_left,
+                                  TimerType.MEASUREMENT_TIME),
+    'detector_actual_time': _stop_get(protocol.get_time_left,
+                                      TimerType.ACTUAL_TIME),
+}
+for _index in range(4):
+    SNAPSHOT_COMMANDS['external_signal_{}'.format(_index)] = \
+        _ctrl_get(protocol.get_external_signal, _index)
+
+DUMP_NAMES = (
+    'detector_type', 'serial_number', 'software_version', 'run_status',
+    'dynamic_range', 'energy_threshold', 'exposure_time', 'nb_frames',
+    'nb_cycles', 'nb_gates', 'nb_probes', 'master_mode', 'synchronization_mode',
+    'timing_mode', 'delay_after_trigger', 'readout', 'settings',
+    'external_signal_0', 'external_signal_1', 'external_signal_2',
+    'external_signal_3')
+
+
+class Snapshot(collections.abc.Mapping):
+    """
+    Immutable detector state: a mapping of property name to value which
+    also gives attribute access (snap.exposure_time)
+    """
+
+    __slots__ = '_state', 'timestamp'
+
+    def __init__(self, state, timestamp=None):
+        object.__setattr__(self, '_state', dict(state))
+        object.__setattr__(self, 'timestamp',
+                           time.time() if timestamp is None else timestamp)
+
+    def __getitem__(self, name):
+        return self._state[name]
+
+    def __iter__(self):
+        return iter(self._state)
+
+    def __len__(self):
+        return len(self._state)
+
+    def __getattr__(self, name):
+        try:
+            return self._state[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Snapshot is read-only')
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._state)
+
+
+def snapshot(detector, names=None):
+    """
+    Read the detector state in one pipelined exchange. names defaults to
+    all readable properties. Properties which don't map to a single
+    protocol command are read with getattr.
+    Returns a Snapshot
+    """
+    if names is None:
+        names = state_names(type(detector), 'r')
+    pipe = Pipeline(detector)
+    indexes, state = {}, {}
+    for name in names:
+        command = SNAPSHOT_COMMANDS.get(name)
+        if command is None:
+            continue
+        is_stop, func, args, _ = command
+        add = pipe.stop if is_stop else pipe.ctrl
+        indexes[name] = add(func, *args)
+    results = pipe.execute() if pipe else []
+    for name in names:
+        if name in indexes:
+            value = results[indexes[name]][1]
+            convert = SNAPSHOT_COMMANDS[name][3]
+            state[name] = value if convert is None else convert(value)
+        else:
+            state[name] = getattr(detector, name)
+    return Snapshot(state)
+
+
+def get_frame_timeout(detector, info, margin=FRAME_TIMEOUT_MARGIN):
+    """
+    Time budget (s) to wait for each frame derived from the acquisition
+    parameters in info (as returned by update_client).
+    None (wait forever) if the detector is waiting for external signals
+    """
+    state = detector._acq_state
+    if state is not None and 'timing_mode' in state:
+        timing_mode = state['timing_mode']
+    else:
+        timing_mode = detector.timing_mode
+    if timing_mode != ExternalCommunicationMode.AUTO_TIMING:
+        return None
+    frame_time = max(info['acq_time'], info['frame_period'])
+    return (info['delay_after_trigger'] + frame_time) * 1E-9 + margin
 
 
 def progress_report(detector, info):
-    nb_frames = info['nb_frames'] or 1
-    nb_cycles = info['nb_cycles'] or 1
-    nb_cycles_left = detector.nb_cycles_left + 2
-    nb_frames_left  = detector.nb_frames_left + 2
-    exposure_time_left = detector.exposure_time_left
-    nb_cycles_finished = nb_cycles - nb_cycles_left
-    nb_frames_finished = nb_frames - nb_frames_left
-    return dict(
-        info,
-        timestamp=time.time(),
-        nb_cycles_left=nb_cycles_left,
-        nb_frames_left=nb_frames_left,
-        exposure_time_left=exposure_time_left,
-        nb_cycles_finished=nb_cycles_finished,
-        nb_frames_finished=nb_frames_finished,
-        current_cycle=nb_cycles_finished + 1,
-        current_frame=nb_frames_finished + 1,
-        total_frames_finished=nb_cycles_finished * nb_frames + nb_frames_finished,
-        exposure_time=info['acq_time'] * 1e-9 - exposure_time_left)
+    tracer = trace.tracer
+    measure = metrics.enabled or tracer is not None
+    if measure:
+        start = time.perf_counter()
+    report = _progress_report(detector, info)
+    if measure:
+        end = time.perf_counter()
+        if tracer is not None:
+            tracer.add('progress', start, end)
+        if metrics.enabled:
+            metrics.histogram('progress_poll_seconds',
+                              'progress report time').record(end - start)
+    return report
+
+
+def _progress_report(detector, info):
+    # the three stop port reads in one pipelined exchange
+    pipe = Pipeline(detector)
+    pipe.stop(protocol.get_time_left, TimerType.NB_CYCLES)
+    pipe.stop(protocol.get_time_left, TimerType.NB_FRAMES)
+    pipe.stop(protocol.get_time_left, TimerType.ACQUISITION_TIME)
+    (_, nb_cycles_left), (_, nb_frames_left), (_, exposure_time_left) = \
+        pipe.execute()
+    return ProgressEvent(info, nb_cycles_left + 2, nb_frames_left + 2,
+                         exposure_time_left)
@@ -0,0 +1,282 @@
+"""
+Detector to host clock correlation.
+
+The detector clock (ACTUAL_TIME, read through the stop port) is sampled
+at a low rate and a drift and offset model mapping detector time to host
+time (time.time()) is fitted on the samples. Frames are then stamped with
+their estimated exposure start and end in host time without any per frame
+request:
+
+    clock = ClockCorrelator(mythen)
+    with clock:                  # samples every clock.interval seconds
+        with mythen.acquisition(clock=clock, nb_frames=1000) as acq:
+            for event in acq:
+                print(event.exposure_start, event.exposure_end)
+        # all frames re-stamped with the final (best) model
+        starts, ends = acq.exposure_times()
+
+Each sample takes the host time in the middle of the request. Samples
+with a long round trip are the least accurate so only the fastest ones
+are used for the fit.
+
+The frame step (exposure plus readout dead time, or the frame period) is
+first estimated with the performance model (see sls.perf) and then
+measured: the acquisition samples the detector progress (frames done at
+a given detector time) every clock.interval seconds.
+"""
+
+import time
+import logging
+import threading
+import collections
+
+import numpy
+
+from . import metrics, perf
+from .client import Pipeline
+from .protocol import TimerType, get_time_left
+
+log = logging.getLogger('SLSClock')
+
+# clock sample:
+# - host_time: host time (time.time(), s) in the middle of the request
+# - detector_time: detector ACTUAL_TIME (s)
+# - rtt: request round trip time (s): the uncertainty of the sample
+ClockSample = collections.namedtuple(
+    'ClockSample', ('host_time', 'detector_time', 'rtt'))
+
+
+class ClockModel:
+    """
+    host_time = host_ref + rate * (detector_time - detector_ref)
+
+    uncertainty: residual standard deviation (s) of the fit (NaN if
+    unknown)
+    """
+
+    def __init__(self, detector_ref, host_ref, rate=1.0,
+                 uncertainty=float('nan'), nb_samples=1):
+        self.detector_ref = detector_ref
+        self.host_ref = host_ref
+        self.rate = rate
+        self.uncertainty = uncertainty
+        self.nb_samples = nb_samples
+
+    def __repr__(self):
+        return ('ClockModel(drift={:.3f}ppm, uncertainty={:.6f}s, '
+                'nb_samples={})'.format(self.drift * 1E6, self.uncertainty,
+                                        self.nb_samples))
+
+    @property
+    def drift(self):
+        """relative drift of the detector clock (host seconds per detector
+        second - 1)"""
+        return self.rate - 1
+
+    @property
+    def offset(self):
+        """host time at detector time 0"""
+        return self.host_ref - self.rate * self.detector_ref
+
+    @classmethod
+    def fit(cls, samples):
+        """Least squares fit on the samples (at least one)"""
+        host = numpy.array([s.host_time for s in samples])
+        det = numpy.array([s.detector_time for s in samples])
+        # fit relative to the last sample: good numerical conditioning and
+        # exact where it matters most (recent frames)
+        det_ref, host_ref = det[-1], host[-1]
+        if len(samples) < 2 or numpy.ptp(det) == 0:
+            return cls(det_ref, host_ref, nb_samples=len(samples))
+        x, y = det - det_ref, host - host_ref
+        rate, intercept = numpy.polyfit(x, y, 1)
+        residuals = y - (rate * x + intercept)
+        return cls(det_ref, host_ref + intercept, rate,
+                   uncertainty=float(numpy.std(residuals)),
+                   nb_samples=len(samples))
+
+    def to_host(self, detector_time):
+        """host time of the detector time (scalar or array)"""
+        return self.host_ref + self.rate * (numpy.asarray(detector_time) -
+                                            self.detector_ref)
+
+    def to_detector(self, host_time):
+        """detector time of the host time (scalar or array)"""
+        return self.detector_ref + (numpy.asarray(host_time) -
+                                    self.host_ref) / self.rate
+
+
+class ClockCorrelator:
+    """
+    Samples the detector clock and keeps a ClockModel fitted on the most
+    recent samples.
+
+    interval: time (s) between samples of the background sampling
+              (see start())
+    window: number of most recent samples kept
+    best_fraction: fraction of the samples (the ones with the shortest
+                   round trip) used for the fit
+    perf_model: perf.PerfModel giving the initial frame step (default:
+                the calibrated one of the detector host, loaded on first
+                use)
+    """
+
+    def __init__(self, detector, interval=1.0, window=64, best_fraction=0.5,
+                 perf_model=None):
+        self.detector = detector
+        self.interval = interval
+        self.best_fraction = best_fraction
+        self._perf_model = perf_model
+        self.samples = collections.deque(maxlen=window)
+        self._model = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _add(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+            self._model = None
+        if metrics.enabled:
+            metrics.histogram('clock_sample_rtt_seconds',
+                              'detector clock sample round trip') \
+                .record(sample.rtt)
+
+    def sample(self):
+        """Take one detector clock sample. Returns it"""
+        start = time.time()
+        detector_time = self.detector.detector_actual_time
+        end = time.time()
+        sample = ClockSample((start + end) / 2, detector_time, end - start)
+        self._add(sample)
+        return sample
+
+    def acquisition_start(self):
+        """
+        Detector time of the start of the running acquisition
+        (ACTUAL_TIME - MEASUREMENT_TIME sampled in one pipelined exchange).
+        The ACTUAL_TIME sample also feeds the model
+        """
+        pipe = Pipeline(self.detector)
+        pipe.stop(get_time_left, TimerType.ACTUAL_TIME)
+        pipe.stop(get_time_left, TimerType.MEASUREMENT_TIME)
+        start = time.time()
+        (_, actual_time), (_, measurement_time) = pipe.execute()
+        end = time.time()
+        self._add(ClockSample((start + end) / 2, actual_time, end - start))
+        return actual_time - measurement_time
+
+    def acquisition_progress(self):
+        """
+        (ACTUAL_TIME, frames left, cycles left) of the running acquisition
+        sampled in one pipelined exchange. The ACTUAL_TIME sample also
+        feeds the model
+        """
+        pipe = Pipeline(self.detector)
+        pipe.stop(get_time_left, TimerType.ACTUAL_TIME)
+        pipe.stop(get_time_left, TimerType.NB_FRAMES)
+        pipe.stop(get_time_left, TimerType.NB_CYCLES)
+        start = time.time()
+        (_, actual_time), (_, frames_left), (_, cycles_left) = pipe.execute()
+        end = time.time()
+        self._add(ClockSample((start + end) / 2, actual_time, end - start))
+        return actual_time, frames_left, cycles_left
+
+    @property
+    def perf_model(self):
+        """performance model estimating the readout dead time"""
+        if self._perf_model is None:
+            self._perf_model = perf.PerfModel.load(self.detector.host)
+        return self._perf_model
+
+    @property
+    def model(self):
+        """ClockModel fitted on the best recent samples (samples the
+        detector if there are none yet)"""
+        if not self.samples:
+            self.sample()
+        with self._lock:
+            if self._model is None:
+                samples = sorted(self.samples, key=lambda s: s.rtt)
+                nb = max(int(len(samples) * self.best_fraction), 1)
+                best = sorted(samples[:nb], key=lambda s: s.detector_time)
+                self._model = model = ClockModel.fit(best)
+                if metrics.enabled:
+                    metrics.gauge('clock_drift_ppm',
+                                  'detector clock drift').set(model.drift * 1E6)
+                    metrics.gauge('clock_uncertainty_seconds',
+                                  'detector clock fit residual') \
+                        .set(model.uncertainty)
+            return self._model
+
+    def exposure_times(self, acquisition_start, info, indexes, frame_time):
+        """exposure_times() with the current model"""
+        return exposure_times(self.model, acquisition_start, info, indexes,
+                              frame_time)
+
+    def start(self):
+        """Start sampling every interval seconds in a background thread"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='SLSClock',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception:
+                log.exception('failed to sample detector clock')
+            self._stop.wait(self.interval)
+
+
+def frame_step(info, readout_time):
+    """
+    Nominal time (s) between frames: exposure plus readout dead time or the
+    frame period if longer
+    """
+    return max(info['acq_time'] * 1E-9 + readout_time,
+               info['frame_period'] * 1E-9)
+
+
+def fit_frame_step(progress):
+    """
+    Frame step (s) measured on (detector time, frames done) progress
+    samples: least squares slope. None if there are not enough samples
+    """
+    if len(progress) < 2:
+        return None
+    det, done = numpy.array(progress, dtype=float).T
+    if numpy.ptp(done) == 0:
+        return None
+    return float(numpy.polyfit(done, det, 1)[0])
+
+
+def exposure_times(model, acquisition_start, info, indexes, frame_time):
+    """
+    Estimated exposure (start, end) host times of the given frame indexes
+    (array) of an internally timed acquisition started at the detector
+    time acquisition_start, with the update_client info and the time (s)
+    between frames (see frame_step() and fit_frame_step())
+    """
+    exposure = info['acq_time'] * 1E-9
+    first_start = acquisition_start + info['delay_after_trigger'] * 1E-9
+    starts = first_start + numpy.asarray(indexes) * frame_time
+    starts = model.to_host(starts)
+    return starts, starts + exposure * model.rate
@@ -12,12 +12,12 @@ def load_mythen(mythen, fname):
     else:
         config = load(fname)
     if 'hostname' in config:
-        assert mythen.conn_ctrl.addr[0] == config['hostname']
-        assert mythen.conn_stop.addr[0] == config['hostname']
+        assert mythen.ctrl_pool.addr[0] == config['hostname']
+        assert mythen.stop_pool.addr[0] == config['hostname']
     if 'port' in config:
-        assert mythen.conn_ctrl.addr[1] == config['port']
+        assert mythen.ctrl_pool.addr[1] == config['port']
     if 'stopport' in config:
-        assert mythen.conn_stop.addr[1] == config['stopport']
+        assert mythen.stop_pool.addr[1] == config['stopport']
     if 'nmod' in config:
         mythen.set_nb_modules(config['nmod'])
         assert mythen.get_nb_modules() == config['nmod']
@@ -30,6 +30,12 @@ def load_mythen(mythen, fname):
     if 'clkdivider' in config:
         mythen.clock_divider = config['clkdivider']
         assert mythen.clock_divider == config['clkdivider']
+    if 'totclkdivider' in config:
+        mythen.tot_clock_divider = config['totclkdivider']
+        assert mythen.tot_clock_divider == config['totclkdivider']
+    if 'totdutycycle' in config:
+        mythen.tot_duty_cycle = config['totdutycycle']
+        assert mythen.tot_duty_cycle == config['totdutycycle']
     for i in range(4):
         key = 'extsig:{}'.format(i)
         if key in config:
@@ -54,9 +60,9 @@ def load_mythen(mythen, fname):
 
 def save_mythen(mythen, fname):
     config = dict(
-        hostname=mythen.conn_ctrl.addr[0],
-        port=mythen.conn_ctrl.addr[1],
-        stopport=mythen.conn_stop.addr[1],
+        hostname=mythen.ctrl_pool.addr[0],
+        port=mythen.ctrl_pool.addr[1],
+        stopport=mythen.stop_pool.addr[1],
         nmod=mythen.get_nb_modules(),
         waitstates=mythen.wait_states,
         setlength=mythen.signal_length,
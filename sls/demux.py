@@ -0,0 +1,97 @@
+"""
+Pump-probe demultiplexing.
+
+In pump-probe mode (PUMP_PROBE_MODE readout flag, nb_probes probe types)
+each frame holds one sub-frame per probe, one after the other:
+
+    | probe 0: channel 0 .. N-1 | probe 1: channel 0 .. N-1 | ...
+
+Demux splits frames into a (nb_slots, nb_channels) array of per-probe
+views (no copy) and Accumulator sums them per probe in one vectorized
+operation per frame:
+
+    with mythen.acquisition(readout=ReadoutFlag.PUMP_PROBE_MODE,
+                            nb_probes=2, demux='probes',
+                            accumulate=True) as acq:
+        for event in acq:
+            if event.type == 'frame':
+                pumped, unpumped = event.data
+    print(acq.accumulator.mean())
+"""
+
+import numpy
+
+from .protocol import ReadoutFlag
+from .sparse import SparseFrame
+
+# Acquisition demux mode -> (update_client info key with the number of
+# slots, readout flag the detector needs to send one sub-frame per slot).
+# Gated acquisitions are not a mode: the gates of a frame are integrated
+# into a single frame
+DEMUX_MODES = dict(probes=('nb_probes', ReadoutFlag.PUMP_PROBE_MODE))
+
+
+class Demux:
+    """Splits frames of nb_slots sub-frames into per slot views"""
+
+    def __init__(self, nb_slots):
+        if nb_slots < 1:
+            raise ValueError('need at least one probe (got {})'
+                             .format(nb_slots))
+        self.nb_slots = nb_slots
+
+    def __repr__(self):
+        return '{}(nb_slots={})'.format(type(self).__name__, self.nb_slots)
+
+    @classmethod
+    def from_info(cls, mode, info, readout):
+        """Demux for the given mode ('probes'), update_client info and
+        readout flags"""
+        try:
+            key, flag = DEMUX_MODES[mode]
+        except KeyError:
+            raise ValueError('unknown demux mode {!r} (expected one of {})'
+                             .format(mode, ', '.join(DEMUX_MODES)))
+        if not readout & flag:
+            raise ValueError('demux {!r} needs the {} readout flag'
+                             .format(mode, flag.name))
+        return cls(max(info[key], 1))
+
+    def nb_channels(self, frame_length):
+        nb_channels, rest = divmod(frame_length, self.nb_slots)
+        if rest:
+            raise ValueError('frame of {} channels cannot be split into {} '
+                             'probes'.format(frame_length, self.nb_slots))
+        return nb_channels
+
+    def split(self, frame):
+        """(nb_slots, nb_channels) view on the frame (no copy)"""
+        if isinstance(frame, SparseFrame):
+            frame = frame.to_dense()
+        return frame.reshape(self.nb_slots, self.nb_channels(len(frame)))
+
+
+class Accumulator:
+    """Per probe running sum of demultiplexed frames"""
+
+    def __init__(self, nb_slots, nb_channels, dtype='<i8'):
+        self.sums = numpy.zeros((nb_slots, nb_channels), dtype=dtype)
+        self.nb_frames = 0
+
+    def __repr__(self):
+        return '{}(nb_slots={}, nb_channels={}, nb_frames={})'.format(
+            type(self).__name__, self.sums.shape[0], self.sums.shape[1],
+            self.nb_frames)
+
+    def add(self, frames):
+        """add a (nb_slots, nb_channels) demultiplexed frame"""
+        numpy.add(self.sums, frames, out=self.sums)
+        self.nb_frames += 1
+
+    def mean(self):
+        """(nb_slots, nb_channels) mean counts per frame"""
+        return self.sums / max(self.nb_frames, 1)
+
+    def reset(self):
+        self.sums[:] = 0
+        self.nb_frames = 0
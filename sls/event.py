@@ -0,0 +1,199 @@
+"""
+Acquisition events.
+
+Events still unpack like the former (event type, payload) tuples:
+
+    for event_type, data in detector.acquisition():
+        ...
+
+but they also carry metadata:
+
+    for event in detector.acquisition():
+        if event.type == 'frame':
+            print(event.frame_nb, event.cycle_nb, event.timestamp, event.data)
+
+Continuous acquisitions also yield periodic 'checkpoint' events (see
+CheckpointEvent) when a checkpoint interval is given.
+"""
+
+import time
+
+
+class Event:
+
+    __slots__ = ()
+
+    type = None
+
+    @property
+    def payload(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return iter((self.type, self.payload))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.type, self.payload)[index]
+
+
+class FrameEvent(Event):
+    """
+    A frame received from the detector.
+
+    * index: frame index since the start of the acquisition
+    * frame_nb: frame number within the cycle
+    * cycle_nb: cycle number
+    * timestamp: host time (time.time()) when the frame was received
+    * detector_time: estimated detector time (s, since the start of the
+      acquisition) of the end of the frame exposure derived from the
+      acquisition parameters and the readout dead time (measured along
+      the acquisition with a clock). None if the timing is not internal
+    * data: the frame data (numpy view on the received buffer, no copy).
+      A (nb_probes, nb_channels) array in demux mode (see sls.demux)
+    * exposure_start, exposure_end: estimated host time (time.time()) of
+      the frame exposure. None unless the acquisition has a clock (see
+      sls.clock) and the timing is internal
+    """
+
+    __slots__ = ('index', 'frame_nb', 'cycle_nb', 'timestamp',
+                 'detector_time', 'data', 'exposure_start', 'exposure_end')
+
+    type = 'frame'
+
+    def __init__(self, index, frame_nb, cycle_nb, timestamp, detector_time,
+                 data, exposure_start=None, exposure_end=None):
+        self.index = index
+        self.frame_nb = frame_nb
+        self.cycle_nb = cycle_nb
+        self.timestamp = timestamp
+        self.detector_time = detector_time
+        self.data = data
+        self.exposure_start = exposure_start
+        self.exposure_end = exposure_end
+
+    @property
+    def payload(self):
+        return self.data
+
+    def __repr__(self):
+        return ('FrameEvent(index={}, frame_nb={}, cycle_nb={}, '
+                'timestamp={:.6f})'.format(self.index, self.frame_nb,
+                                           self.cycle_nb, self.timestamp))
+
+
+class ProgressEvent(Event):
+    """
+    Acquisition progress. Behaves also as a read-only mapping with the
+    acquisition info (shared by all events of the acquisition, not
+    copied) plus the progress fields (as the former progress dict)
+    """
+
+    __slots__ = ('info', 'timestamp', 'nb_cycles_left', 'nb_frames_left',
+                 'exposure_time_left')
+
+    type = 'progress'
+
+    fields = ('timestamp', 'nb_cycles_left', 'nb_frames_left',
+              'exposure_time_left', 'nb_cycles_finished',
+              'nb_frames_finished', 'current_cycle', 'current_frame',
+              'total_frames_finished', 'exposure_time')
+
+    def __init__(self, info, nb_cycles_left, nb_frames_left,
+                 exposure_time_left, timestamp=None):
+        self.info = info
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.nb_cycles_left = nb_cycles_left
+        self.nb_frames_left = nb_frames_left
+        self.exposure_time_left = exposure_time_left
+
+    @property
+    def payload(self):
+        return self
+
+    @property
+    def nb_cycles_finished(self):
+        return (self.info['nb_cycles'] or 1) - self.nb_cycles_left
+
+    @property
+    def nb_frames_finished(self):
+        return (self.info['nb_frames'] or 1) - self.nb_frames_left
+
+    @property
+    def current_cycle(self):
+        return self.nb_cycles_finished + 1
+
+    @property
+    def current_frame(self):
+        return self.nb_frames_finished + 1
+
+    @property
+    def total_frames_finished(self):
+        nb_frames = self.info['nb_frames'] or 1
+        return self.nb_cycles_finished * nb_frames + self.nb_frames_finished
+
+    @property
+    def exposure_time(self):
+        return self.info['acq_time'] * 1e-9 - self.exposure_time_left
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.fields:
+                return getattr(self, key)
+            return self.info[key]
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self.info) + list(self.fields)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self):
+        return ('ProgressEvent(frame={}, cycle={}, exposure_time_left={})'
+                .format(self.current_frame, self.current_cycle,
+                        self.exposure_time_left))
+
+
+class CheckpointEvent(Event):
+    """
+    Periodic checkpoint of a long (typically continuous) acquisition.
+
+    * index: checkpoint number since the start of the acquisition
+    * timestamp: host time (time.time()) of the checkpoint
+    * elapsed: time (s) since the start of the acquisition
+    * nb_frames: frames received since the start of the acquisition
+    * interval_frames: frames received since the previous checkpoint
+    * frame_rate: frames/s since the previous checkpoint
+    """
+
+    __slots__ = ('index', 'timestamp', 'elapsed', 'nb_frames',
+                 'interval_frames', 'frame_rate')
+
+    type = 'checkpoint'
+
+    def __init__(self, index, timestamp, elapsed, nb_frames, interval_frames,
+                 frame_rate):
+        self.index = index
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+        self.nb_frames = nb_frames
+        self.interval_frames = interval_frames
+        self.frame_rate = frame_rate
+
+    @property
+    def payload(self):
+        return self
+
+    def __repr__(self):
+        return ('CheckpointEvent(index={}, elapsed={:.3f}, nb_frames={}, '
+                'frame_rate={:.1f})'.format(self.index, self.elapsed,
+                                            self.nb_frames, self.frame_rate))
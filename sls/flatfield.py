@@ -0,0 +1,183 @@
+"""
+Streaming flat field builder.
+
+Frames of a flat (evenly illuminated) acquisition are summed into 64 bit
+counters as they arrive: no frame is kept so memory doesn't grow with the
+number or length of frames. Dead, hot and noisy channels can be asked for
+at any time during the acquisition and the flat field is ready when the
+last frame arrives:
+
+    builder = FlatFieldBuilder()
+    builder.acquire(mythen, nb_frames=500, exposure_time=10)
+    print(builder.bad_channels())
+    builder.save('flat.dat', 'bad.chans')
+
+The flat field file has one 'channel value' line per channel with the
+values normalized to a mean of 1 over the good channels and 0 for the
+bad ones (channels which read 0 in the flat field file are bad ones for
+the slsDetector library). The bad channel file has one channel per line
+(see settings._load_bad_channels).
+"""
+
+import logging
+
+import numpy
+
+from .sparse import SparseFrame
+
+log = logging.getLogger('SLSFlatField')
+
+
+class FlatFieldBuilder:
+    """
+    Incremental flat field.
+
+    dead_level: channels summing less than dead_level times the median
+                channel are dead
+    hot_level: channels summing more than hot_level times the median
+               channel are hot
+    noisy_level: channels whose frame to frame variance is more than
+                 noisy_level times their (Poisson) mean are noisy
+    """
+
+    def __init__(self, dead_level=0.2, hot_level=5.0, noisy_level=10.0):
+        self.dead_level = dead_level
+        self.hot_level = hot_level
+        self.noisy_level = noisy_level
+        self.sums = None
+        self.squares = None
+        self.nb_frames = 0
+
+    def __repr__(self):
+        nb_channels = 0 if self.sums is None else len(self.sums)
+        return '{}(nb_channels={}, nb_frames={})'.format(
+            type(self).__name__, nb_channels, self.nb_frames)
+
+    def reset(self):
+        self.sums = self.squares = None
+        self.nb_frames = 0
+
+    def add(self, frame):
+        """accumulate one frame (array, demultiplexed array or SparseFrame)"""
+        if isinstance(frame, SparseFrame):
+            channels, counts = frame.channels, frame.counts
+            nb_channels = frame.nb_channels
+        else:
+            frame = numpy.asarray(frame).reshape(-1)
+            nb_channels = len(frame)
+        if self.sums is None:
+            self.sums = numpy.zeros(nb_channels, dtype='<i8')
+            self.squares = numpy.zeros(nb_channels, dtype='<f8')
+        elif nb_channels != len(self.sums):
+            raise ValueError('frame of {} channels in a flat field of {} '
+                             'channels'.format(nb_channels, len(self.sums)))
+        if isinstance(frame, SparseFrame):
+            self.sums[channels] += counts
+            self.squares[channels] += numpy.square(counts, dtype='<f8')
+        else:
+            numpy.add(self.sums, frame, out=self.sums)
+            self.squares += numpy.square(frame, dtype='<f8')
+        self.nb_frames += 1
+
+    def consume(self, events, check_interval=None):
+        """
+        accumulate the frames of an acquisition (or any iterable of
+        events). Returns when the last frame has been added.
+        check_interval: every check_interval frames, log the channels which
+                        turned bad since the previous check
+        """
+        bad = None
+        for event in events:
+            if event.type != 'frame':
+                continue
+            self.add(event.data)
+            if check_interval and not self.nb_frames % check_interval:
+                bad, previous = self.bad(), bad
+                if previous is not None and (bad & ~previous).any():
+                    log.warning('new bad channels after %d frames: %s',
+                                self.nb_frames,
+                                numpy.flatnonzero(bad & ~previous).tolist())
+        log.info('flat field of %d frames: %d bad channels', self.nb_frames,
+                 len(self.bad_channels()))
+        return self
+
+    def acquire(self, detector, nb_frames, exposure_time, check_interval=None,
+                **opts):
+        """acquire nb_frames (read into two buffers) and consume them"""
+        with detector.acquisition(progress_interval=None, nb_buffers=2,
+                                  nb_frames=nb_frames, nb_cycles=1,
+                                  exposure_time=exposure_time, **opts) as acq:
+            return self.consume(acq, check_interval)
+
+    def _check(self):
+        if not self.nb_frames:
+            raise ValueError('empty flat field')
+
+    @property
+    def mean(self):
+        """mean counts per frame of each channel"""
+        self._check()
+        return self.sums / self.nb_frames
+
+    @property
+    def variance(self):
+        """frame to frame counts variance of each channel"""
+        mean = self.mean
+        return numpy.maximum(self.squares / self.nb_frames - mean * mean, 0)
+
+    def dead(self):
+        """dead (low counting) channel mask"""
+        level = self.dead_level * numpy.median(self.sums)
+        return self.sums <= level
+
+    def hot(self):
+        """hot (high counting) channel mask"""
+        level = self.hot_level * max(numpy.median(self.sums), 1)
+        return self.sums > level
+
+    def noisy(self):
+        """noisy channel mask (needs a few frames)"""
+        if self.nb_frames < 3:
+            return numpy.zeros(len(self.sums), dtype=bool)
+        mean = self.mean
+        return self.variance > self.noisy_level * numpy.maximum(mean, 1)
+
+    def bad(self):
+        """bad channel mask (dead, hot or noisy)"""
+        self._check()
+        return self.dead() | self.hot() | self.noisy()
+
+    def bad_channels(self):
+        """sorted bad channel indexes"""
+        return numpy.flatnonzero(self.bad())
+
+    def flat_field(self):
+        """
+        (values, errors): counts normalized to a mean of 1 over the good
+        channels and their Poisson errors. Bad channels are 0
+        """
+        bad = self.bad()
+        good_sums = self.sums[~bad]
+        if not len(good_sums) or not good_sums.sum():
+            raise ValueError('flat field without good channels')
+        sums = numpy.where(bad, 0, self.sums)
+        values = sums / good_sums.mean()
+        errors = numpy.where(bad, 0,
+                             values / numpy.sqrt(numpy.maximum(sums, 1)))
+        return values, errors
+
+    def save(self, flat_field_fname, bad_channels_fname=None):
+        """write the flat field (and the bad channel) files"""
+        values, _ = self.flat_field()
+        table = numpy.column_stack((numpy.arange(len(values)), values))
+        numpy.savetxt(flat_field_fname, table, fmt=('%d', '%.6g'))
+        if bad_channels_fname is not None:
+            numpy.savetxt(bad_channels_fname, self.bad_channels(), fmt='%d')
+
+
+def load_flat_field(fname):
+    """flat field values of a flat field file"""
+    channels, values = numpy.loadtxt(fname, unpack=True)
+    result = numpy.zeros(int(channels.max()) + 1)
+    result[channels.astype(int)] = values
+    return result
@@ -9,35 +9,89 @@ import os
 import time
 import logging
 import threading
+import collections
 
 import numpy
 
 from Lima.Core import (
-    HwInterface, HwDetInfoCtrlObj, HwSyncCtrlObj, HwBufferCtrlObj, HwCap,
-    HwFrameInfoType, SoftBufferCtrlObj, Size, Point, FrameDim, Roi, Bpp32,
-    IntTrig, IntTrigMult, Timestamp, AcqReady, AcqRunning, CtControl, CtSaving)
+    HwInterface, HwDetInfoCtrlObj, HwSyncCtrlObj, HwBufferCtrlObj,
+    HwRoiCtrlObj, HwCap, HwFrameInfoType, HwMaxImageSizeCallbackGen,
+    SoftBufferCtrlObj, Size, Point, FrameDim, Roi, Bpp8, Bpp16, Bpp32,
+    IntTrig, IntTrigMult, ExtTrigSingle, ExtTrigMult, ExtGate, Timestamp,
+    AcqReady, AcqRunning, CtControl, CtSaving)
 
-from sls.client import Detector
-from sls.protocol import DEFAULT_CTRL_PORT, DEFAULT_STOP_PORT
+from sls import trace
+from sls.client import Detector, apply_options
+from sls.protocol import (DEFAULT_CTRL_PORT, DEFAULT_STOP_PORT,
+                          NB_CHANNELS_PER_MODULE, ExternalCommunicationMode,
+                          ExternalSignal)
 
 
 Status = HwInterface.StatusType
 
+# detector dynamic range (bits) -> lima image type
+IMAGE_TYPES = {4: Bpp8, 8: Bpp8, 16: Bpp16, 24: Bpp32, 32: Bpp32}
+
+# lima image type -> detector dynamic range (bits)
+DYNAMIC_RANGES = {Bpp8: 8, Bpp16: 16, Bpp32: 24}
+
+# lima image type -> numpy dtype of the frame buffer
+IMAGE_DTYPES = {Bpp8: '<u1', Bpp16: '<u2', Bpp32: '<i4'}
+
+# lima trigger mode -> (detector timing mode, input signal type)
+TRIGGER_MODES = {
+    IntTrig: (ExternalCommunicationMode.AUTO_TIMING, None),
+    IntTrigMult: (ExternalCommunicationMode.AUTO_TIMING, None),
+    ExtTrigSingle: (ExternalCommunicationMode.TRIGGER_EXPOSURE,
+                    ExternalSignal.TRIGGER_IN_RISING_EDGE),
+    ExtTrigMult: (ExternalCommunicationMode.TRIGGER_EXPOSURE,
+                  ExternalSignal.TRIGGER_IN_RISING_EDGE),
+    ExtGate: (ExternalCommunicationMode.GATE_FIX_NUMBER,
+              ExternalSignal.GATE_IN_ACTIVE_HIGH),
+}
+
+
+# per frame timing metadata:
+# - frame_nb: acquisition frame number
+# - timestamp: host time (s) at which the frame was received
+# - interval: time (s) since the previous frame was received
+# - actual_time: latest sample of the detector internal timer (s)
+# - measurement_time: latest sample of the detector measurement time (s)
+# - sample_timestamp: host time (s) at which detector times were sampled
+FrameTiming = collections.namedtuple(
+    'FrameTiming', ('frame_nb', 'timestamp', 'interval', 'actual_time',
+                    'measurement_time', 'sample_timestamp'))
+
 
 class Sync(HwSyncCtrlObj):
+    """
+    input_signal: index of the external signal wired to the trigger/gate
+                  input. Its type is set with the trigger mode. None
+                  leaves the external signals as they are
+    """
 
     trig_mode = IntTrig
+    latency_time = 0.0
+    # number of frames asked by lima (None: not set yet)
+    nb_frames = None
 
-    def __init__(self, detector):
+    def __init__(self, detector, input_signal=None):
         self.detector = detector
+        self.input_signal = input_signal
         super().__init__()
 
     def checkTrigMode(self, trig_mode):
-        return trig_mode in (IntTrig, IntTrigMult)
+        return trig_mode in TRIGGER_MODES
 
     def setTrigMode(self, trig_mode):
         if not self.checkTrigMode(trig_mode):
             raise ValueError('Unsupported trigger mode')
+        timing_mode, signal = TRIGGER_MODES[trig_mode]
+        self.detector.timing_mode = timing_mode
+        if signal is not None and self.input_signal is not None:
+            self.detector.set_external_signal(self.input_signal, signal)
+        # the frames/cycles split of the new mode is applied with the
+        # acquisition (see frame_options())
         self.trig_mode = trig_mode
 
     def getTrigMode(self):
@@ -45,27 +99,66 @@ class Sync(HwSyncCtrlObj):
 
     def setExpTime(self, exp_time):
         self.detector.exposure_time = exp_time
+        self._set_frame_period(exp_time, self.latency_time)
 
     def getExpTime(self):
         return self.detector.exposure_time
 
     def setLatTime(self, lat_time):
+        self._set_frame_period(self.detector.exposure_time, lat_time)
         self.latency_time = lat_time
 
     def getLatTime(self):
-        return self.latency_time
+        frame_period = self.detector.frame_period
+        if not frame_period:
+            return 0.0
+        return max(frame_period - self.detector.exposure_time, 0.0)
+
+    def _set_frame_period(self, exp_time, lat_time):
+        # frame period 0 means frames follow each other with the minimum
+        # (readout) dead time
+        self.detector.frame_period = exp_time + lat_time if lat_time > 0 else 0
+
+    def frame_options(self):
+        """
+        acquisition options splitting the lima frames into frames and
+        cycles for the trigger mode (empty if lima didn't set them)
+        """
+        if self.nb_frames is None:
+            return {}
+        # in trigger mode each trigger starts a cycle of nb_frames frames
+        if self.trig_mode == ExtTrigMult:
+            opts = dict(nb_frames=1, nb_cycles=self.nb_frames)
+        else:
+            opts = dict(nb_frames=self.nb_frames, nb_cycles=1)
+        if self.trig_mode == ExtGate:
+            opts['nb_gates'] = 1
+        return opts
 
     def setNbHwFrames(self, nb_frames):
-        self.detector.nb_frames = nb_frames
-        self.detector.nb_cycles = 1
+        self.nb_frames = nb_frames
+        apply_options(self.detector, self.frame_options())
+
+    @property
+    def continuous(self):
+        # lima convention: 0 frames means acquire until stopped
+        return self.nb_frames == 0
 
     def getNbHwFrames(self):
+        if self.continuous:
+            return 0
         nb = self.detector.nb_frames or 1
         nb *= self.detector.nb_cycles or 1
         return nb
 
     def getValidRanges(self):
-        return self.ValidRangesType(10E-9, 1E6, 10E-9, 1E6)
+        return self.ValidRangesType(10E-9, 1E6, 0, 1E6)
+
+
+class MaxImageSizeCallbackGen(HwMaxImageSizeCallbackGen):
+
+    def setMaxImageSizeCallbackActive(self, cb_active):
+        pass
 
 
 class DetInfo(HwDetInfoCtrlObj):
@@ -75,8 +168,25 @@ class DetInfo(HwDetInfoCtrlObj):
 
     def __init__(self, detector):
         self.detector = detector
+        self.image_type = None
+        self.mis_cb_gen = MaxImageSizeCallbackGen()
         super().__init__()
 
+    def update(self):
+        """
+        Synchronize the lima image type and size with the detector dynamic
+        range and number of modules.
+        Notifies lima through the max image size callback if they changed
+        """
+        info = self.detector.update_client()
+        image_type = IMAGE_TYPES[info['dynamic_range']]
+        image_size = Size(info['nb_modules'] * NB_CHANNELS_PER_MODULE, 1)
+        if image_type != self.image_type or image_size != self.image_size:
+            self.image_type = image_type
+            self.image_size = image_size
+            self.mis_cb_gen.maxImageSizeChanged(image_size, image_type)
+        return image_type
+
     def getMaxImageSize(self):
         return self.image_size
 
@@ -87,10 +197,15 @@ class DetInfo(HwDetInfoCtrlObj):
         return type(self).image_type
 
     def getCurrImageType(self):
+        if self.image_type is None:
+            return self.update()
         return self.image_type
 
     def setCurrImageType(self, image_type):
-        self.image_type = image_type
+        if image_type not in DYNAMIC_RANGES:
+            raise ValueError('Unsupported image type')
+        self.detector.dynamic_range = DYNAMIC_RANGES[image_type]
+        self.update()
 
     def getPixelSize(self):
         return (1.0, 1.0)
@@ -102,25 +217,77 @@ class DetInfo(HwDetInfoCtrlObj):
         return "Mythen-II"
 
     def registerMaxImageSizeCallback(self, cb):
-        pass
+        self.mis_cb_gen.registerMaxImageSizeCallback(cb)
 
     def unregisterMaxImageSizeCallback(self, cb):
-        pass
+        self.mis_cb_gen.unregisterMaxImageSizeCallback(cb)
 
 
-class Interface(HwInterface):
+class RoiCtrl(HwRoiCtrlObj):
+    """
+    Hardware ROI. The detector only reads out the modules touched by the ROI
+    so the ROI is always expanded to module boundaries
+    """
 
     def __init__(self, detector):
+        self.detector = detector
+        super().__init__()
+
+    def checkRoi(self, set_roi):
+        if set_roi.isEmpty():
+            return Roi()
+        size = NB_CHANNELS_PER_MODULE
+        x0 = set_roi.getTopLeft().x
+        x1 = x0 + set_roi.getSize().getWidth()
+        x0 = (x0 // size) * size
+        x1 = -(-x1 // size) * size
+        return Roi(x0, 0, x1 - x0, 1)
+
+    def setRoi(self, set_roi):
+        hw_roi = self.checkRoi(set_roi)
+        if hw_roi.isEmpty():
+            rois = []
+        else:
+            xmin = hw_roi.getTopLeft().x
+            xmax = xmin + hw_roi.getSize().getWidth() - 1
+            rois = [dict(xmin=xmin, xmax=xmax)]
+        self.detector.rois = rois
+
+    def getRoi(self):
+        rois = self.detector.rois
+        if not rois:
+            return Roi()
+        xmin = min(roi['xmin'] for roi in rois)
+        xmax = max(roi['xmax'] for roi in rois)
+        return self.checkRoi(Roi(xmin, 0, xmax - xmin + 1, 1))
+
+
+class Interface(HwInterface):
+
+    # minimum time (s) between detector time samples during acquisition.
+    # Each sample costs a stop port request so we don't do it on every frame
+    detector_time_interval = 1.0
+
+    # number of most recent frame timings kept
+    nb_frame_timings = 10000
+
+    # time (s) between checkpoints (logged) of continuous acquisitions
+    checkpoint_interval = 60.0
+
+    def __init__(self, detector, input_signal=None):
         super().__init__()
         self.detector = detector
         self.det_info = DetInfo(detector)
-        self.sync = Sync(detector)
+        self.sync = Sync(detector, input_signal)
+        self.roi = RoiCtrl(detector)
         self.buff = SoftBufferCtrlObj()
-        self.caps = list(map(HwCap, (self.det_info, self.sync, self.buff)))
+        self.caps = list(map(HwCap, (self.det_info, self.sync, self.roi,
+                                     self.buff)))
         self._status = Status.Ready
         self._nb_acquired_frames = 0
         self._acq_thread = None
         self._acq = None
+        self.frame_timings = collections.deque(maxlen=self.nb_frame_timings)
 
     def getCapList(self):
         return self.caps
@@ -129,13 +296,22 @@ class Interface(HwInterface):
         pass
 
     def prepareAcq(self):
-        nb_frames = self.sync.getNbHwFrames()
+        # the dynamic range may have been changed directly on the detector
+        self.det_info.update()
         frame_dim = self.buff.getFrameDim()
-        frame_infos = [HwFrameInfoType() for i in range(nb_frames)]
-        self._acq = self.detector.acquisition(progress_interval=None)
+        # frames are copied to the lima buffer before the next one is
+        # read: a single rolling client buffer is enough. continuous also
+        # clears the continuous readout flag left by a previous live
+        # acquisition
+        continuous = self.sync.continuous
+        self._acq = self.detector.acquisition(
+            progress_interval=None, continuous=continuous, nb_buffers=1,
+            checkpoint_interval=self.checkpoint_interval if continuous else None,
+            **self.sync.frame_options())
         self._nb_acquired_frames = 0
+        self.frame_timings.clear()
         self._acq_thread = threading.Thread(
-            target=self._acquire, args=(self._acq, frame_dim, frame_infos))
+            target=self._acquire, args=(self._acq, frame_dim))
 
     def startAcq(self):
         self._acq_thread.start()
@@ -156,9 +332,26 @@ class Interface(HwInterface):
     def getNbHwAcquiredFrames(self):
         return self._nb_acquired_frames
 
-    def _acquire(self, acq, frame_dim, frame_infos):
+    def getFrameTiming(self, frame_nb):
+        """FrameTiming of the given frame (only the most recent are kept)"""
+        timings = self.frame_timings
+        if timings:
+            index = frame_nb - timings[0].frame_nb
+            if 0 <= index < len(timings):
+                return timings[index]
+        raise KeyError('no timing information for frame {}'.format(frame_nb))
+
+    def getLastFrameTiming(self):
+        return self.frame_timings[-1] if self.frame_timings else None
+
+    def _sample_detector_time(self):
+        detector = self.detector
+        return (detector.detector_actual_time, detector.measurement_time,
+                time.time())
+
+    def _acquire(self, acq, frame_dim):
         try:
-            self._acquisition_loop(acq, frame_dim, frame_infos)
+            self._acquisition_loop(acq, frame_dim)
         except BaseException as err:
             print('Error occurred: {!r}'.format(err))
             import traceback
@@ -166,37 +359,68 @@ class Interface(HwInterface):
         finally:
             self._acq = None
 
-    def _acquisition_loop(self, acq, frame_dim, frame_infos):
+    def _acquisition_loop(self, acq, frame_dim):
         frame_size = frame_dim.getMemSize()
+        dtype = IMAGE_DTYPES[frame_dim.getImageType()]
         buffer_mgr = self.buff.getBuffer()
+        timings = self.frame_timings
+        time_interval = self.detector_time_interval
+
+        tracer = trace.tracer
 
         start_time = time.time()
         buffer_mgr.setStartTimestamp(Timestamp(start_time))
+        last_time = start_time
+        sample = self._sample_detector_time()
         self._status = Status.Exposure
-        for frame_nb, (_, frame) in enumerate(acq):
+        for event in acq:
+            if event.type != 'frame':
+                # checkpoint (already logged by the acquisition)
+                continue
+            frame_nb, frame, recv_time = event.index, event.data, event.timestamp
+            if tracer is not None:
+                frame_start = time.perf_counter()
             self._status = Status.Readout
+            if frame.nbytes != frame_size:
+                raise ValueError('frame size mismatch: detector sent {} bytes '
+                                 'but lima expects {} bytes'
+                                 .format(frame.nbytes, frame_size))
             buff = buffer_mgr.getFrameBufferPtr(frame_nb)
             # don't know why the sip.voidptr has no size
             buff.setsize(frame_size)
-            data = numpy.frombuffer(buff, dtype='<i4')
+            # frame and buffer have the same item size: no widening copy
+            data = numpy.frombuffer(buff, dtype=dtype)
             data[:] = frame
-            frame_info = frame_infos[frame_nb]
+            # frame info is created lazily: long acquisitions don't
+            # allocate one object per frame up front
+            frame_info = HwFrameInfoType()
             frame_info.acq_frame_nb = frame_nb
+            frame_info.frame_timestamp = Timestamp(recv_time - start_time)
             buffer_mgr.newFrameReady(frame_info)
+            if recv_time - sample[2] >= time_interval:
+                sample = self._sample_detector_time()
+            timings.append(FrameTiming(frame_nb, recv_time,
+                                       recv_time - last_time, *sample))
+            last_time = recv_time
             self._nb_acquired_frames += 1
             self._status = Status.Exposure
+            if tracer is not None:
+                tracer.add('lima_frame', frame_start, time.perf_counter(),
+                           frame_nb)
         self._status = Status.Ready
 
 
-def get_ctrl(host, ctrl_port=DEFAULT_CTRL_PORT, stop_port=DEFAULT_STOP_PORT):
+def get_ctrl(host, ctrl_port=DEFAULT_CTRL_PORT, stop_port=DEFAULT_STOP_PORT,
+             input_signal=None):
     detector = Detector(host, ctrl_port=ctrl_port, stop_port=stop_port)
-    interface = Interface(detector)
+    interface = Interface(detector, input_signal)
     ctrl = CtControl(interface)
     return ctrl
 
 
 def run(options):
-    ctrl = get_ctrl(options.host, options.ctrl_port, options.stop_port)
+    ctrl = get_ctrl(options.host, options.ctrl_port, options.stop_port,
+                    options.input_signal)
 
     acq = ctrl.acquisition()
     acq.setAcqExpoTime(options.exposure_time)
@@ -258,6 +482,8 @@ def main(args=None):
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--ctrl-port', default=DEFAULT_CTRL_PORT)
     parser.add_argument('--stop-port', default=DEFAULT_STOP_PORT)
+    parser.add_argument('--input-signal', default=None, type=int,
+                        help='external signal wired to the trigger input')
     parser.add_argument('-n', '--nb-frames', default=10, type=int)
     parser.add_argument('-e', '--exposure-time',default=0.1, type=float)
     parser.add_argument('-l', '--latency-time', default=0.0, type=float)
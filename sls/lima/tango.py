@@ -1,5 +1,8 @@
+import json
+
 from tango import DevState, Util
 from tango.server import Device, device_property, attribute
+from sls import metrics as sls_metrics
 from sls.lima.camera import get_ctrl
 from sls.protocol import DEFAULT_CTRL_PORT, DEFAULT_STOP_PORT
 from sls.protocol import RunStatus
@@ -10,14 +13,37 @@ class MythenSLS(Device):
     host = device_property(dtype=str)
     ctrl_port = device_property(dtype=int, default_value=DEFAULT_CTRL_PORT)
     stop_port = device_property(dtype=int, default_value=DEFAULT_STOP_PORT)
+    # serve metrics in prometheus text format on this port (0: off) of
+    # this interface (default: local only)
+    metrics_port = device_property(dtype=int, default_value=0)
+    metrics_host = device_property(dtype=str, default_value='127.0.0.1')
+    # external signal wired to the trigger/gate input (-1: not managed)
+    input_signal = device_property(dtype=int, default_value=-1)
 
     def init_device(self):
         super().init_device()
         self.ctrl = get_control()
+        self.interface.sync.input_signal = \
+            None if self.input_signal < 0 else self.input_signal
+        self.metrics_server = None
+        if self.metrics_port:
+            sls_metrics.enable()
+            self.metrics_server = sls_metrics.REGISTRY.serve(
+                self.metrics_port, host=self.metrics_host)
+
+    def delete_device(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+        super().delete_device()
+
+    @property
+    def interface(self):
+        return self.ctrl.hwInterface()
 
     @property
     def mythen(self):
-        return self.ctrl.hwInterface().detector
+        return self.interface.detector
 
     def dev_state(self):
         status = self.mythen.run_status
@@ -51,6 +77,29 @@ class MythenSLS(Device):
     def measurement_time(self):
         return self.mythen.measurement_time
 
+    @attribute(unit='s')
+    def last_frame_timestamp(self):
+        timing = self.interface.getLastFrameTiming()
+        return float('nan') if timing is None else timing.timestamp
+
+    @attribute(unit='s')
+    def last_frame_interval(self):
+        timing = self.interface.getLastFrameTiming()
+        return float('nan') if timing is None else timing.interval
+
+    @attribute(dtype=bool)
+    def metrics_enabled(self):
+        return sls_metrics.enabled
+
+    @metrics_enabled.setter
+    def metrics_enabled(self, enabled):
+        sls_metrics.enable(enabled)
+
+    @attribute(dtype=str)
+    def metrics(self):
+        """metrics as a JSON encoded dict"""
+        return json.dumps(sls_metrics.REGISTRY.to_dict())
+
     @attribute(dtype=int)
     def energy_threshold(self):
         return self.mythen.energy_threshold
@@ -0,0 +1,143 @@
+"""
+In-process loopback transport.
+
+Connects the client directly to simulated detectors running in a
+background thread of the same process: no TCP/IP stack, no simulator
+process and no ports to allocate. Each command goes through a socket pair
+handed to the simulator detector handlers.
+
+Useful for tests and for micro-benchmarks of the protocol stack:
+
+    from sls.simulator import detectors
+    from sls.loopback import Loopback
+
+    with Loopback(detectors({'mythen': {}})) as loopback:
+        mythen = loopback.client()
+        print(mythen.energy_threshold)
+
+Requires the simulator dependencies (gevent, scipy).
+"""
+
+import socket
+import logging
+import threading
+import itertools
+
+import gevent
+import gevent.event
+import gevent.socket
+
+from . import client
+
+# client address seen by the simulated detectors
+LOOPBACK_HOST = '127.0.0.1'
+
+log = logging.getLogger('SLSLoopback')
+
+
+class Loopback:
+    """
+    Serves the given simulator detectors (sls.simulator.Detector) from a
+    dedicated thread running its own gevent hub. Detectors are identified
+    by their ctrl and stop ports.
+    """
+
+    def __init__(self, detectors):
+        self.detectors = list(detectors)
+        self.handlers = {}
+        for detector in self.detectors:
+            self.handlers[detector['ctrl_port']] = detector.handle_ctrl
+            self.handlers[detector['stop_port']] = detector.handle_stop
+        self._client_ports = itertools.count(1)
+        self._ready = threading.Event()
+        self._thread = None
+        self._hub = None
+        self._stop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name='SLSLoopback',
+                                        daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.send()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        self._hub = gevent.get_hub()
+        stopped = gevent.event.Event()
+        # an active async watcher keeps the hub alive while idle and is
+        # the thread safe way to wake it up to stop
+        self._stop = self._hub.loop.async_()
+        self._stop.start(stopped.set)
+        self._ready.set()
+        log.info('loopback ready for ports %s', sorted(self.handlers))
+        try:
+            stopped.wait()
+        finally:
+            self._stop.close()
+            for detector in self.detectors:
+                if detector.acquisition:
+                    detector.acquisition.stop()
+
+    def _serve(self, handler, sock, addr):
+        # runs in the loopback thread
+        sock = gevent.socket.socket(sock.family, sock.type,
+                                    fileno=sock.detach())
+        gevent.spawn(handler, sock, addr)
+
+    def open(self, port):
+        """Open a new connection to the given port. Returns the client socket"""
+        if self._thread is None:
+            raise ConnectionRefusedError('loopback is not running')
+        try:
+            handler = self.handlers[port]
+        except KeyError:
+            raise ConnectionRefusedError(
+                'no loopback detector on port {}'.format(port))
+        sock, server_sock = socket.socketpair()
+        addr = LOOPBACK_HOST, next(self._client_ports)
+        self._hub.loop.run_callback_threadsafe(self._serve, handler,
+                                               server_sock, addr)
+        return sock
+
+    def connection(self, addr, timeout=None):
+        """Connection factory (usable as Detector connection_factory)"""
+        return LoopbackConnection(addr, timeout=timeout, loopback=self)
+
+    def client(self, detector=None, **kwargs):
+        """
+        Returns a sls.client.Detector connected to the given simulator
+        detector (defaults to the first one)
+        """
+        if detector is None:
+            detector = self.detectors[0]
+        return client.Detector(LOOPBACK_HOST, ctrl_port=detector['ctrl_port'],
+                               stop_port=detector['stop_port'],
+                               connection_factory=self.connection, **kwargs)
+
+
+class LoopbackConnection(client.Connection):
+
+    def __init__(self, addr, timeout=None, loopback=None):
+        super().__init__(addr, timeout=timeout)
+        self.loopback = loopback
+
+    def open_transport(self, timeout):
+        sock = self.loopback.open(self.port)
+        sock.settimeout(timeout)
+        return sock
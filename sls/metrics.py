@@ -0,0 +1,301 @@
+"""
+Lightweight metrics: counters, gauges and HDR-style histograms.
+
+Metrics are disabled by default. Instrumented code checks the module
+level `enabled` flag before doing any measurement so the cost when
+disabled is a single attribute lookup.
+
+    from sls import metrics
+
+    metrics.enable()
+    ... use the detector ...
+    print(metrics.REGISTRY.to_dict())     # JSON serializable
+    print(metrics.REGISTRY.to_prometheus())
+
+    # expose in prometheus text format on http://localhost:9100/metrics
+    metrics.REGISTRY.serve(9100)
+"""
+
+import math
+import threading
+import collections
+import socketserver
+import http.server
+
+# instrumented code must check this flag before measuring
+enabled = False
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def disable():
+    enable(False)
+
+
+def _json_value(value):
+    # JSON has no NaN nor infinity: unknown values are None
+    return value if math.isfinite(value) else None
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    items = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+    return '{' + items + '}'
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted(dict(labels).items()))
+
+    @property
+    def key(self):
+        return self.name + _labels_text(self.labels)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.key)
+
+
+class Counter(Metric):
+    """Monotonically increasing value"""
+
+    type = 'counter'
+
+    def __init__(self, name, help='', labels=()):
+        super().__init__(name, help=help, labels=labels)
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def reset(self):
+        self.value = 0
+
+    def to_dict(self):
+        return self.value
+
+    def to_prometheus(self):
+        return ['{}_total{} {}'.format(self.name, _labels_text(self.labels),
+                                       self.value)]
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help='', labels=()):
+        super().__init__(name, help=help, labels=labels)
+        self.value = float('nan')
+
+    def set(self, value):
+        self.value = value
+
+    def reset(self):
+        self.value = float('nan')
+
+    def to_dict(self):
+        return _json_value(self.value)
+
+    def to_prometheus(self):
+        return ['{}{} {}'.format(self.name, _labels_text(self.labels),
+                                 self.value)]
+
+
+class Histogram(Metric):
+    """
+    HDR-style histogram: log-linear buckets with a constant relative
+    precision of 1/2**precision_bits over the whole range.
+
+    Values are stored as integer multiples of `resolution` (ex: 1e-6 for
+    seconds with microsecond resolution). Values above the range are
+    clamped to the last bucket.
+    """
+
+    type = 'summary'
+
+    quantiles = 0.5, 0.9, 0.99, 0.999
+
+    def __init__(self, name, help='', labels=(), resolution=1e-6,
+                 precision_bits=3, max_bits=40):
+        super().__init__(name, help=help, labels=labels)
+        self.resolution = resolution
+        self.precision_bits = precision_bits
+        self.sub_buckets = 1 << precision_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = (max_bits - precision_bits + 1) * self.sub_buckets * [0]
+        self.reset()
+
+    def reset(self):
+        self.counts[:] = len(self.counts) * [0]
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value):
+        sub = self.sub_buckets
+        if value < 2 * sub:
+            return value
+        shift = value.bit_length() - self.precision_bits - 1
+        return (shift + 1) * sub + (value >> shift) - sub
+
+    def _lower_bound(self, index):
+        sub = self.sub_buckets
+        if index < 2 * sub:
+            return index
+        shift = index // sub - 1
+        return (index % sub + sub) << shift
+
+    def record(self, value):
+        ivalue = min(max(int(value / self.resolution), 0), self.max_value)
+        self.counts[self._index(ivalue)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Value at quantile q (0 <= q <= 1). NaN if empty"""
+        if not self.count:
+            return float('nan')
+        target = max(math.ceil(q * self.count), 1)
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= target:
+                # report bucket middle, bounded by the real extremes
+                low = self._lower_bound(index)
+                high = self._lower_bound(index + 1)
+                value = (low + high) / 2 * self.resolution
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float('nan')
+
+    def to_dict(self):
+        result = dict(count=self.count, sum=self.sum,
+                      mean=_json_value(self.mean), min=_json_value(self.min),
+                      max=_json_value(self.max))
+        for q in self.quantiles:
+            result['p{:g}'.format(q * 100)] = _json_value(self.quantile(q))
+        return result
+
+    def to_prometheus(self):
+        lines = []
+        for q in self.quantiles:
+            labels = self.labels + (('quantile', q),)
+            lines.append('{}{} {}'.format(self.name, _labels_text(labels),
+                                          self.quantile(q)))
+        labels = _labels_text(self.labels)
+        lines.append('{}_sum{} {}'.format(self.name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(self.name, labels, self.count))
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics. `counter()`, `gauge()` and `histogram()` return
+    the existing metric with the same name and labels or create a new one
+    """
+
+    def __init__(self, prefix='sls_'):
+        self.prefix = prefix
+        self.metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, klass, name, help='', labels=(), **kwargs):
+        key = name, tuple(sorted(dict(labels).items()))
+        try:
+            return self.metrics[key]
+        except KeyError:
+            with self._lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = klass(self.prefix + name, help=help,
+                                   labels=labels, **kwargs)
+                    self.metrics[key] = metric
+            return metric
+
+    def counter(self, name, help='', labels=()):
+        return self._get(Counter, name, help=help, labels=labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self._get(Gauge, name, help=help, labels=labels)
+
+    def histogram(self, name, help='', labels=(), **kwargs):
+        return self._get(Histogram, name, help=help, labels=labels, **kwargs)
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    def to_dict(self):
+        """metric values (JSON serializable: unknown values are None)"""
+        return {metric.key: metric.to_dict()
+                for metric in list(self.metrics.values())}
+
+    def to_prometheus(self):
+        lines, described = [], set()
+        # samples of the same metric family must be contiguous
+        metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help:
+                    lines.append('# HELP {} {}'.format(metric.name,
+                                                       metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.to_prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve metrics in prometheus text format from a background thread.
+        Returns the HTTP server (call shutdown() to stop it)
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = _ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='SLSMetrics', daemon=True)
+        thread.start()
+        return server
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is python >= 3.7
+    daemon_threads = True
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,446 @@
+"""
+Acquisition performance model.
+
+Estimates the frame rate, dead time, duration and data volume of an
+acquisition from its parameters (exposure, frame period, dynamic range,
+readout speeds and flags) and the network bandwidth, and warns when the
+plan cannot be met:
+
+    from sls.perf import PerfModel, plan_state
+
+    model = PerfModel.load(mythen.host)   # calibrated if possible
+    estimate = model.estimate(plan_state(mythen, exposure_time=1e-3,
+                                         nb_frames=1000),
+                              consumer_time=2e-3)
+    print(estimate.report())
+
+The readout time model is nominal until calibrated against the actual
+detector: calibrate() runs short acquisitions at each dynamic range and
+stores the measured frame times locally (see DEFAULT_CALIBRATION_PATH)
+so later estimates use them.
+
+From the command line:
+
+$ sls-perf -e 0.001 -n 1000 --dynamic-range 16          # nominal detector
+$ sls-perf --host=bl04mythen -e 0.001 -n 1000            # current state
+$ sls-perf --host=bl04mythen --calibrate
+"""
+
+import os
+import json
+import time
+import logging
+
+import numpy
+
+from . import protocol
+from .client import Pipeline, apply_options
+from .protocol import (SpeedType, ReadoutFlag, ExternalCommunicationMode,
+                       NB_CHANNELS_PER_MODULE, SPARSE_READOUT)
+
+log = logging.getLogger('SLSPerf')
+
+DEFAULT_CALIBRATION_PATH = os.path.join(os.path.expanduser('~'), '.sls',
+                                        'perf.json')
+
+# state of a factory Mythen II (6 modules) in Detector property units
+DEFAULT_STATE = dict(
+    exposure_time=1.0, frame_period=0.0, delay_after_trigger=0.0,
+    nb_frames=1, nb_cycles=1, dynamic_range=24,
+    readout=ReadoutFlag.NORMAL_READOUT,
+    timing_mode=ExternalCommunicationMode.AUTO_TIMING,
+    clock_divider=6, wait_states=13, signal_length=3,
+    nb_channels=6 * NB_CHANNELS_PER_MODULE)
+
+# plan state keys which are measured by calibrate()
+CALIBRATION_KEYS = ('exposure_time', 'frame_period', 'dynamic_range',
+                    'clock_divider', 'wait_states', 'signal_length',
+                    'nb_channels')
+
+# plan state keys changed by measure()
+RESTORE_KEYS = ('exposure_time', 'frame_period', 'nb_frames', 'nb_cycles',
+                'dynamic_range')
+
+
+def counter_bits(dynamic_range):
+    """bits read out of each channel counter"""
+    return 24 if dynamic_range in (24, 32) else dynamic_range
+
+
+def frame_bytes(state):
+    """bytes of a (dense) frame on the wire"""
+    bits = 32 if state['dynamic_range'] in (24, 32) else state['dynamic_range']
+    return state['nb_channels'] * bits // 8
+
+
+def readout_cycles(state):
+    """
+    serial readout clock periods of a frame: the chips of a module are read
+    out in parallel, bit after bit, each bit taking the clock divider plus
+    the wait states and signal length
+    """
+    speed = state['clock_divider'] + state['wait_states'] + state['signal_length']
+    return counter_bits(state['dynamic_range']) * speed
+
+
+def plan_state(detector, **plan):
+    """
+    Acquisition state (see DEFAULT_STATE) of the detector read in one
+    pipelined exchange with the given plan fields (Detector property
+    names and units) on top
+    """
+    pipe = Pipeline(detector)
+    pipe.ctrl(protocol.update_client)
+    pipe.ctrl(protocol.get_readout)
+    pipe.ctrl(protocol.get_external_communication_mode)
+    for speed in (SpeedType.CLOCK_DIVIDER, SpeedType.WAIT_STATES,
+                  SpeedType.SIGNAL_LENGTH):
+        pipe.ctrl(protocol.get_speed, speed)
+    (_, info), (_, readout), (_, timing_mode), (_, clock_divider), \
+        (_, wait_states), (_, signal_length) = pipe.execute()
+    shape, _ = protocol._to_numpy_meta(info['data_bytes'],
+                                       info['dynamic_range'])
+    state = dict(
+        exposure_time=info['acq_time'] * 1E-9,
+        frame_period=info['frame_period'] * 1E-9,
+        delay_after_trigger=info['delay_after_trigger'] * 1E-9,
+        nb_frames=info['nb_frames'], nb_cycles=info['nb_cycles'],
+        dynamic_range=info['dynamic_range'], readout=readout,
+        timing_mode=timing_mode, clock_divider=clock_divider,
+        wait_states=wait_states, signal_length=signal_length,
+        nb_channels=shape[0])
+    state.update(plan)
+    return state
+
+
+class Estimate:
+    """
+    Performance estimate of an acquisition (times in s, sizes in bytes).
+
+    * frame_time: time between frames (None if externally timed)
+    * limit: what sets the frame time: 'exposure', 'readout',
+      'frame_period', 'network', 'consumer' or 'trigger'
+    * nb_frames: total number of frames (None if continuous)
+    * duration: None if externally timed or continuous
+    * warnings: list of reasons the plan cannot be met as given
+    """
+
+    __slots__ = ('exposure_time', 'readout_time', 'transfer_time',
+                 'frame_time', 'limit', 'nb_frames', 'duration',
+                 'frame_bytes', 'warnings')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name))
+
+    def __repr__(self):
+        return '{}(frame_rate={}, duration={}, limit={!r})'.format(
+            type(self).__name__, self.frame_rate, self.duration, self.limit)
+
+    @property
+    def frame_rate(self):
+        return None if not self.frame_time else 1 / self.frame_time
+
+    @property
+    def dead_time(self):
+        """time between frames not spent exposing"""
+        if self.frame_time is None:
+            return self.readout_time
+        return self.frame_time - self.exposure_time
+
+    @property
+    def total_bytes(self):
+        if self.nb_frames is None:
+            return None
+        return self.nb_frames * self.frame_bytes
+
+    @property
+    def data_rate(self):
+        """bytes/s while acquiring"""
+        return None if not self.frame_time else self.frame_bytes / self.frame_time
+
+    def report(self):
+        def fmt(value, unit, scale=1):
+            return 'unknown' if value is None else \
+                '{:.6g} {}'.format(value * scale, unit)
+        lines = [
+            'exposure time: ' + fmt(self.exposure_time, 's'),
+            'readout time:  ' + fmt(self.readout_time, 's'),
+            'transfer time: ' + fmt(self.transfer_time, 's'),
+            'frame time:    ' + fmt(self.frame_time, 's') +
+            ' (limited by {})'.format(self.limit),
+            'frame rate:    ' + fmt(self.frame_rate, 'Hz'),
+            'dead time:     ' + fmt(self.dead_time, 's'),
+            'frames:        ' + ('endless' if self.nb_frames is None
+                                 else str(self.nb_frames)),
+            'duration:      ' + fmt(self.duration, 's'),
+            'frame size:    ' + fmt(self.frame_bytes, 'kB', 1E-3),
+            'data volume:   ' + fmt(self.total_bytes, 'MB', 1E-6),
+            'data rate:     ' + fmt(self.data_rate, 'MB/s', 1E-6),
+        ]
+        lines += ['WARNING: ' + warning for warning in self.warnings]
+        return '\n'.join(lines)
+
+
+class PerfModel:
+    """
+    readout_time = readout_overhead + cycle_time * readout_cycles(state)
+    transfer_time = frame_bytes(state) / bandwidth
+
+    The defaults are nominal values for a Mythen II on a 1 GbE link.
+    nb_records: number of measured acquisitions the model was fitted on
+    """
+
+    def __init__(self, readout_overhead=20E-6, cycle_time=20E-9,
+                 bandwidth=100E6, nb_records=0):
+        self.readout_overhead = readout_overhead
+        self.cycle_time = cycle_time
+        self.bandwidth = bandwidth
+        self.nb_records = nb_records
+
+    def __repr__(self):
+        return ('PerfModel(readout_overhead={:.3g}s, cycle_time={:.3g}s, '
+                'bandwidth={:.3g}B/s, nb_records={})'.format(
+                    self.readout_overhead, self.cycle_time, self.bandwidth,
+                    self.nb_records))
+
+    def readout_time(self, state):
+        return self.readout_overhead + self.cycle_time * readout_cycles(state)
+
+    def transfer_time(self, state):
+        return frame_bytes(state) / self.bandwidth
+
+    def estimate(self, state, consumer_time=None):
+        """
+        Estimate of the acquisition with the given state (see plan_state;
+        missing keys are taken from DEFAULT_STATE).
+        consumer_time: time (s) the client spends processing each frame
+        """
+        state = dict(DEFAULT_STATE, **state)
+        readout = ReadoutFlag(state['readout'])
+        exposure = state['exposure_time']
+        readout_time = self.readout_time(state)
+        transfer_time = self.transfer_time(state)
+        in_ram = bool(readout & ReadoutFlag.STORE_IN_RAM)
+        continuous = bool(readout & ReadoutFlag.CONTINOUS_RO) and \
+            not state['nb_frames']
+        nb_cycles = max(state['nb_cycles'], 1)
+        nb_frames = None if continuous else \
+            max(state['nb_frames'], 1) * nb_cycles
+        warnings = []
+        if readout & SPARSE_READOUT:
+            warnings.append('sparse readout: transfer estimated for dense '
+                            'frames (upper bound)')
+        # candidates for the frame time: the slowest one wins
+        limits = [(exposure + readout_time,
+                   'exposure' if exposure >= readout_time else 'readout')]
+        period = state['frame_period']
+        if period:
+            limits.append((period, 'frame_period'))
+            if period < exposure + readout_time:
+                warnings.append(
+                    'frame period {:.6g}s shorter than exposure + readout '
+                    '({:.6g}s)'.format(period, exposure + readout_time))
+        detector_time = max(limits)[0]
+        if not in_ram:
+            limits.append((transfer_time, 'network'))
+            if transfer_time > detector_time:
+                warnings.append(
+                    'network bound: a frame takes {:.6g}s to transfer but '
+                    'the detector makes one every {:.6g}s'
+                    .format(transfer_time, detector_time))
+        if consumer_time is not None and not in_ram:
+            limits.append((consumer_time, 'consumer'))
+            if consumer_time > max(detector_time, transfer_time):
+                warnings.append(
+                    'consumer slower than the frame time ({:.6g}s > {:.6g}s):'
+                    ' frames back up until the detector blocks (consider a '
+                    'burst acquisition or a lighter consumer)'.format(
+                        consumer_time, max(detector_time, transfer_time)))
+        frame_time, limit = max(limits)
+        if state['timing_mode'] != ExternalCommunicationMode.AUTO_TIMING:
+            warnings.append('external timing: frame time set by the triggers')
+            frame_time = duration = None
+            limit = 'trigger'
+        elif continuous:
+            duration = None
+        else:
+            frames_per_cycle = nb_frames // nb_cycles
+            duration = nb_cycles * (state['delay_after_trigger'] +
+                                    frames_per_cycle * frame_time)
+            if in_ram:
+                # bulk readout of the detector RAM at the end
+                duration += nb_frames * transfer_time
+                if consumer_time is not None:
+                    duration += nb_frames * consumer_time
+        return Estimate(exposure_time=exposure, readout_time=readout_time,
+                        transfer_time=transfer_time, frame_time=frame_time,
+                        limit=limit, nb_frames=nb_frames, duration=duration,
+                        frame_bytes=frame_bytes(state), warnings=warnings)
+
+    @classmethod
+    def fit(cls, records):
+        """
+        Model fitted on measured acquisitions: each record is a plan state
+        (CALIBRATION_KEYS) with the measured frame_time (s).
+        The bandwidth is the highest data rate of the records, so at least
+        one of them should be network bound (see calibrate()).
+        Returns the nominal model if there are no records
+        """
+        model = cls(nb_records=len(records))
+        if not records:
+            return model
+        states = [dict(DEFAULT_STATE, **record) for record in records]
+        measured = numpy.array([record['frame_time'] for record in records])
+        # the link moved the bytes of a frame every frame time: the
+        # fastest record gives the bandwidth (the nominal one only if the
+        # records are not physical)
+        rates = numpy.array([frame_bytes(s) for s in states]) / measured
+        rate = float(rates.max())
+        if numpy.isfinite(rate) and rate > 0:
+            model.bandwidth = rate
+        transfer = numpy.array([model.transfer_time(s) for s in states])
+        # readout: frames not limited by the network or the frame period
+        dead = measured - numpy.array([s['exposure_time'] for s in states])
+        periods = numpy.array([s['frame_period'] for s in states])
+        free = (transfer < measured * 0.9) & (periods < measured * 0.9)
+        cycles = numpy.array([readout_cycles(s) for s in states])[free]
+        dead = dead[free]
+        if len(numpy.unique(cycles)) > 1:
+            a = numpy.stack((numpy.ones(len(cycles)), cycles), axis=1)
+            (overhead, cycle_time), *_ = numpy.linalg.lstsq(a, dead,
+                                                            rcond=None)
+            if cycle_time > 0:
+                model.readout_overhead = max(float(overhead), 0.0)
+                model.cycle_time = float(cycle_time)
+                return model
+        if len(dead):
+            # not enough distinct speeds: keep the nominal cycle time
+            overhead = numpy.mean(dead - model.cycle_time * cycles)
+            model.readout_overhead = max(float(overhead), 0.0)
+        return model
+
+    @classmethod
+    def load(cls, host=None, path=DEFAULT_CALIBRATION_PATH):
+        """Model fitted on the stored records (of the given host)"""
+        return cls.fit(load_records(host, path))
+
+
+def load_records(host=None, path=DEFAULT_CALIBRATION_PATH):
+    """stored calibration records (of the given host)"""
+    try:
+        with open(path, 'rt') as fobj:
+            records = json.load(fobj)
+    except FileNotFoundError:
+        return []
+    if host is not None:
+        records = [record for record in records if record.get('host') == host]
+    return records
+
+
+def save_records(records, path=DEFAULT_CALIBRATION_PATH):
+    """store the records, replacing the stored ones of the same hosts"""
+    hosts = {record.get('host') for record in records}
+    kept = [record for record in load_records(path=path)
+            if record.get('host') not in hosts]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wt') as fobj:
+        json.dump(kept + list(records), fobj, indent=1)
+
+
+def restore_plan(detector, state):
+    """bring back the acquisition parameters of a plan_state()"""
+    apply_options(detector, {key: state[key] for key in RESTORE_KEYS})
+
+
+def measure(detector, nb_frames=200, **plan):
+    """
+    Run an acquisition of nb_frames with the given plan. Returns its
+    calibration record: the plan state and the measured frame_time (s)
+    """
+    state = plan_state(detector, nb_frames=nb_frames, nb_cycles=1, **plan)
+    with detector.acquisition(progress_interval=None, nb_frames=nb_frames,
+                              nb_cycles=1, **plan) as acq:
+        stamps = [event.timestamp for event in acq if event.type == 'frame']
+    # first to last frame: start overhead excluded
+    frame_time = (stamps[-1] - stamps[0]) / max(len(stamps) - 1, 1)
+    record = {key: state[key] for key in CALIBRATION_KEYS}
+    record.update(host=detector.host, frame_time=frame_time, date=time.time())
+    log.info('measured %r', record)
+    return record
+
+
+def calibrate(detector, dynamic_ranges=(4, 8, 16, 24), exposure_time=1E-4,
+              nb_frames=200, path=DEFAULT_CALIBRATION_PATH):
+    """
+    Measure the frame time at each dynamic range with a short exposure
+    and no frame period, store the records (if path is not None) and
+    return the fitted model. The acquisition parameters are restored
+    afterwards
+    """
+    previous = plan_state(detector)
+    try:
+        records = [measure(detector, nb_frames=nb_frames,
+                           exposure_time=exposure_time, frame_period=0,
+                           dynamic_range=dynamic_range)
+                   for dynamic_range in dynamic_ranges]
+    finally:
+        restore_plan(detector, previous)
+    if path is not None:
+        save_records(records, path)
+    return PerfModel.fit(records)
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='SLS acquisition performance estimate')
+    parser.add_argument('--host', default=None,
+                        help='detector (default: a nominal Mythen II)')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='measure the detector and store the results')
+    parser.add_argument('--calibration', default=DEFAULT_CALIBRATION_PATH,
+                        help='calibration file')
+    parser.add_argument('-e', '--exposure-time', type=float)
+    parser.add_argument('-p', '--frame-period', type=float)
+    parser.add_argument('--delay-after-trigger', type=float)
+    parser.add_argument('-n', '--nb-frames', type=int)
+    parser.add_argument('-c', '--nb-cycles', type=int)
+    parser.add_argument('--dynamic-range', type=int, choices=(4, 8, 16, 24))
+    parser.add_argument('--clock-divider', type=int)
+    parser.add_argument('--wait-states', type=int)
+    parser.add_argument('--signal-length', type=int)
+    parser.add_argument('--burst', action='store_true',
+                        help='store frames in the detector RAM')
+    parser.add_argument('--consumer-time', type=float,
+                        help='client processing time per frame (s)')
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level),
+                        format='%(levelname)s %(asctime)-15s %(name)s: '
+                               '%(message)s')
+
+    plan = {key: value for key, value in vars(options).items()
+            if key in DEFAULT_STATE and value is not None}
+    if options.host is None:
+        if options.calibrate:
+            parser.error('--calibrate needs a --host')
+        model, state = PerfModel.load(path=options.calibration), plan
+    else:
+        from .client import Detector
+        detector = Detector(options.host)
+        if options.calibrate:
+            model = calibrate(detector, path=options.calibration)
+            print(model)
+        else:
+            model = PerfModel.load(detector.host, options.calibration)
+        state = plan_state(detector, **plan)
+    if options.burst:
+        readout = ReadoutFlag(state.get('readout', DEFAULT_STATE['readout']))
+        state['readout'] = readout | ReadoutFlag.STORE_IN_RAM
+    print(model.estimate(state, options.consumer_time).report())
+
+
+if __name__ == '__main__':
+    main()
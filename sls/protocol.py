@@ -1,6 +1,11 @@
 import sys
+import time
 import struct
 
+import numpy
+
+from . import metrics, sparse, trace
+
 PY36 = sys.version_info[:2] >= (3, 6)
 
 if PY36:
@@ -8,8 +13,6 @@ if PY36:
 else:
     from sls import enum36 as enum
 
-import numpy
-
 
 DEFAULT_CTRL_PORT = 1952
 DEFAULT_STOP_PORT = 1953
@@ -19,6 +22,10 @@ INET_TEMPLATE = '{{:\x00<{}}}'.format(INET_ADDRSTRLEN)
 
 GET_CODE = -1
 
+NB_CHANNELS_PER_CHIP = 128
+NB_CHIPS_PER_MODULE = 10
+NB_CHANNELS_PER_MODULE = NB_CHIPS_PER_MODULE * NB_CHANNELS_PER_CHIP
+
 
 def add_enum_to_from_string(enum, emap):
     emap_inv = {v:k for k, v in emap.items()}
@@ -118,6 +125,13 @@ class SLSError(Exception):
     pass
 
 
+class SLSTimeoutError(SLSError):
+    """
+    Raised when a request or a frame doesn't arrive within its time budget.
+    The connection is closed when this happens
+    """
+
+
 IdParam = enum.IntEnum('IdParam', start=0, names=[
     'MODULE_SERIAL_NUMBER',
     'MODULE_FIRMWARE_VERSION',
@@ -187,6 +201,18 @@ SpeedType = enum.IntEnum('SpeedType', start=0, names=[
 ])
 
 
+DigitalTestMode = enum.IntEnum('DigitalTestMode', start=0, names=[
+    'CHIP_TEST',              # shift a reference pattern through the chips
+                              # and read it back (number of bit errors)
+    'MODULE_FIRMWARE_TEST',
+    'DETECTOR_FIRMWARE_TEST',
+    'DETECTOR_MEMORY_TEST',
+    'DETECTOR_BUS_TEST',
+    'DETECTOR_SOFTWARE_TEST',
+    'DIGITAL_BIT_TEST'
+])
+
+
 RunStatus = enum.IntEnum('RunStatus', start=0, names=[
     'IDLE',         # detector ready to start acquisition - no data in memory
     'ERROR',        # error i.e. normally fifo full
@@ -234,6 +260,10 @@ class ReadoutFlag(enum.IntFlag):
     CONTINOUS_RO = 0x4000            # pump-probe mode
 
 
+# readout flags with variable length (sparse) frames (see sls.sparse)
+SPARSE_READOUT = ReadoutFlag.READ_HITS | ReadoutFlag.ZERO_COMPRESSION
+
+
 ExternalCommunicationMode = enum.IntEnum('ExternalCommunicationMode', start=0, names=[
     'AUTO_TIMING',              # internal timing
     'TRIGGER_EXPOSURE',         # trigger mode i.e. exposure is triggered
@@ -304,36 +334,143 @@ def read_message(conn):
 
 
 def _to_numpy_meta(nb_bytes, dynamic_range):
+    """(shape, native dtype) of a frame of nb_bytes"""
     if dynamic_range in (24, 32): # 24/32 bits
         return (nb_bytes // 4,), '<i4'
     elif dynamic_range == 16:
-        return (nb_bytes // 2,), '<i2'
+        return (nb_bytes // 2,), '<u2'
     elif dynamic_range == 8:
-        return (nb_bytes,), '<i'
+        return (nb_bytes,), '<u1'
+    elif dynamic_range == 4:
+        # two channels per byte
+        return (nb_bytes * 2,), '<u1'
     else:
         raise ValueError('unsupported dynamic range {!r}'.format(dynamic_range))
 
 
-def read_data(conn, size, dynamic_range):
-    data = conn.read(size)
-    data_size = len(data)
-    if data_size != size:
-        raise SLSError('wrong data size received: ' \
-                       'expected {} bytes but got {} bytes'
-                       .format(size, data_size))
-    shape, dtype = _to_numpy_meta(size, dynamic_range)
+def _frame_array(out, shape, dtype):
+    """array of the given shape and dtype on the writable buffer out"""
+    dtype = numpy.dtype(dtype)
+    nb_bytes = shape[0] * dtype.itemsize
+    data = memoryview(out).cast('B')[:nb_bytes]
+    if len(data) != nb_bytes:
+        raise ValueError('frame buffer too small: need {} bytes but got '
+                         '{} bytes'.format(nb_bytes, len(data)))
     return numpy.frombuffer(data, dtype=dtype)
 
 
+def decode_data(data, dynamic_range, dtype=None, out=None):
+    """
+    Decode raw frame bytes into a 1D array of channel counts.
+
+    dtype: output dtype. Defaults to the native one: the narrowest holding
+           the counts ('<u1' for 4 and 8 bit, '<u2' for 16 bit and '<i4'
+           for 24/32 bit). A wider one (ex: '<i4') widens while decoding
+    out: writable buffer (ex: numpy array) to decode into. Returns a view
+         on it. Otherwise a new array is allocated
+    """
+    shape, native = _to_numpy_meta(len(data), dynamic_range)
+    dtype = numpy.dtype(native if dtype is None else dtype)
+    if out is None:
+        frame = numpy.empty(shape, dtype=dtype)
+    else:
+        frame = _frame_array(out, shape, dtype)
+    if dynamic_range == 4:
+        packed = numpy.frombuffer(data, dtype='<u1')
+        # first channel in the low nibble
+        numpy.bitwise_and(packed, 0xF, out=frame[0::2])
+        numpy.right_shift(packed, 4, out=frame[1::2])
+    else:
+        frame[:] = numpy.frombuffer(data, dtype=native)
+    return frame
+
+
+def read_data(conn, size, dynamic_range, out=None, dtype=None):
+    """
+    Read a frame of size bytes. Returns the channel counts (see
+    decode_data for dtype). If out (writable buffer) is given the frame
+    is written into it and the returned array is a view on it. Otherwise
+    a new buffer is allocated.
+    Frames already in the requested dtype are read in place (no decoding)
+    """
+    shape, native = _to_numpy_meta(size, dynamic_range)
+    in_place = dynamic_range != 4 and (dtype is None or
+                                       numpy.dtype(dtype) == native)
+    if in_place and out is not None:
+        data = memoryview(out).cast('B')[:size]
+        if len(data) != size:
+            raise ValueError('frame buffer too small: need {} bytes but got '
+                             '{} bytes'.format(size, len(data)))
+        conn.readinto(data)
+    else:
+        data = conn.read(size)
+        data_size = len(data)
+        if data_size != size:
+            raise SLSError('wrong data size received: ' \
+                           'expected {} bytes but got {} bytes'
+                           .format(size, data_size))
+    tracer = trace.tracer
+    if tracer is not None:
+        start = time.perf_counter()
+    if in_place:
+        frame = numpy.frombuffer(data, dtype=native)
+    else:
+        frame = decode_data(data, dynamic_range, dtype=dtype, out=out)
+    if tracer is not None:
+        tracer.add('decode', start, time.perf_counter())
+    return frame
+
+
+def read_sparse_data(conn, size, dynamic_range, readout, dtype=None):
+    """
+    Read a variable length frame (READ_HITS or ZERO_COMPRESSION readout).
+    size is the size (bytes) of the dense frame. Returns a
+    sparse.SparseFrame (dense dtype: see decode_data)
+    """
+    shape, native = _to_numpy_meta(size, dynamic_range)
+    dtype = native if dtype is None else dtype
+    nb_words = read_i32(conn)
+    if not 0 <= nb_words <= shape[0]:
+        raise SLSError('wrong sparse frame size: {} words for {} channels'
+                       .format(nb_words, shape[0]))
+    words = numpy.frombuffer(conn.read(nb_words * 4), dtype='<i4')
+    decode = sparse.decode_hits if readout & ReadoutFlag.READ_HITS else \
+        sparse.decode_zero_compression
+    try:
+        frame = decode(words, shape[0], dtype=dtype)
+    except ValueError as error:
+        raise SLSError('wrong sparse frame: {}'.format(error))
+    return frame
+
+
 def request_reply(conn, request, reply_fmt='<i'):
+    measure = metrics.enabled or trace.tracer is not None
+    if measure:
+        start = time.perf_counter()
     conn.write(request)
     result = read_result(conn)
     if result == ResultType.FAIL:
         raise SLSError(read_message(conn))
     reply = read_format(conn, reply_fmt) if reply_fmt else None
+    if measure:
+        _record_command(request, start, time.perf_counter())
     return result, reply
 
 
+def _record_command(request, start, end):
+    code = struct.unpack_from('<i', request)[0]
+    try:
+        name = CommandCode(code).name
+    except ValueError:
+        name = str(code)
+    if metrics.enabled:
+        metrics.histogram('command_seconds', 'command round trip time',
+                          labels=dict(command=name)).record(end - start)
+    tracer = trace.tracer
+    if tracer is not None:
+        tracer.add(name, start, end)
+
+
 def decode_update_client(reply):
     return dict(last_client_ip=reply[0].strip(b'\x00').decode(),
                 nb_modules=reply[1],
@@ -458,6 +595,17 @@ def get_id(conn, mode, mod_nb=None):
     return result, reply[0]
 
 
+def digital_test(conn, mode, mod_nb=None):
+    assert isinstance(mode, DigitalTestMode)
+    if mode in (DigitalTestMode.CHIP_TEST, DigitalTestMode.DIGITAL_BIT_TEST):
+        assert mod_nb is not None
+        request = struct.pack('<iii', CommandCode.DIGITAL_TEST, mode, mod_nb)
+    else:
+        request = struct.pack('<ii', CommandCode.DIGITAL_TEST, mode)
+    result, reply = request_reply(conn, request, reply_fmt='<i')
+    return result, reply[0]
+
+
 def _settings(conn, mod_nb=0, value=GET_CODE):
     assert value == GET_CODE or isinstance(value, DetectorSettings)
     request = struct.pack('<iii', CommandCode.SETTINGS, value, mod_nb)
@@ -646,29 +794,94 @@ def set_lock(conn, value):
     return _lock(conn, value)
 
 
-def get_rois(conn):
-    request = struct.pack('<ii', CommandCode.SET_ROI, GET_CODE)
+def encode_rois(rois):
+    """
+    rois: list of dict with xmin, xmax (channels, both inclusive) and
+    optional ymin, ymax (default to 0)
+    """
+    values = []
+    for roi in rois:
+        values += [roi['xmin'], roi['xmax'],
+                   roi.get('ymin', 0), roi.get('ymax', 0)]
+    return struct.pack('<{}i'.format(len(values)), *values)
+
+
+def decode_rois(raw_data):
+    nb_rois = len(raw_data) // 4
+    return [dict(xmin=raw_data[4*i+0], xmax=raw_data[4*i+1],
+                 ymin=raw_data[4*i+2], ymax=raw_data[4*i+3])
+            for i in range(nb_rois)]
+
+
+def _rois(conn, rois=None):
+    if rois is None:
+        request = struct.pack('<ii', CommandCode.SET_ROI, GET_CODE)
+    else:
+        request = struct.pack('<ii', CommandCode.SET_ROI, len(rois))
+        request += encode_rois(rois)
     result, reply = request_reply(conn, request, reply_fmt='<i')
     nb_rois = reply[0]
-    raw_data = conn.read_format('<{}i'.format(4 * nb_rois))
-    rois = []
-    for i in range(nb_rois):
-        roi = dict(xmin=raw_data[4*i+0], xmax=raw_data[4*i+1],
-                   ymin=raw_data[4*i+2], ymax=raw_data[4*i+3])
-        rois.append(roi)
-    return rois
+    if nb_rois > 0:
+        raw_data = read_format(conn, '<{}i'.format(4 * nb_rois))
+    else:
+        raw_data = ()
+    return result, decode_rois(raw_data)
+
+
+def get_rois(conn):
+    return _rois(conn)
 
 
-def read_all(conn, frame_size, dynamic_range):
+def set_rois(conn, rois):
+    return _rois(conn, rois)
+
+
+def read_all(conn, frame_size, dynamic_range, out=None,
+             readout=ReadoutFlag.NORMAL_READOUT, dtype=None):
     request = struct.pack('<i', CommandCode.READ_ALL)
     conn.write(request)
-    return fetch_frames(conn, frame_size, dynamic_range)
+    return fetch_frames(conn, frame_size, dynamic_range, out=out,
+                        readout=readout, dtype=dtype)
 
 
-def fetch_frame(conn, frame_size, dynamic_range):
+def fetch_frame(conn, frame_size, dynamic_range, out=None,
+                readout=ReadoutFlag.NORMAL_READOUT, dtype=None):
+    """
+    Read the next acquisition frame. Returns (result, frame).
+    out and dtype: see read_data.
+    With a sparse readout (see SPARSE_READOUT) frame is a
+    sparse.SparseFrame unless out is given (see read_sparse_data)
+    """
+    tracer = trace.tracer
+    measure = metrics.enabled or tracer is not None
+    if measure:
+        start = time.perf_counter()
     result = read_result(conn)
     if result == ResultType.OK:
-        return result, read_data(conn, frame_size, dynamic_range)
+        if readout & SPARSE_READOUT:
+            data = read_sparse_data(conn, frame_size, dynamic_range, readout,
+                                    dtype=dtype)
+            payload_bytes = data.payload_bytes
+            if out is not None:
+                data = data.to_dense(out)
+        else:
+            data = read_data(conn, frame_size, dynamic_range, out=out,
+                             dtype=dtype)
+            payload_bytes = frame_size
+        if measure:
+            end = time.perf_counter()
+            if tracer is not None:
+                tracer.add('frame', start, end)
+        if metrics.enabled:
+            metrics.histogram('frame_fetch_seconds',
+                              'time waiting for and reading a frame') \
+                .record(end - start)
+            metrics.counter('frames', 'frames received').inc()
+            metrics.counter('frame_bytes', 'frame bytes received') \
+                .inc(payload_bytes)
+            metrics.gauge('frame_size_bytes', 'size of the last frame') \
+                .set(payload_bytes)
+        return result, data
     elif result == ResultType.FINISHED:
         return result, None
     elif result == ResultType.FAIL:
@@ -678,19 +891,30 @@ def fetch_frame(conn, frame_size, dynamic_range):
         raise SLSError('Unexpected frame result')
 
 
-def fetch_frames(conn, frame_size, dynamic_range):
+def fetch_frames(conn, frame_size, dynamic_range, out=None,
+                 readout=ReadoutFlag.NORMAL_READOUT, dtype=None):
+    """
+    Frames until the end of acquisition. out: optional sequence of frame
+    buffers (ex: 2D array) to read the frames into. Frames beyond its
+    length get a new buffer
+    """
+    buffers = iter(() if out is None else out)
     while True:
-        result, frame = fetch_frame(conn, frame_size, dynamic_range)
+        result, frame = fetch_frame(conn, frame_size, dynamic_range,
+                                    out=next(buffers, None), readout=readout,
+                                    dtype=dtype)
         if result == ResultType.OK:
             yield frame
         else:
             break
 
 
-def read_frame(conn, frame_size, dynamic_range):
+def read_frame(conn, frame_size, dynamic_range, out=None,
+               readout=ReadoutFlag.NORMAL_READOUT, dtype=None):
     request = struct.pack('<i', CommandCode.READ_FRAME)
     conn.write(request)
-    return read_data(conn, frame_size, dynamic_range)
+    return fetch_frame(conn, frame_size, dynamic_range, out=out,
+                       readout=readout, dtype=dtype)
 
 
 def start_acquisition_and_read_all(conn):
@@ -0,0 +1,371 @@
+"""
+Protocol wire recorder and offline replayer.
+
+Record every request and reply exchanged with the detector:
+
+    from sls.client import Detector
+    from sls.record import Recorder
+
+    with Recorder('session.slsrec') as recorder:
+        mythen = Detector('bl04mythen', connection_factory=recorder.connection)
+        mythen.acquire() ...
+
+Replay it later without a detector (at full speed or at the original timing):
+
+    from sls.record import Replayer
+
+    replayer = Replayer('session.slsrec', realtime=False)
+    # sessions are matched by port: any resolvable host will do
+    mythen = Detector('127.0.0.1', connection_factory=replayer.connection)
+    mythen.acquire() ...
+
+Session file format (little endian):
+
+* header: magic (8 bytes) + version (uint32)
+* records: kind (uint8), session id (uint32), monotonic time since the start
+  of the recording (float64), payload size (uint32) followed by the payload
+
+A session is everything exchanged between a connect and a close. The payload
+of a CONNECT record is the "<ip>:<port>" address.
+
+The detector closes the connection after each command so a session is
+usually one request and its reply. On replay, a session is picked when its
+request is complete (at the first read): the next recorded session of the
+same port with the same request. The number of polls (ex: run status or
+progress on the stop port) is not deterministic: when a request was made
+more times than recorded, the reply of its last session is replayed again,
+and recorded sessions never requested are skipped.
+"""
+
+import time
+import struct
+import threading
+import collections
+
+from .client import Connection
+
+MAGIC = b'SLSREC\x00\x00'
+VERSION = 1
+
+HEADER = struct.Struct('<8sI')
+RECORD = struct.Struct('<BIdI')
+
+CONNECT, WRITE, READ, CLOSE = range(4)
+
+Record = collections.namedtuple('Record', 'kind session time payload')
+
+
+def encode_addr(addr):
+    return '{0[0]}:{0[1]}'.format(addr).encode()
+
+
+def decode_addr(payload):
+    host, port = payload.decode().rsplit(':', 1)
+    return host, int(port)
+
+
+def session_request(records):
+    """request of a session: the bytes written before the first read"""
+    request = bytearray()
+    for record in records:
+        if record.kind == READ:
+            break
+        if record.kind == WRITE:
+            request += record.payload
+    return bytes(request)
+
+
+def load(filename):
+    """Load a session file. Returns a list of Record"""
+    with open(filename, 'rb') as fobj:
+        data = fobj.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('{!r} is not a session file'.format(filename))
+    if version != VERSION:
+        raise ValueError('unsupported session version {}'.format(version))
+    records = []
+    offset, size = HEADER.size, len(data)
+    while offset < size:
+        kind, session, t, nb_bytes = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + nb_bytes]
+        offset += nb_bytes
+        records.append(Record(kind, session, t, payload))
+    return records
+
+
+class Recorder:
+    """
+    Records the traffic of all connections created by the `connection`
+    factory (usable as Detector connection_factory) into a session file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fobj = open(filename, 'wb')
+        self.fobj.write(HEADER.pack(MAGIC, VERSION))
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        self._session_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if not self.fobj.closed:
+                self.fobj.close()
+
+    def new_session(self):
+        with self._lock:
+            self._session_id += 1
+            return self._session_id
+
+    def record(self, kind, session, payload=b''):
+        t = time.monotonic() - self.start
+        header = RECORD.pack(kind, session, t, len(payload))
+        with self._lock:
+            self.fobj.write(header)
+            self.fobj.write(payload)
+
+    def connection(self, addr, timeout=None):
+        return RecordingConnection(addr, timeout=timeout, recorder=self)
+
+
+class RecordingConnection(Connection):
+
+    def __init__(self, addr, timeout=None, recorder=None):
+        super().__init__(addr, timeout=timeout)
+        self.recorder = recorder
+        self.session = None
+
+    def connect(self):
+        super().connect()
+        self.session = self.recorder.new_session()
+        self.recorder.record(CONNECT, self.session, encode_addr(self.addr))
+
+    def close(self):
+        if self.sock and self.session is not None:
+            self.recorder.record(CLOSE, self.session)
+        super().close()
+
+    def write(self, buff):
+        self.recorder.record(WRITE, self.session, bytes(buff))
+        super().write(buff)
+
+    def recv(self, size):
+        data = super().recv(size)
+        self.recorder.record(READ, self.session, data)
+        return data
+
+    def read(self, size):
+        data = super().read(size)
+        self.recorder.record(READ, self.session, data)
+        return data
+
+    def readinto(self, buff):
+        size = super().readinto(buff)
+        self.recorder.record(READ, self.session,
+                             bytes(memoryview(buff).cast('B')[:size]))
+        return size
+
+
+class Replayer:
+    """
+    Replays a recorded session file. Each connection created by the
+    `connection` factory replays the recorded session of the same port
+    matching its request (see module doc).
+
+    realtime: if True, replies are delivered with the same delays as they
+              were recorded (scaled by 1/speed). Otherwise at full speed
+    strict: if True, requests must match recorded ones. Otherwise an
+            unknown request gets the next recorded session of the port
+    """
+
+    def __init__(self, filename, realtime=False, speed=1.0, strict=True):
+        self.filename = filename
+        self.realtime = realtime
+        self.speed = speed
+        self.strict = strict
+        self._lock = threading.Lock()
+        self.sessions = collections.OrderedDict()
+        # port: session ids in recorded order
+        self.ports = collections.defaultdict(collections.deque)
+        # (port, request): session ids in recorded order
+        self.requests = collections.defaultdict(collections.deque)
+        # (port, request): last replayed session
+        self.last = {}
+        for record in load(filename):
+            if record.kind == CONNECT:
+                self.sessions[record.session] = []
+                port = decode_addr(record.payload)[1]
+                self.ports[port].append(record.session)
+            self.sessions[record.session].append(record)
+        for port, session_ids in self.ports.items():
+            for session_id in session_ids:
+                request = session_request(self.sessions[session_id])
+                self.requests[port, request].append(session_id)
+
+    def next_session(self, port):
+        """next recorded session of the port (in recorded order)"""
+        with self._lock:
+            try:
+                session_id = self.ports[port].popleft()
+            except IndexError:
+                raise ConnectionRefusedError(
+                    'no more recorded sessions for port {}'.format(port))
+            request = session_request(self.sessions[session_id])
+            self.requests[port, request].remove(session_id)
+            self.last[port, request] = session_id
+            return self.sessions[session_id]
+
+    def find_session(self, port, request):
+        """
+        next recorded session of the port with the given request (the last
+        one again if they have all been replayed)
+        """
+        key = port, request
+        with self._lock:
+            session_ids = self.requests.get(key)
+            if session_ids:
+                session_id = session_ids.popleft()
+                self.ports[port].remove(session_id)
+                self.last[key] = session_id
+            elif key in self.last:
+                session_id = self.last[key]
+            elif self.strict:
+                raise ConnectionError(
+                    'no recorded session for request {!r} to port {}'
+                    .format(request, port))
+            else:
+                session_id = None
+        if session_id is None:
+            return self.next_session(port)
+        return self.sessions[session_id]
+
+    def connection(self, addr, timeout=None):
+        return ReplayConnection(addr, timeout=timeout, replayer=self)
+
+
+class ReplayConnection(Connection):
+
+    def __init__(self, addr, timeout=None, replayer=None):
+        super().__init__(addr, timeout=timeout)
+        self.replayer = replayer
+        self.records = None
+        self.request = None
+
+    def connect(self):
+        # the session is picked once the request is complete (see _bind)
+        self.records = None
+        self.request = bytearray()
+        self.buffer = bytearray()
+        self.sock = self
+
+    def close(self):
+        self.sock = None
+        self.records = None
+        self.request = None
+
+    def _bind(self):
+        """pick the recorded session of the request written so far"""
+        if self.records is not None:
+            return
+        request = bytes(self.request)
+        records = self.replayer.find_session(self.port, request)
+        recorded = session_request(records)
+        if recorded != request and self.replayer.strict:
+            raise ConnectionError('request {!r} does not match recorded {!r}'
+                                  .format(request, recorded))
+        records = collections.deque(records)
+        self.last_record_time = records.popleft().time
+        while records and records[0].kind == WRITE:
+            self.last_record_time = records.popleft().time
+        self.records = records
+        self.last_event_time = time.monotonic()
+
+    def fileno(self):
+        return -1
+
+    def _due_in(self, record):
+        """time (s) until the record is due (realtime replay only)"""
+        if not self.replayer.realtime:
+            return 0
+        gap = (record.time - self.last_record_time) / self.replayer.speed
+        return self.last_event_time + gap - time.monotonic()
+
+    def _consume(self, record):
+        self.last_record_time = record.time
+        self.last_event_time = time.monotonic()
+        return self.records.popleft()
+
+    def write(self, buff):
+        self.log.debug('send: %r', buff)
+        if self.records is None:
+            self.request += buff
+            return
+        records = self.records
+        if not records or records[0].kind != WRITE:
+            raise ConnectionError('unexpected request {!r}'.format(buff))
+        record = self._consume(records[0])
+        if self.replayer.strict and record.payload != bytes(buff):
+            raise ConnectionError('request {!r} does not match recorded {!r}'
+                                  .format(buff, record.payload))
+
+    def _fill(self, size):
+        self._bind()
+        records = self.records
+        while len(self.buffer) < size:
+            if not records or records[0].kind != READ:
+                self.close()
+                raise ConnectionError('connection closed')
+            due_in = self._due_in(records[0])
+            if due_in > 0:
+                time_left = self.time_left()
+                if time_left is not None and time_left < due_in:
+                    time.sleep(max(time_left, 0))
+                    self._on_timeout('read')
+                time.sleep(due_in)
+            self.buffer += self._consume(records[0]).payload
+
+    def wait_readable(self, timeout=None):
+        self._bind()
+        time_left = self.time_left()
+        if time_left is not None:
+            if time_left <= 0:
+                self._on_timeout('select')
+            timeout = time_left if timeout is None else min(timeout, time_left)
+        if self.buffer or not self.records or self.records[0].kind != READ:
+            return True
+        due_in = self._due_in(self.records[0])
+        if timeout is not None and due_in > timeout:
+            time.sleep(timeout)
+            return False
+        if due_in > 0:
+            time.sleep(due_in)
+        return True
+
+    def recv(self, size):
+        if not self.buffer:
+            self._fill(1)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size):
+        self._fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, buff):
+        view = memoryview(buff).cast('B')
+        size = len(view)
+        self._fill(size)
+        view[:] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
@@ -2,25 +2,33 @@ import os
 import time
 import struct
 import logging
+import itertools
 import functools
 
 import numpy
 import scipy.stats
+import scipy.special
 
 import gevent.queue
 import gevent.server
 
+from . import sparse
 from .protocol import (DEFAULT_CTRL_PORT, DEFAULT_STOP_PORT, INET_TEMPLATE,
                        GET_CODE,
                        IdParam, ResultType, CommandCode, DetectorSettings,
+                       DigitalTestMode,
                        DetectorType, TimerType, SpeedType,
                        SynchronizationMode, MasterMode,
                        ExternalCommunicationMode, ExternalSignal,
-                       RunStatus, Dimension, ReadoutFlag,
-                       read_command, read_format, read_i32, read_i64)
+                       RunStatus, Dimension, ReadoutFlag, SPARSE_READOUT,
+                       read_command, read_format, read_i32, read_i64,
+                       encode_rois, decode_rois)
 
 log = logging.getLogger('SLSServer')
 
+# trimbits value which leaves the channel threshold untouched (beam mode)
+TRIM_CENTER = 32
+
 
 def build_default_module(nb, serial_nb):
     return dict(id=nb, serial_nb=serial_nb,
@@ -67,6 +75,23 @@ DEFAULT_DETECTOR_CONFIG = {
         synchronization_mode=SynchronizationMode.NONE,
         master_mode=MasterMode.NO_MASTER,
         readout_flags=ReadoutFlag.NORMAL_READOUT,
+        # mean counts per channel and frame in sparse readout modes
+        sparse_mean_counts=0.05,
+        # readout timing model (s): readout_overhead + readout_cycle_time *
+        # counter bits * (clock_divider + wait_states + signal_length)
+        readout_overhead=20e-6,
+        readout_cycle_time=20e-9,
+        # fastest (lowest) readout speeds which still read out the counters
+        # correctly: faster ones corrupt bits
+        stable_speeds=dict(clock_divider=4, wait_states=8, signal_length=2),
+        # monochromatic beam lighting all channels evenly (None: no beam,
+        # synthetic diffraction frames). Ex: dict(energy=12000 (eV),
+        # flux=1E5 (photons/s/channel), noise=300 (eV), dispersion=200
+        # (eV, of the channel thresholds), seed=0, trim_step=0 (eV the
+        # channel threshold goes down for each trimbit above 32),
+        # dead_channels=[], hot_channels=[] (count 20 times more))
+        beam=None,
+        rois=[],
         modules=[build_default_module(idx, 0xEE0+idx) for idx in range(6)]
     )
 }
@@ -108,9 +133,20 @@ class Acquisition:
                            nb_cycles=max(detector['nb_cycles'], 1),
                            acquisition_time=detector['acquisition_time']*1e-9,
                            dead_time=detector['frame_period']*1e-9,
-                           size=int(self.detector.data_bytes / 4))
+                           size=self.detector.nb_roi_channels,
+                           nb_probes=self.detector.nb_frame_probes,
+                           dynamic_range=detector['dynamic_range'],
+                           continuous=bool(detector['readout_flags'] &
+                                           ReadoutFlag.CONTINOUS_RO),
+                           readout=detector['readout_flags'],
+                           sparse_mean_counts=detector['sparse_mean_counts'],
+                           readout_time=detector.readout_time,
+                           beam_rates=detector.beam_rates(),
+                           bit_errors=detector.readout_errors *
+                           detector.nb_roi_mods)
         self.nb_frames_left = self.params['nb_frames'] * self.params['nb_cycles']
         self.nb_cycles_left = self.params['nb_cycles']
+        self.start_time = self.frame_start = time.time()
 
     @property
     def acquisition_time_left(self):
@@ -134,25 +170,47 @@ class Acquisition:
         nb_frames = self.params['nb_frames']
         acq_time = self.params['acquisition_time']
         dead_time = self.params['dead_time']
+        readout_time = self.params['readout_time']
         size = self.params['size']
+        nb_probes = self.params['nb_probes']
+        continuous = self.params['continuous']
+        sparse_readout = self.params['readout'] & SPARSE_READOUT
+        if continuous:
+            # stream frames until stopped
+            nb_cycles = 1
         start_time = time.time()
         n = 0
         half = size // 2
         ri = lambda x, n=200: numpy.random.randint(x-n, x+n)
         for cycle_index in range(nb_cycles):
             self.nb_frames_left = nb_frames
-            for frame_index in range(nb_frames):
-                is_last = self.nb_frames_left == 1
+            frame_indexes = itertools.count() if continuous else range(nb_frames)
+            for frame_index in frame_indexes:
+                is_last = (not continuous and self.nb_frames_left == 1 and
+                           cycle_index == nb_cycles - 1)
                 self.frame_start = time.time()
-                nap = start_time + (acq_time + dead_time) * n + acq_time - time.time()
-                if nap > 0:
-                    gevent.sleep(nap)
-
-                data = normal(size, scale=ri(100000, 50000), loc=ri(half))
-                data += normal(size, scale=ri(300000, 10000), loc=ri(800))
-                data += normal(size, scale=ri(50000, 5000), loc=ri(5000))
-                data += normal(size, scale=ri(500000, 10000), loc=ri(6500))
-                data += numpy.random.randint(0, 100, size, '<i4') # noise
+                nap = (start_time + (acq_time + readout_time + dead_time) * n +
+                       acq_time + readout_time - time.time())
+                # always yield: when late (fast frame rates, continuous
+                # readout) the stop port must still be served
+                gevent.sleep(max(nap, 0))
+
+                if sparse_readout:
+                    data = self.gen_sparse_frame()
+                elif self.params['beam_rates'] is not None:
+                    data = self.gen_beam_frame()
+                else:
+                    data = normal(size, scale=ri(100000, 50000), loc=ri(half))
+                    data += normal(size, scale=ri(300000, 10000), loc=ri(800))
+                    data += normal(size, scale=ri(50000, 5000), loc=ri(5000))
+                    data += normal(size, scale=ri(500000, 10000), loc=ri(6500))
+                    data += numpy.random.randint(0, 100, size, '<i4') # noise
+                    if nb_probes > 1:
+                        # one sub-frame per probe: pumped ones count more
+                        data = numpy.concatenate(
+                            [data * (10 + probe) // 10
+                             for probe in range(nb_probes)])
+                    data = self.pack(self.corrupt(data))
                 events = [ResultType.OK, data]
                 if is_last:
                     events.append(ResultType.FINISHED)
@@ -160,12 +218,70 @@ class Acquisition:
                 self.detector.log.info('sending frame #%d for cycle #%d',
                                        frame_index, cycle_index)
                 yield events
-                self.nb_frames_left -= 1
+                if not continuous:
+                    self.nb_frames_left -= 1
                 if dead_time:
                     gevent.sleep(dead_time)
                 n += 1
             self.nb_cycles_left -= 1
 
+    def pack(self, data):
+        """counts encoded with the dynamic range"""
+        dynamic_range = self.params['dynamic_range']
+        if dynamic_range in (24, 32):
+            return data
+        # scale counts into the counter range
+        max_value = (1 << dynamic_range) - 1
+        peak = data.max()
+        if peak > max_value:
+            data = data * max_value // peak
+        if dynamic_range == 16:
+            return data.astype('<u2')
+        data = data.astype('<u1')
+        if dynamic_range == 8:
+            return data
+        # 4 bit: two channels per byte, first one in the low nibble
+        return data[0::2] | (data[1::2] << 4)
+
+    def gen_beam_counts(self):
+        """photon counts of each channel under the beam"""
+        expected = self.params['beam_rates'] * self.params['acquisition_time']
+        data = numpy.random.poisson(expected).astype('<i4')
+        nb_probes = self.params['nb_probes']
+        if nb_probes > 1:
+            data = numpy.tile(data, nb_probes)
+        return data
+
+    def gen_beam_frame(self):
+        return self.pack(self.corrupt(self.gen_beam_counts()))
+
+    def corrupt(self, data):
+        """flip random counter bits (readout faster than stable)"""
+        nb_errors = self.params['bit_errors']
+        if nb_errors:
+            bits = min(self.params['dynamic_range'], 24)
+            channels = numpy.random.randint(0, len(data), nb_errors)
+            data[channels] ^= 1 << numpy.random.randint(0, bits, nb_errors)
+        return data
+
+    def gen_sparse_frame(self):
+        """
+        low count frame (or the beam counts) encoded as the readout flags
+        ask (see sls.sparse)
+        """
+        readout = self.params['readout']
+        if self.params['beam_rates'] is not None:
+            data = self.gen_beam_counts()
+        else:
+            size = self.params['size'] * self.params['nb_probes']
+            data = numpy.random.poisson(self.params['sparse_mean_counts'],
+                                        size).astype('<i4')
+        if readout & ReadoutFlag.READ_HITS:
+            words = sparse.encode_hits(data)
+        else:
+            words = sparse.encode_zero_compression(data)
+        return numpy.concatenate(([len(words)], words)).astype('<i4')
+
     def stop(self):
         if self.task is not None:
             self.task.kill()
@@ -225,11 +341,95 @@ class Detector:
     def nb_channels(self):
         return self.config['nb_channels_x'] * self.config['nb_channels_y']
 
+    @property
+    def nb_roi_mods(self):
+        """number of modules read out (only those touched by a ROI)"""
+        rois = self['rois']
+        if not rois:
+            return self.nb_mods
+        mod_channels = self.nb_chips * self.nb_channels
+        modules = set()
+        for roi in rois:
+            first = max(roi['xmin'], 0) // mod_channels
+            last = min(roi['xmax'] // mod_channels, self.nb_mods - 1)
+            modules.update(range(first, last + 1))
+        return len(modules)
+
+    @property
+    def nb_roi_channels(self):
+        """number of channels read out"""
+        return self.nb_roi_mods * self.nb_chips * self.nb_channels
+
+    @property
+    def nb_frame_probes(self):
+        """number of sub-frames per frame (pump-probe mode)"""
+        if self['readout_flags'] & ReadoutFlag.PUMP_PROBE_MODE:
+            return max(self['nb_probes'], 1)
+        return 1
+
     @property
     def data_bytes(self):
         drange = self['dynamic_range']
-        drangeb = 4 if drange == 24 else int(drange/8)
-        return self.nb_mods * self.nb_chips * self.nb_channels * drangeb
+        bits = 32 if drange == 24 else drange
+        return self.nb_frame_probes * self.nb_roi_channels * bits // 8
+
+    @property
+    def readout_time(self):
+        """time (s) to read out a frame with the current speeds"""
+        drange = self['dynamic_range']
+        bits = 24 if drange == 32 else drange
+        speed = (self['clock_divider'] + self['wait_states'] +
+                 self['signal_length'])
+        return self['readout_overhead'] + self['readout_cycle_time'] * bits * speed
+
+    @property
+    def threshold_offsets(self):
+        """threshold offset (eV) of each channel (beam mode)"""
+        beam = self['beam']
+        key = beam.get('dispersion', 0), beam.get('seed', 0)
+        cache = getattr(self, '_threshold_offsets', None)
+        if cache is None or cache[0] != key:
+            nb = self['nb_modules_x_max'] * self.nb_chips * self.nb_channels
+            offsets = numpy.random.RandomState(key[1]).normal(0, key[0], nb)
+            self._threshold_offsets = cache = key, offsets
+        return cache[1]
+
+    @property
+    def trimbits(self):
+        """trimbits of each channel (the 6 low bits of its register)"""
+        registers = [channel for module in self['modules'][:self.nb_mods]
+                     for chip in module['chips'] for channel in chip['channels']]
+        return numpy.array(registers, dtype='<i4') & 0x3F
+
+    def beam_rates(self):
+        """
+        counts/s of each channel read out under the beam (None if there is
+        no beam): the channels count the photons above their threshold
+        """
+        beam = self['beam']
+        if not beam:
+            return None
+        size = self.nb_roi_channels
+        thresholds = self['energy_threshold'] + self.threshold_offsets[:size]
+        trim_step = beam.get('trim_step', 0)
+        if trim_step:
+            trimbits = self.trimbits[:size]
+            thresholds = thresholds + trim_step * (TRIM_CENTER - trimbits)
+        z = (thresholds - beam['energy']) / (numpy.sqrt(2) * beam['noise'])
+        rates = beam['flux'] * 0.5 * scipy.special.erfc(z)
+        dead = [ch for ch in beam.get('dead_channels', ()) if ch < size]
+        hot = [ch for ch in beam.get('hot_channels', ()) if ch < size]
+        rates[hot] *= 20
+        rates[dead] = 0
+        return rates
+
+    @property
+    def readout_errors(self):
+        """bit errors per module and frame with the current speeds"""
+        stable = self['stable_speeds']
+        deficit = sum(max(value - self[name], 0)
+                      for name, value in stable.items())
+        return deficit * self.nb_chips
 
     def handle_ctrl(self, sock, addr):
         self.log.debug('connected to control %r', addr)
@@ -315,6 +515,20 @@ class Detector:
 
         return struct.pack('<q', value)
 
+    def digital_test(self, conn, addr):
+        mode = DigitalTestMode(read_i32(conn))
+        if mode in (DigitalTestMode.CHIP_TEST,
+                    DigitalTestMode.DIGITAL_BIT_TEST):
+            mod_nb = read_i32(conn)
+            # the reference pattern goes through the readout chain
+            result = self.readout_errors
+            self.log.info('digital test %s[%d] = %d', mode.name, mod_nb,
+                          result)
+        else:
+            result = 0
+            self.log.info('digital test %s = %d', mode.name, result)
+        return struct.pack('<i', result)
+
     def get_module(self, conn, addr):
         mod_nb = read_i32(conn)
         self.log.info('get module[%d]', mod_nb)
@@ -346,11 +560,12 @@ class Detector:
         # the size of the pointer in the struct (because the detector is a 32bits
         # lnux)
         dacs0, adcs0, chip0, channel0  = read_format(conn, '<iiii')
-        mod['gain'], mod['offset'] = read_format(conn, '<dd')
         mod['dacs'] = read_format(conn, '<{}i'.format(nb_dacs)) if nb_dacs else []
         mod['adcs'] = read_format(conn, '<{}i'.format(nb_adcs)) if nb_adcs else []
         chip_registers = read_format(conn, '<{}i'.format(nb_chips))
         channels = read_format(conn, '<{}i'.format(nb_channels))
+        # gain and offset come last (same order as the client sends them)
+        mod['gain'], mod['offset'] = read_format(conn, '<dd')
         channels_per_chip = nb_channels // nb_chips
         mod['chips'] = chips = []
         for idx in range(nb_chips):
@@ -499,6 +714,16 @@ class Detector:
                       'get' if value == GET_CODE else 'set', index, result)
         return struct.pack('<i', result)
 
+    def set_roi(self, conn, addr):
+        nb_rois = read_i32(conn)
+        if nb_rois != GET_CODE:
+            raw_data = read_format(conn, '<{}i'.format(4*nb_rois)) if nb_rois else ()
+            self['rois'] = decode_rois(raw_data)
+        result = self['rois']
+        self.log.info('%s rois = %r',
+                      'get' if nb_rois == GET_CODE else 'set', result)
+        return struct.pack('<i', len(result)) + encode_rois(result)
+
     def speed(self, conn, addr):
         speed = SpeedType(read_i32(conn))
         name = speed.name.lower()
@@ -522,50 +747,128 @@ class Detector:
     def time_left(self, conn, addr):
         timer_type = TimerType(read_i32(conn))
         name = timer_type.name.lower()
-        if self._run_status == RunStatus.IDLE:
+        acq = self.acquisition
+        running = self._run_status == RunStatus.RUNNING and acq is not None
+        if timer_type == TimerType.ACTUAL_TIME:
+            result = int((time.time() - self.start_time) * 1E9)
+        elif timer_type == TimerType.MEASUREMENT_TIME:
+            result = int((time.time() - acq.start_time) * 1E9) if running else 0
+        elif timer_type == TimerType.PROGRESS:
+            result = 0
+            if running and not acq.params['continuous']:
+                total = acq.params['nb_frames'] * acq.params['nb_cycles']
+                done = total - acq.nb_frames_left - \
+                    (acq.nb_cycles_left - 1) * acq.params['nb_frames']
+                result = int(100 * done / total)
+        elif not running:
+            result = self[name]
+        elif timer_type == TimerType.ACQUISITION_TIME:
+            result = int(acq.acquisition_time_left * 1E9)
+        elif timer_type == TimerType.NB_FRAMES:
+            result = acq.nb_frames_left
+        elif timer_type == TimerType.NB_CYCLES:
+            result = acq.nb_cycles_left
+        else:
             result = self[name]
-        elif self._run_status == RunStatus.RUNNING:
-            acq = self.acquisition
-            if timer_type == TimerType.ACQUISITION_TIME:
-                result = int(acq.acquisition_time_left * 1E9)
-            elif timer_type == TimerType.NB_FRAMES:
-                result = acq.nb_frames_left
-            elif timer_type == TimerType.NB_CYCLES:
-                result = acq.nb_cycles_left
         self.log.info('get time left %r = %r', timer_type.name, result)
         return struct.pack('<q', result)
 
+    def _new_acquisition(self):
+        self._run_status = RunStatus.RUNNING
+        acquisition = self.acquisition = Acquisition(self)
+        acquisition.prepare()
+        acquisition.start()
+        return acquisition
+
+    def _end_acquisition(self, acquisition):
+        acquisition.stop()
+        if self.acquisition is acquisition:
+            self.acquisition = None
+            self._run_status = RunStatus.IDLE
+        self.log.info('finished acquisition')
+
+    def _send_frames(self, conn, acquisition, nb_frames=None):
+        """
+        Send (at most nb_frames) frames of the acquisition.
+        Returns True if the end of acquisition was sent
+        """
+        finished = False
+        for frames in itertools.islice(acquisition.frames, nb_frames):
+            if frames is None:
+                # keep the end mark for the next read
+                acquisition.frames.put(None)
+                break
+            events = []
+            for frame in frames:
+                if isinstance(frame, ResultType):
+                    event = struct.pack('<i', frame)
+                    finished = finished or frame == ResultType.FINISHED
+                elif isinstance(frame, bytes):
+                    event = frame
+                else:
+                    event = frame.tobytes()
+                events.append(event)
+            try:
+                conn.write(b''.join(events))
+            except BrokenPipeError:
+                pass
+        return finished
+
     def start_and_read_all(self, conn, addr):
         self.log.info('start acquisition')
-        self._run_status = RunStatus.RUNNING
-        self.acquisition = Acquisition(self)
-        self.acquisition.prepare()
-        self.acquisition.start()
+        # the client may start the next acquisition as soon as it gets the
+        # last frame, before this handler finishes: only touch our own
+        acquisition = self._new_acquisition()
         try:
-            for frames in self.acquisition.frames:
-                if frames is None:
-                    break
-                events = []
-                for frame in frames:
-                    if isinstance(frame, ResultType):
-                        event = struct.pack('<i', frame)
-                    elif isinstance(frame, bytes):
-                        event = frame
-                    else:
-                        event = frame.tobytes()
-                    events.append(event)
-                try:
-                    conn.write(b''.join(events))
-                except BrokenPipeError:
-                    pass
+            if self['readout_flags'] & ReadoutFlag.STORE_IN_RAM:
+                # data is only sent after the end of the acquisition
+                acquisition.task.join()
+            self._send_frames(conn, acquisition)
         finally:
-            self.acquisition.stop()
-            self.acquisition = None
-            self._run_status = RunStatus.IDLE
-            self.log.info('finished acquisition')
+            self._end_acquisition(acquisition)
             conn.flush()
             conn.close()
 
+    def start_acquisition(self, conn, addr):
+        self.log.info('start acquisition (data kept in memory)')
+        acquisition = self._new_acquisition()
+
+        def finished(task):
+            if self.acquisition is acquisition:
+                self._run_status = RunStatus.FINISHED
+        acquisition.task.link(finished)
+        return b''
+
+    def _send_end(self, conn, message):
+        conn.write(struct.pack('<i', ResultType.FINISHED) + message)
+
+    def read_all(self, conn, addr):
+        acquisition = self.acquisition
+        self.log.info('read all')
+        if acquisition is None:
+            self._send_end(conn, b'no data in memory')
+            return
+        try:
+            if not self._send_frames(conn, acquisition):
+                # stopped: the frames acquired so far were sent
+                self._send_end(conn, b'acquisition stopped')
+        finally:
+            self._end_acquisition(acquisition)
+            conn.flush()
+
+    def read_frame(self, conn, addr):
+        acquisition = self.acquisition
+        self.log.info('read frame')
+        if acquisition is None:
+            self._send_end(conn, b'no data in memory')
+        elif acquisition.frames.peek() is None:
+            # acquisition stopped and all its frames were read
+            self._send_end(conn, b'acquisition stopped')
+            self._end_acquisition(acquisition)
+        elif self._send_frames(conn, acquisition, 1):
+            self._end_acquisition(acquisition)
+        conn.flush()
+
     def start(self):
         ctrl_port = self['ctrl_port']
         stop_port = self['stop_port']
@@ -0,0 +1,123 @@
+"""
+Sparse frame encodings (READ_HITS and ZERO_COMPRESSION readout flags).
+
+In these readout modes a frame has a variable length. After the frame
+result code the detector sends the number of 32 bit words of the frame
+followed by the words:
+
+* READ_HITS: the indexes of the channels which counted at least once
+* ZERO_COMPRESSION: a word >= 0 is the counts of the next channel, a
+  negative word -n skips n channels with no counts
+
+Decoded frames are SparseFrame objects: (channel index, counts) arrays
+which can be densified on demand, optionally into a preallocated frame.
+"""
+
+import numpy
+
+WORD = numpy.dtype('<i4')
+
+
+class SparseFrame:
+    """
+    Frame given as the channels with counts.
+
+    * channels: channel indexes (sorted)
+    * counts: counts of each channel (1 for READ_HITS: only hits are known)
+    * nb_channels: number of channels of the dense frame
+    * dtype: dtype of the dense frame
+    * payload_bytes: number of bytes the frame took on the wire
+    """
+
+    __slots__ = ('channels', 'counts', 'nb_channels', 'dtype',
+                 'payload_bytes')
+
+    def __init__(self, channels, counts, nb_channels, dtype=WORD,
+                 payload_bytes=0):
+        self.channels = channels
+        self.counts = counts
+        self.nb_channels = nb_channels
+        self.dtype = numpy.dtype(dtype)
+        self.payload_bytes = payload_bytes
+
+    def __repr__(self):
+        return 'SparseFrame(nb_hits={}, nb_channels={})'.format(
+            self.nb_hits, self.nb_channels)
+
+    def __len__(self):
+        return self.nb_channels
+
+    @property
+    def nb_hits(self):
+        return len(self.channels)
+
+    @property
+    def nbytes(self):
+        """size of the dense frame"""
+        return self.nb_channels * self.dtype.itemsize
+
+    def to_dense(self, out=None):
+        """
+        Dense frame. out: optional writable buffer (ex: numpy array) of at
+        least nbytes to write the frame into. Returns the frame (a view on
+        out if given)
+        """
+        if out is None:
+            frame = numpy.zeros(self.nb_channels, dtype=self.dtype)
+        else:
+            data = memoryview(out).cast('B')[:self.nbytes]
+            if len(data) != self.nbytes:
+                raise ValueError('frame buffer too small: need {} bytes but '
+                                 'got {} bytes'.format(self.nbytes, len(data)))
+            frame = numpy.frombuffer(data, dtype=self.dtype)
+            frame[:] = 0
+        frame[self.channels] = self.counts
+        return frame
+
+    def __array__(self, dtype=None, copy=None):
+        frame = self.to_dense()
+        return frame if dtype is None else frame.astype(dtype)
+
+
+def decode_hits(words, nb_channels, dtype=WORD):
+    channels = numpy.asarray(words, dtype=WORD)
+    if len(channels) and (channels.min() < 0 or
+                          channels.max() >= nb_channels):
+        raise ValueError('hit channel out of range')
+    counts = numpy.ones(len(channels), dtype=dtype)
+    return SparseFrame(channels, counts, nb_channels, dtype=dtype,
+                       payload_bytes=WORD.itemsize * (len(channels) + 1))
+
+
+def decode_zero_compression(words, nb_channels, dtype=WORD):
+    words = numpy.asarray(words, dtype=WORD)
+    values = words >= 0
+    # each word moves the channel position: one channel for a value, n
+    # channels for a skip of n
+    steps = numpy.where(values, 1, -words.astype('<i8'))
+    ends = numpy.cumsum(steps)
+    if len(ends) and ends[-1] > nb_channels:
+        raise ValueError('zero compressed frame longer than {} channels'
+                         .format(nb_channels))
+    channels = (ends[values] - 1).astype(WORD)
+    counts = words[values].astype(dtype)
+    return SparseFrame(channels, counts, nb_channels, dtype=dtype,
+                       payload_bytes=WORD.itemsize * (len(words) + 1))
+
+
+def encode_hits(frame):
+    return numpy.flatnonzero(frame).astype(WORD)
+
+
+def encode_zero_compression(frame):
+    frame = numpy.asarray(frame)
+    channels = numpy.flatnonzero(frame)
+    # zero channels before each channel with counts and after the last one
+    gaps = numpy.diff(channels, prepend=-1) - 1
+    trailing = len(frame) - (channels[-1] + 1 if len(channels) else 0)
+    words = numpy.empty(2 * len(channels) + 1, dtype=WORD)
+    words[0:-1:2] = -gaps
+    words[1:-1:2] = frame[channels]
+    words[-1] = -trailing
+    # drop empty skips (channels with counts are never 0)
+    return words[words != 0]
@@ -0,0 +1,246 @@
+"""
+Energy threshold scans and S-curve fitting.
+
+A threshold scan acquires a flat monochromatic illumination at each
+energy threshold. Each channel counts the photons above its own effective
+threshold so the counts of a channel along the scan follow an S-curve:
+
+    counts(E) = amplitude / 2 * erfc((E - position) / (sqrt(2) * width))
+
+position is the energy the channel threshold is really at and width its
+noise. The fit runs on all channels at once (vectorized Gauss-Newton with
+Levenberg-Marquardt damping) so a full detector fits in well under a
+second:
+
+    thresholds = numpy.arange(6000, 18000, 250)
+    counts = scan(mythen, thresholds, exposure_time=0.5)
+    curves = fit_scurves(thresholds, counts)
+    print(curves.dispersion, curves.noise)
+    for module in curves.module_stats():
+        print(module)
+"""
+
+import logging
+
+import numpy
+
+from .protocol import NB_CHANNELS_PER_MODULE
+
+log = logging.getLogger('SLSThreshold')
+
+SQRT2 = numpy.sqrt(2)
+SQRT_2PI = numpy.sqrt(2 * numpy.pi)
+
+# Abramowitz and Stegun 7.1.26 (absolute error < 1.5E-7)
+_ERFC_P = 0.3275911
+_ERFC_A = (0.254829592, -0.284496736, 1.421413741, -1.453152027,
+           1.061405429)
+
+
+def erfc(x):
+    """complementary error function (vectorized, numpy only)"""
+    x = numpy.asarray(x, dtype=float)
+    ax = numpy.abs(x)
+    t = 1 / (1 + _ERFC_P * ax)
+    poly = numpy.zeros_like(t)
+    for a in reversed(_ERFC_A):
+        poly = (poly + a) * t
+    result = poly * numpy.exp(-ax * ax)
+    return numpy.where(x < 0, 2 - result, result)
+
+
+def scurve(thresholds, position, width, amplitude):
+    """S-curve counts at the thresholds (broadcast with the parameters)"""
+    z = (numpy.asarray(thresholds) - position) / (SQRT2 * width)
+    return amplitude * 0.5 * erfc(z)
+
+
+def acquire_counts(detector, exposure_time=1.0, nb_frames=1, out=None,
+                   **opts):
+    """
+    Acquire nb_frames and sum them into out (a new int64 array if not
+    given). Frames are read into a single buffer. Returns out
+    """
+    with detector.acquisition(progress_interval=None, nb_buffers=1,
+                              exposure_time=exposure_time,
+                              nb_frames=nb_frames, nb_cycles=1,
+                              **opts) as acq:
+        for event in acq:
+            if event.type != 'frame':
+                continue
+            if out is None:
+                out = numpy.zeros(len(event.data), dtype='<i8')
+            numpy.add(out, event.data, out=out)
+    return out
+
+
+def scan(detector, thresholds, exposure_time=1.0, nb_frames=1, **opts):
+    """
+    Acquire nb_frames at each energy threshold (eV, all modules).
+    Returns the (len(thresholds), nb_channels) int64 counts summed over the
+    frames of each threshold. Successive points only re-arm the threshold
+    (see AcquisitionPlan). The energy threshold is restored at the end
+    """
+    previous = detector.energy_threshold
+    counts = None
+    try:
+        for index, threshold in enumerate(thresholds):
+            point = acquire_counts(detector, exposure_time, nb_frames,
+                                   energy_threshold=int(threshold), **opts)
+            if counts is None:
+                counts = numpy.zeros((len(thresholds), len(point)),
+                                     dtype='<i8')
+            counts[index] = point
+            log.info('threshold %s eV: %d counts', threshold, point.sum())
+    finally:
+        detector.energy_threshold = previous
+    return counts
+
+
+class SCurves:
+    """
+    Per channel S-curve fit results (arrays of nb_channels):
+
+    * position: threshold (eV) where the channel counts half the photons
+    * width: noise (eV) of the channel
+    * amplitude: counts well below the threshold
+    * chi2: reduced chi square of the fit (Poisson weights)
+    * valid: channels with a converged fit inside the scanned range
+    """
+
+    def __init__(self, position, width, amplitude, chi2, valid):
+        self.position = position
+        self.width = width
+        self.amplitude = amplitude
+        self.chi2 = chi2
+        self.valid = valid
+
+    def __repr__(self):
+        return ('{}(nb_channels={}, nb_valid={}, dispersion={:.1f}, '
+                'noise={:.1f})'.format(type(self).__name__,
+                                       len(self.position), self.nb_valid,
+                                       self.dispersion, self.noise))
+
+    @property
+    def nb_valid(self):
+        return int(self.valid.sum())
+
+    @property
+    def dispersion(self):
+        """threshold dispersion (eV): std of the valid channel positions"""
+        return float(numpy.std(self.position[self.valid]))
+
+    @property
+    def noise(self):
+        """median noise (eV) of the valid channels"""
+        return float(numpy.median(self.width[self.valid]))
+
+    def module_stats(self, nb_channels=NB_CHANNELS_PER_MODULE):
+        """per module dict(module, nb_valid, threshold, dispersion, noise)"""
+        stats = []
+        nb_modules = len(self.position) // nb_channels
+        for module in range(nb_modules):
+            channels = slice(module * nb_channels, (module + 1) * nb_channels)
+            valid = self.valid[channels]
+            position = self.position[channels][valid]
+            width = self.width[channels][valid]
+            stats.append(dict(
+                module=module, nb_valid=int(valid.sum()),
+                threshold=float(position.mean()) if len(position) else None,
+                dispersion=float(position.std()) if len(position) else None,
+                noise=float(numpy.median(width)) if len(width) else None))
+        return stats
+
+
+def _initial_guess(thresholds, counts):
+    # the differential spectrum (-dN/dE) of an S-curve is a gaussian: its
+    # moments give position and width
+    steps = numpy.diff(thresholds)
+    weights = numpy.clip(-numpy.diff(counts, axis=0), 0, None)
+    middles = (thresholds[1:] + thresholds[:-1]) / 2
+    total = weights.sum(axis=0)
+    safe = numpy.where(total > 0, total, 1)
+    position = (weights * middles[:, None]).sum(axis=0) / safe
+    variance = (weights * (middles[:, None] - position)**2).sum(axis=0) / safe
+    width = numpy.maximum(numpy.sqrt(variance), steps.min() / 2)
+    amplitude = counts.max(axis=0)
+    return position, width, amplitude, total > 0
+
+
+def fit_scurves(thresholds, counts, max_iterations=50, tolerance=1E-4):
+    """
+    Fit the S-curve of every channel of a threshold scan.
+
+    thresholds: (n,) scanned energies (eV)
+    counts: (n, nb_channels) counts (see scan())
+    max_iterations, tolerance: stop when the largest relative parameter
+                               change is below tolerance
+
+    Returns SCurves
+    """
+    thresholds = numpy.asarray(thresholds, dtype=float)
+    counts = numpy.asarray(counts, dtype=float)
+    order = numpy.argsort(thresholds)
+    thresholds, counts = thresholds[order], counts[order]
+    nb_points, nb_channels = counts.shape
+    if nb_points < 4:
+        raise ValueError('need at least 4 thresholds to fit S-curves')
+    position, width, amplitude, fittable = _initial_guess(thresholds, counts)
+    chi2 = numpy.full(nb_channels, numpy.inf)
+    converged = numpy.zeros(nb_channels, dtype=bool)
+
+    # fit only the channels with a falling edge
+    index = numpy.flatnonzero(fittable)
+    e = thresholds[:, None]
+    y = counts[:, index]
+    weights = 1 / numpy.maximum(y, 1)
+    params = numpy.stack((position[index], width[index], amplitude[index]),
+                         axis=1)
+    damping = numpy.full(len(index), 1E-3)
+    cost = (weights * (y - scurve(e, *params.T))**2).sum(axis=0)
+    active = numpy.ones(len(index), dtype=bool)
+    eye = numpy.eye(3)
+    for iteration in range(max_iterations):
+        # converged channels drop out: later iterations get cheaper
+        act = numpy.flatnonzero(active)
+        if not len(act):
+            break
+        p, ya, wa = params[act], y[:, act], weights[:, act]
+        z = (e - p[:, 0]) / p[:, 1]
+        gauss = numpy.exp(-0.5 * z * z) / SQRT_2PI
+        half_erfc = 0.5 * erfc(z / SQRT2)
+        # d model / d (position, width, amplitude)
+        jac = numpy.stack((p[:, 2] * gauss / p[:, 1],
+                           p[:, 2] * gauss * z / p[:, 1],
+                           half_erfc), axis=-1)
+        wjac = jac * wa[:, :, None]
+        normal = numpy.einsum('ncp,ncq->cpq', wjac, jac)
+        gradient = numpy.einsum('ncp,nc->cp', wjac, ya - p[:, 2] * half_erfc)
+        diagonal = normal[:, [0, 1, 2], [0, 1, 2]]
+        normal += (damping[act, None] * diagonal + 1E-12)[:, :, None] * eye
+        step = numpy.linalg.solve(normal, gradient[:, :, None])[:, :, 0]
+        trial = p + step
+        trial[:, 1] = numpy.abs(trial[:, 1])
+        trial_cost = (wa * (ya - scurve(e, *trial.T))**2).sum(axis=0)
+        # accept the improved channels, damp more the others
+        better = trial_cost < cost[act]
+        accept, reject = act[better], act[~better]
+        params[accept] = trial[better]
+        cost[accept] = trial_cost[better]
+        damping[accept] /= 10
+        damping[reject] *= 10
+        relative = numpy.abs(step[better]) / numpy.maximum(
+            numpy.abs(p[better]), 1E-9)
+        active[accept[relative.max(axis=1) < tolerance]] = False
+        # stuck channels: no progress possible anymore
+        active[reject[damping[reject] > 1E10]] = False
+    log.debug('S-curve fit: %d iterations, %d channels not converged',
+              iteration + 1, active.sum())
+
+    position[index], width[index], amplitude[index] = params.T
+    chi2[index] = cost / max(nb_points - 3, 1)
+    converged[index] = ~active
+    valid = (converged & numpy.isfinite(position) & (width > 0) &
+             (amplitude > 0) & (position >= thresholds[0]) &
+             (position <= thresholds[-1]))
+    return SCurves(position, width, amplitude, chi2, valid)
@@ -0,0 +1,155 @@
+"""
+Acquisition timeline tracing in Chrome trace format.
+
+Tracing is off by default. When on, instrumented code records spans
+(connect, commands, acquisition start, frame receive, decode, consumer,
+progress poll, lima frame handling) into a preallocated ring buffer, so
+tracing long acquisitions doesn't allocate memory per span. When the ring
+is full the oldest spans are overwritten.
+
+    from sls import trace
+
+    tracer = trace.start()
+    ... acquire ...
+    trace.stop()
+    tracer.dump('acquisition.json')
+
+Open the file in chrome://tracing or https://ui.perfetto.dev
+"""
+
+import os
+import json
+import time
+import threading
+import itertools
+import contextlib
+
+import numpy
+
+DEFAULT_CAPACITY = 1 << 20
+
+# thread id of the spans: the native (OS) one if available (python >= 3.8)
+if hasattr(threading, 'get_native_id'):
+    _thread_id, _THREAD_ID_ATTR = threading.get_native_id, 'native_id'
+else:
+    _thread_id, _THREAD_ID_ATTR = threading.get_ident, 'ident'
+
+# the active tracer (None means tracing is off). Instrumented code must
+# check it before measuring
+tracer = None
+
+
+def start(capacity=DEFAULT_CAPACITY):
+    """Start tracing into a new Tracer. Returns it"""
+    global tracer
+    tracer = Tracer(capacity)
+    return tracer
+
+
+def stop():
+    """Stop tracing. Returns the tracer which was active (if any)"""
+    global tracer
+    result, tracer = tracer, None
+    return result
+
+
+class Tracer:
+    """
+    Ring buffer of spans. Each span has a name, start and end time (from
+    time.perf_counter()), the thread id (native if available) and an
+    optional integer
+    argument (ex: frame number)
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.starts = numpy.zeros(capacity, dtype='<f8')
+        self.ends = numpy.zeros(capacity, dtype='<f8')
+        self.names = numpy.zeros(capacity, dtype='<u2')
+        self.threads = numpy.zeros(capacity, dtype='<u8')
+        self.args = numpy.full(capacity, -1, dtype='<i8')
+        self.name_ids = {}
+        self.name_list = []
+        self._names_lock = threading.Lock()
+        self.nb_spans = 0
+        self._index = itertools.count()
+        # reference to convert perf_counter into wall clock time
+        self.perf_origin = time.perf_counter()
+        self.time_origin = time.time()
+
+    def _name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            with self._names_lock:
+                name_id = self.name_ids.get(name)
+                if name_id is None:
+                    name_id = len(self.name_list)
+                    self.name_list.append(name)
+                    self.name_ids[name] = name_id
+            return name_id
+
+    def add(self, name, start, end, arg=-1):
+        """Record a span. start and end come from time.perf_counter()"""
+        # next() on itertools.count is atomic: threads never share a slot
+        index = next(self._index)
+        i = index % self.capacity
+        self.names[i] = self._name_id(name)
+        self.starts[i] = start
+        self.ends[i] = end
+        self.threads[i] = _thread_id()
+        self.args[i] = arg
+        self.nb_spans = index + 1
+
+    @contextlib.contextmanager
+    def span(self, name, arg=-1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), arg)
+
+    @property
+    def nb_dropped(self):
+        """number of spans overwritten because the ring was full"""
+        return max(self.nb_spans - self.capacity, 0)
+
+    def clear(self):
+        self.nb_spans = 0
+        self._index = itertools.count()
+
+    def spans(self):
+        """Recorded spans sorted by start time as a list of
+        (name, start, end, thread id, arg)"""
+        n = min(self.nb_spans, self.capacity)
+        order = numpy.argsort(self.starts[:n], kind='stable')
+        names = self.name_list
+        return [(names[self.names[i]], self.starts[i], self.ends[i],
+                 int(self.threads[i]), int(self.args[i])) for i in order]
+
+    def to_chrome(self):
+        """Spans as a Chrome trace format dict"""
+        pid = os.getpid()
+        origin = self.perf_origin
+        events, thread_ids = [], set()
+        for name, start, end, tid, arg in self.spans():
+            event = dict(name=name, ph='X', pid=pid, tid=tid,
+                         ts=(start - origin) * 1E6, dur=(end - start) * 1E6)
+            if arg >= 0:
+                event['args'] = dict(arg=arg)
+            events.append(event)
+            thread_ids.add(tid)
+        thread_names = {getattr(thread, _THREAD_ID_ATTR): thread.name
+                        for thread in threading.enumerate()}
+        for tid in sorted(thread_ids):
+            name = thread_names.get(tid, 'thread-{}'.format(tid))
+            events.append(dict(name='thread_name', ph='M', pid=pid, tid=tid,
+                               args=dict(name=name)))
+        return dict(traceEvents=events, displayTimeUnit='ms',
+                    otherData=dict(time_origin=self.time_origin,
+                                   nb_dropped=self.nb_dropped))
+
+    def dump(self, filename):
+        """Write spans in Chrome trace format JSON"""
+        with open(filename, 'w') as fobj:
+            json.dump(self.to_chrome(), fobj)
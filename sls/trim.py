@@ -0,0 +1,201 @@
+"""
+Software trimming of the channel thresholds.
+
+Each channel register holds 6 trimbits (see
+settings._load_module_settings) which fine tune the threshold of the
+channel. Under a flat monochromatic beam, with the energy threshold
+inside the S-curve (ex: at the beam energy), channels with a lower
+threshold count more. Trimming looks for the trimbits which make every
+channel count the same.
+
+All channels are trimmed in parallel by successive approximation: from
+the most significant trimbit down, each bit is set on all channels, one
+acquisition is taken and the bit is kept on the channels which don't
+overshoot the target counts. Trimming takes 6 + 4 acquisitions whatever
+the number of channels (the on-detector EXECUTE_TRIMMING is not used):
+
+    result = trim(mythen, energy_threshold=12000, exposure_time=1)
+    print(result)
+    settings = sls.settings.load('settings.yml')
+    update_settings(settings, result.modules)
+    sls.settings.save(settings, 'settings.yml')
+"""
+
+import copy
+import logging
+
+import numpy
+
+from . import protocol
+from .client import Pipeline
+from .protocol import DetectorSettings
+from .threshold import acquire_counts
+
+log = logging.getLogger('SLSTrim')
+
+TRIM_BITS = 6
+TRIM_MASK = (1 << TRIM_BITS) - 1
+
+
+def module_from_info(info):
+    """module dict (settings/set_module format) from a get_module info"""
+    nb_chips = info['nb_chips']
+    per_chip = info['nb_channels'] // nb_chips
+    channels = list(info['channel_registers'])
+    chips = [dict(register=register,
+                  channels=channels[idx * per_chip:(idx + 1) * per_chip])
+             for idx, register in enumerate(info['chip_registers'])]
+    return dict(module_nb=info['module_nb'],
+                serial_number=info['serial_nb'],
+                reg=DetectorSettings(info['register']).name.lower(),
+                dacs=list(info['dacs'] or []), adcs=list(info['adcs'] or []),
+                chips=chips, gain=info['gain'], offset=info['offset'])
+
+
+def read_modules(detector, nb_modules=None):
+    """module dicts of the detector read in one pipelined exchange"""
+    if nb_modules is None:
+        nb_modules = detector.get_nb_modules()
+    pipe = Pipeline(detector)
+    for mod_nb in range(nb_modules):
+        pipe.ctrl(protocol.get_module, mod_nb)
+    return [module_from_info(info) for _, info in pipe.execute()]
+
+
+def upload_modules(detector, modules):
+    """set_module all modules in one pipelined exchange"""
+    pipe = Pipeline(detector)
+    for module in modules:
+        pipe.ctrl(protocol.set_module, module)
+    pipe.execute()
+
+
+def get_trimbits(modules):
+    """trimbits of all channels (in frame order)"""
+    registers = [channel for module in modules
+                 for chip in module['chips'] for channel in chip['channels']]
+    return numpy.array(registers, dtype='<i8') & TRIM_MASK
+
+
+def set_trimbits(modules, trimbits):
+    """write the trimbits into the channel registers (other flags kept)"""
+    trimbits = iter(int(trim) for trim in trimbits)
+    for module in modules:
+        for chip in module['chips']:
+            chip['channels'] = [(register & ~TRIM_MASK) | next(trimbits)
+                                for register in chip['channels']]
+
+
+class TrimResult:
+    """
+    * trimbits: trimbits found for each channel
+    * counts: counts of each channel with the trimbits
+    * initial_counts: counts of each channel with mid range trimbits
+    * target: counts every channel was trimmed to
+    * saturated: channels which would need trimbits out of range
+    * modules: trimmed module dicts (as uploaded)
+    """
+
+    def __init__(self, trimbits, counts, initial_counts, target, saturated,
+                 modules):
+        self.trimbits = trimbits
+        self.counts = counts
+        self.initial_counts = initial_counts
+        self.target = target
+        self.saturated = saturated
+        self.modules = modules
+
+    def __repr__(self):
+        return ('{}(target={:.1f}, spread={:.4f}, initial_spread={:.4f}, '
+                'nb_saturated={})'.format(
+                    type(self).__name__, self.target, self.spread,
+                    self.initial_spread, int(self.saturated.sum())))
+
+    @property
+    def spread(self):
+        """relative counts dispersion (std / target) after trimming"""
+        return float(numpy.std(self.counts) / self.target)
+
+    @property
+    def initial_spread(self):
+        return float(numpy.std(self.initial_counts) / self.target)
+
+
+def trim(detector, energy_threshold, exposure_time=1.0, nb_frames=1,
+         modules=None, target=None, **opts):
+    """
+    Trim all channels (see module doc) and leave the detector trimmed.
+
+    energy_threshold: threshold (eV) to trim at
+    modules: module dicts to trim (default: read from the detector)
+    target: counts for every channel (default: median counts with mid
+            range trimbits)
+    opts: extra acquisition options
+
+    The energy threshold is restored at the end. On error the modules are
+    restored as well. Returns TrimResult
+    """
+    if modules is None:
+        modules = read_modules(detector)
+    previous = copy.deepcopy(modules)
+    modules = copy.deepcopy(modules)
+    nb_channels = len(get_trimbits(modules))
+    previous_threshold = detector.energy_threshold
+
+    def measure(trimbits):
+        set_trimbits(modules, trimbits)
+        upload_modules(detector, modules)
+        counts = acquire_counts(detector, exposure_time, nb_frames,
+                                energy_threshold=int(energy_threshold),
+                                **opts)
+        return counts[:nb_channels]
+
+    try:
+        low = measure(numpy.zeros(nb_channels, dtype=int))
+        high = measure(numpy.full(nb_channels, TRIM_MASK))
+        # do counts grow with the trimbits (threshold going down)?
+        increasing = numpy.median(high) >= numpy.median(low)
+        initial = measure(numpy.full(nb_channels, 1 << (TRIM_BITS - 1)))
+        if target is None:
+            target = float(numpy.median(initial))
+        trimbits = numpy.zeros(nb_channels, dtype=int)
+        if not increasing:
+            low, high = high, low
+        for bit in reversed(range(TRIM_BITS)):
+            trial = trimbits | (1 << bit)
+            counts = measure(trial)
+            keep = counts <= target if increasing else counts >= target
+            trimbits = numpy.where(keep, trial, trimbits)
+            log.info('trimbit %d kept on %d channels', bit, keep.sum())
+        counts = measure(trimbits)
+    except BaseException:
+        upload_modules(detector, previous)
+        raise
+    finally:
+        detector.energy_threshold = previous_threshold
+    # channels the trimbits range can't bring to the target
+    saturated = (low > target) | (high < target)
+    result = TrimResult(trimbits, counts, initial, target, saturated, modules)
+    log.info('trimmed %r', result)
+    return result
+
+
+def update_settings(settings, modules, setting=None):
+    """
+    Write the (trimmed) modules into a settings structure (see
+    sls.settings: {'calibration': {setting: {'modules': [...]}}}) replacing
+    the ones with the same module number. setting defaults to the 'reg'
+    of each module. Returns settings
+    """
+    calibration = settings.setdefault('calibration', {})
+    for module in modules:
+        name = setting or module['reg']
+        stored = calibration.setdefault(name, {}).setdefault('modules', [])
+        module = dict(module, reg=name)
+        for index, old in enumerate(stored):
+            if old.get('module_nb') == module['module_nb']:
+                stored[index] = dict(old, **module)
+                break
+        else:
+            stored.append(module)
+    return settings
@@ -0,0 +1,191 @@
+"""
+Readout speed auto-tuning.
+
+Finds the fastest readout speeds (clock divider, wait states, signal
+length and optionally the time over threshold ones) which still read out
+the data correctly, and records them as a configuration profile:
+
+    result = tune(mythen)
+    print(result.best)
+    save_profile(result.best, 'mythen.yml')   # see config.load_mythen
+
+Lower values are faster. A candidate is valid when the chip test (the
+detector shifts a reference pattern through the chips and reads it back,
+see DigitalTestMode.CHIP_TEST) reports no bit errors on any module,
+`repeats` times in a row. Each parameter is bisected in turn between its
+lower bound and its current value, assuming the readout is valid at the
+starting speeds and gets worse as a parameter decreases. The bisected
+speeds (valid by construction) are the best ones. Their frame rate and
+the starting one are then measured with short acquisitions, averaged
+over a few runs, as a check: a warning is logged if the gain does not
+show.
+"""
+
+import os
+import logging
+import collections
+
+from . import perf, protocol
+from .client import Pipeline
+from .protocol import SLSError, SpeedType, DigitalTestMode
+
+log = logging.getLogger('SLSTune')
+
+# tunable speed: name -> (SpeedType, configuration file key, lowest value)
+SPEEDS = collections.OrderedDict((
+    ('clock_divider', (SpeedType.CLOCK_DIVIDER, 'clkdivider', 1)),
+    ('wait_states', (SpeedType.WAIT_STATES, 'waitstates', 0)),
+    ('signal_length', (SpeedType.SIGNAL_LENGTH, 'setlength', 0)),
+    ('tot_clock_divider', (SpeedType.TOT_CLOCK_DIVIDER, 'totclkdivider', 1)),
+    ('tot_duty_cycle', (SpeedType.TOT_DUTY_CYCLE, 'totdutycycle', 0)),
+))
+
+# speeds which set the readout time
+READOUT_SPEEDS = ('clock_divider', 'wait_states', 'signal_length')
+
+
+class Trial:
+    """
+    Readout speeds tried.
+
+    * speeds: {name: value}
+    * nb_errors: chip test bit errors (all modules and repeats)
+    * frame_time: measured time (s) between frames, mean of the runs
+      (None if not measured: only the starting and best speeds are)
+    """
+
+    __slots__ = ('speeds', 'nb_errors', 'frame_time')
+
+    def __init__(self, speeds, nb_errors, frame_time=None):
+        self.speeds = speeds
+        self.nb_errors = nb_errors
+        self.frame_time = frame_time
+
+    def __repr__(self):
+        speeds = ', '.join('{}={}'.format(*item) for item in self.speeds.items())
+        return 'Trial({}, nb_errors={}, frame_rate={})'.format(
+            speeds, self.nb_errors, self.frame_rate)
+
+    @property
+    def valid(self):
+        return self.nb_errors == 0
+
+    @property
+    def frame_rate(self):
+        return None if not self.frame_time else 1 / self.frame_time
+
+
+TuneResult = collections.namedtuple('TuneResult', ('start', 'best', 'trials'))
+
+
+def get_speeds(detector, names=READOUT_SPEEDS):
+    """current speeds read in one pipelined exchange"""
+    pipe = Pipeline(detector)
+    for name in names:
+        pipe.ctrl(protocol.get_speed, SPEEDS[name][0])
+    return {name: value for name, (_, value) in zip(names, pipe.execute())}
+
+
+def set_speeds(detector, speeds):
+    """set the speeds in one pipelined exchange"""
+    pipe = Pipeline(detector)
+    for name, value in speeds.items():
+        pipe.ctrl(protocol.set_speed, SPEEDS[name][0], value)
+    pipe.execute()
+
+
+def chip_errors(detector, nb_modules, repeats=1):
+    """chip test bit errors of all modules (repeated) in one exchange"""
+    pipe = Pipeline(detector)
+    for _ in range(repeats):
+        for mod_nb in range(nb_modules):
+            pipe.ctrl(protocol.digital_test, DigitalTestMode.CHIP_TEST,
+                      mod_nb)
+    return sum(errors for _, errors in pipe.execute())
+
+
+def tune(detector, names=READOUT_SPEEDS, bounds=None, repeats=3,
+         nb_frames=100, exposure_time=1E-4, nb_runs=3, apply=True):
+    """
+    Search the fastest valid speeds (see module doc).
+
+    names: speeds to tune, in order
+    bounds: {name: lowest value to try} (defaults to the SPEEDS ones)
+    repeats: chip tests per module for a candidate to be valid
+    nb_frames, exposure_time: acquisition measuring the frame rate
+    nb_runs: acquisitions averaged per frame rate measurement
+    apply: leave the detector at the best speeds (otherwise the starting
+           ones are restored)
+
+    Raises SLSError if the readout is not valid at the starting speeds
+    """
+    bounds = dict(bounds or {})
+    nb_modules = detector.get_nb_modules()
+    plan = perf.plan_state(detector)
+    original = get_speeds(detector, names)
+    speeds = dict(original)
+    trials = []
+
+    def attempt(candidate):
+        set_speeds(detector, candidate)
+        trial = Trial(dict(candidate),
+                      chip_errors(detector, nb_modules, repeats))
+        log.info('%r', trial)
+        trials.append(trial)
+        return trial
+
+    def measure(trial):
+        set_speeds(detector, trial.speeds)
+        frame_times = [perf.measure(detector, nb_frames=nb_frames,
+                                    exposure_time=exposure_time,
+                                    frame_period=0)['frame_time']
+                       for _ in range(nb_runs)]
+        trial.frame_time = sum(frame_times) / len(frame_times)
+
+    try:
+        start = attempt(speeds)
+        if not start.valid:
+            raise SLSError('readout not valid at the starting speeds {} '
+                           '({} bit errors)'.format(speeds, start.nb_errors))
+        for name in names:
+            low = bounds.get(name, SPEEDS[name][2])
+            high = speeds[name]
+            # smallest valid value in [low, high] (high is valid)
+            while low < high:
+                middle = (low + high) // 2
+                if attempt(dict(speeds, **{name: middle})).valid:
+                    high = middle
+                else:
+                    low = middle + 1
+            speeds[name] = high
+        # the last valid trial of the bisected speeds
+        best = [trial for trial in trials
+                if trial.valid and trial.speeds == speeds][-1]
+        measure(start)
+        if best is not start:
+            measure(best)
+            if best.frame_time >= start.frame_time:
+                log.warning('best speeds %r not faster than the starting '
+                            'ones %r', best, start)
+    except BaseException:
+        set_speeds(detector, original)
+        raise
+    finally:
+        perf.restore_plan(detector, plan)
+    set_speeds(detector, best.speeds if apply else original)
+    log.info('fastest valid speeds %r (started at %r)', best, start)
+    return TuneResult(start, best, trials)
+
+
+def save_profile(trial, fname):
+    """
+    Write the speeds of the trial into the configuration file (created
+    if it doesn't exist) read by config.load_mythen
+    """
+    from . import config
+    profile = config.load(fname) if os.path.exists(fname) else None
+    profile = profile or {}
+    for name, value in trial.speeds.items():
+        profile[SPEEDS[name][1]] = value
+    config.save(profile, fname)
+    return profile
@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def make_mythen():
+    """
+    Factory of clients connected to a loopback simulated Mythen with the
+    given simulator configuration
+    """
+    # the simulator needs gevent and scipy
+    pytest.importorskip('gevent')
+    pytest.importorskip('scipy')
+    from sls.loopback import Loopback
+    from sls.simulator import detectors
+    loopbacks = []
+
+    def make(**config):
+        loopback = Loopback(detectors({'mythen': config}))
+        loopback.start()
+        loopbacks.append(loopback)
+        return loopback.client()
+
+    yield make
+    for loopback in loopbacks:
+        loopback.stop()
+
+
+@pytest.fixture
+def mythen(make_mythen):
+    return make_mythen()
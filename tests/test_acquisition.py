@@ -0,0 +1,125 @@
+import numpy
+import pytest
+
+from sls.protocol import ReadoutFlag, SLSTimeoutError
+
+
+def test_continuous_readout_is_restored(mythen):
+    with mythen.acquisition(continuous=True, nb_frames=1,
+                            exposure_time=0.001, progress_interval=None) as acq:
+        for (event, frame), _ in zip(acq, range(3)):
+            pass
+        acq.stop()
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+    acq = mythen.acquisition(nb_frames=3, exposure_time=0.001,
+                             progress_interval=None)
+    assert len(acq) == 3
+    assert len(acq.run()) == 3
+
+
+def test_readout_is_restored_when_never_run(mythen):
+    with mythen.acquisition(continuous=True, nb_frames=1) as acq:
+        acq._prepare()
+        assert mythen.readout & ReadoutFlag.CONTINOUS_RO
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+
+
+def test_unchanged_readout_is_kept(mythen):
+    mythen.readout = ReadoutFlag.CONTINOUS_RO
+    with mythen.acquisition(continuous=True, nb_frames=1,
+                            exposure_time=0.001, progress_interval=None) as acq:
+        for (event, frame), _ in zip(acq, range(2)):
+            pass
+        acq.stop()
+    assert mythen.readout == ReadoutFlag.CONTINOUS_RO
+    mythen.readout = ReadoutFlag.NORMAL_READOUT
+
+
+def test_burst_readout_is_restored(mythen):
+    burst = mythen.burst_acquisition(nb_frames=5, exposure_time=0.001)
+    data = burst.run()
+    assert len(data) == 5
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+    # a streaming acquisition after the burst
+    frames = mythen.acquisition(nb_frames=3, exposure_time=0.001,
+                                progress_interval=None).run()
+    assert len(frames) == 3
+
+
+def test_burst_readout_is_restored_on_stop(mythen):
+    with mythen.burst_acquisition(nb_frames=1000,
+                                  exposure_time=0.01) as burst:
+        burst.start()
+        burst.stop()
+        burst.read()
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+
+
+def test_burst_read_after_setter(mythen):
+    burst = mythen.burst_acquisition(nb_frames=4, exposure_time=0.001)
+    burst.start()
+    burst.wait()
+    # resets the client cached acquisition state
+    mythen.dynamic_range = 32
+    data = burst.read()
+    assert data.shape == (4, 7680)
+
+
+def test_burst_drain_budget(mythen):
+    burst = mythen.burst_acquisition(nb_frames=3000, exposure_time=0,
+                                     timeout=None)
+    burst.start()
+    burst.wait()
+    # much shorter than the whole drain
+    mythen.ctrl_pool.timeout = 0.05
+    assert len(burst.read()) == 3000
+
+
+def test_burst_auto_timeout(mythen):
+    burst = mythen.burst_acquisition(nb_frames=3000, exposure_time=0)
+    burst.prepare()
+    # readout dead time (30us per frame on the simulator)
+    assert burst._timeout > 3000 * 30e-6
+    assert len(burst.run()) == 3000
+
+
+def test_burst_timeout_when_stalled(mythen):
+    # no frame done within the timeout and the margin
+    burst = mythen.burst_acquisition(nb_frames=2, exposure_time=10,
+                                     timeout=0.1)
+    with pytest.raises(SLSTimeoutError):
+        burst.run()
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+
+
+def test_demux_needs_pump_probe(mythen):
+    with pytest.raises(ValueError):
+        mythen.acquisition(nb_frames=1, nb_probes=2, demux='probes').run()
+    with pytest.raises(ValueError):
+        mythen.acquisition(nb_frames=1, nb_gates=4, demux='gates').run()
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+
+
+def test_pump_probe_readout_is_restored(mythen):
+    acq = mythen.acquisition(nb_frames=2, nb_probes=2, exposure_time=0.001,
+                             readout=ReadoutFlag.PUMP_PROBE_MODE,
+                             demux='probes', progress_interval=None)
+    frames = [frame for event, frame in acq.run()]
+    assert [frame.shape for frame in frames] == 2 * [(2, 7680)]
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+    events = mythen.acquisition(nb_frames=1, nb_probes=0, exposure_time=0.001,
+                                progress_interval=None).run()
+    assert numpy.shape(events[0][1]) == (7680,)
+
+
+def test_no_perf_requests_without_clock(mythen, monkeypatch):
+    from sls import perf
+
+    def forbidden(*args, **kwargs):
+        raise AssertionError('unexpected performance model access')
+
+    monkeypatch.setattr(perf, 'plan_state', forbidden)
+    monkeypatch.setattr(perf, 'load_records', forbidden)
+    events = mythen.acquisition(nb_frames=2, exposure_time=0.001,
+                                progress_interval=None).run()
+    assert events[1].detector_time > events[0].detector_time
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from sls import protocol
+from sls.client import PLAN_FIELDS, AcquisitionPlan, Connection, dump_state
+from sls.protocol import ReadoutFlag, TimerType
+
+
+def count_connections(pool):
+    """make the pool count its open connections. Returns the counter"""
+    counter = dict(open=0, peak=0)
+    lock = threading.Lock()
+    factory = pool.factory
+
+    def counting_factory(addr, timeout=None):
+        conn = factory(addr, timeout=timeout)
+        connect, close = conn.connect, conn.close
+
+        def counted_connect():
+            connect()
+            with lock:
+                counter['open'] += 1
+                counter['peak'] = max(counter['peak'], counter['open'])
+
+        def counted_close():
+            if conn.sock is not None:
+                with lock:
+                    counter['open'] -= 1
+            close()
+
+        conn.connect, conn.close = counted_connect, counted_close
+        return conn
+
+    pool.factory = counting_factory
+    return counter
+
+
+def test_pipeline_respects_pool_size(mythen):
+    mythen.ctrl_pool.max_size = mythen.stop_pool.max_size = 2
+    ctrl = count_connections(mythen.ctrl_pool)
+    stop = count_connections(mythen.stop_pool)
+    snap = mythen.snapshot()
+    assert snap.nb_frames == mythen.nb_frames
+    assert ctrl['peak'] == 2
+    assert stop['peak'] == 2
+    assert ctrl['open'] == stop['open'] == 0
+
+
+def test_pipeline_while_holding_connection(mythen):
+    mythen.ctrl_pool.max_size = 1
+    with mythen.ctrl_pool.acquire():
+        # must not wait for the connection held by this thread
+        with mythen.ctrl_pool.acquire(blocking=False) as conn:
+            assert conn is None
+
+
+def test_current_needs_checkout(mythen):
+    with pytest.raises(RuntimeError):
+        mythen.conn_ctrl
+    with pytest.raises(RuntimeError):
+        mythen.fetch_frame(1, 24)
+
+
+def test_fetch_frame(mythen):
+    mythen.nb_frames = 1
+    info = mythen.update_client()
+    with mythen.ctrl_pool.connection() as conn:
+        assert mythen.conn_ctrl is conn
+        protocol.start_acquisition(conn)
+        result, frame = mythen.fetch_frame(info['data_bytes'],
+                                           info['dynamic_range'])
+        assert result == protocol.ResultType.OK
+        assert frame.shape == (info['data_bytes'] // 4,)
+        result, _ = mythen.fetch_frame(info['data_bytes'],
+                                       info['dynamic_range'])
+        assert result == protocol.ResultType.FINISHED
+
+
+def test_dump_state_has_no_connections(mythen):
+    state = dump_state(mythen)
+    assert 'conn_ctrl' not in state and 'conn_stop' not in state
+    assert not any(isinstance(value, Connection) for value in state.values())
+    assert state['nb_frames'] == mythen.nb_frames
+
+
+def test_plan_detects_changes_behind_cache(mythen):
+    plan = AcquisitionPlan(nb_frames=5, readout=ReadoutFlag.NORMAL_READOUT)
+    plan.apply(mythen)
+    # changes which don't go through the Detector (ex: another process)
+    with mythen.ctrl_pool.connection() as conn:
+        protocol.set_timer(conn, TimerType.NB_FRAMES, 7)
+    with mythen.ctrl_pool.connection() as conn:
+        protocol.set_readout(conn, ReadoutFlag.STORE_IN_RAM)
+    info = plan.apply(mythen)
+    assert info['nb_frames'] == 5
+    assert mythen.nb_frames == 5
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
+
+
+def test_plan_skips_unchanged_fields(mythen):
+    plan = AcquisitionPlan(nb_frames=5, exposure_time=0.01)
+    plan.apply(mythen)
+    sent = []
+    setter = PLAN_FIELDS['nb_frames'][0]
+    PLAN_FIELDS['nb_frames'] = (lambda conn, value: sent.append(value) or
+                                setter(conn, value)), PLAN_FIELDS['nb_frames'][1]
+    try:
+        AcquisitionPlan(nb_frames=6, exposure_time=0.01).apply(mythen)
+        plan.apply(mythen)
+        plan.apply(mythen)
+    finally:
+        PLAN_FIELDS['nb_frames'] = setter, PLAN_FIELDS['nb_frames'][1]
+    # pipelined commands run twice: once to send, once to read the reply
+    assert sent == [6, 6, 5, 5]
@@ -0,0 +1,38 @@
+import numpy
+
+from sls.clock import ClockCorrelator, fit_frame_step, frame_step
+from sls.perf import PerfModel
+
+
+def test_frame_step():
+    info = dict(acq_time=2000000, frame_period=0)
+    assert frame_step(info, 30e-6) == 2.03e-3
+    info['frame_period'] = 3000000
+    assert frame_step(info, 30e-6) == 3e-3
+
+
+def test_fit_frame_step():
+    assert fit_frame_step([(0.1, 10)]) is None
+    progress = [(0.01 + 2.5e-3 * done, done) for done in (10, 30, 50)]
+    assert abs(fit_frame_step(progress) - 2.5e-3) < 1e-9
+
+
+def test_exposure_times_do_not_drift(make_mythen, tmp_path):
+    # readout dead time unknown to the (nominal) performance model:
+    # 500ms drift over the acquisition if the frame step is not measured
+    mythen = make_mythen(readout_overhead=1e-3)
+    # nominal model (no calibration file)
+    perf_model = PerfModel.load(mythen.host, path=str(tmp_path / 'perf.json'))
+    assert perf_model.nb_records == 0
+    clock = ClockCorrelator(mythen, interval=0.05, perf_model=perf_model)
+    with mythen.acquisition(clock=clock, nb_frames=500, exposure_time=2e-3,
+                            progress_interval=None) as acq:
+        events = list(acq)
+    received = numpy.array([event.timestamp for event in events])
+    starts, ends = acq.exposure_times()
+    lag = received - ends
+    drift = numpy.polyfit(numpy.arange(len(lag)), lag, 1)[0] * len(lag)
+    # margins for the simulator timing jitter (>1s drift unmeasured)
+    assert abs(drift) < 0.4
+    # live stamps use the step measured so far
+    assert abs(events[-1].timestamp - events[-1].exposure_end) < 0.5
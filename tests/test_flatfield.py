@@ -0,0 +1,40 @@
+import numpy
+
+from sls.flatfield import FlatFieldBuilder, load_flat_field
+
+BEAM = dict(energy=12000, flux=1E5, noise=300, dispersion=0,
+            dead_channels=[3, 700], hot_channels=[1000, 5000])
+
+
+def test_bad_channels_on_simulator_beam(make_mythen):
+    mythen = make_mythen(beam=BEAM)
+    mythen.energy_threshold = 6000
+    builder = FlatFieldBuilder()
+    builder.acquire(mythen, nb_frames=300, exposure_time=0.001)
+    assert builder.nb_frames == 300
+    assert list(builder.bad_channels()) == [3, 700, 1000, 5000]
+    values, errors = builder.flat_field()
+    good = numpy.ones(len(values), dtype=bool)
+    good[[3, 700, 1000, 5000]] = False
+    assert (values[~good] == 0).all()
+    assert abs(values[good].mean() - 1) < 1E-9
+    assert numpy.allclose(values[good], 1, atol=0.05)
+
+
+def test_save(tmp_path):
+    builder = FlatFieldBuilder()
+    for _ in range(4):
+        builder.add(numpy.array([100, 0, 100, 3000, 100], dtype='<i4'))
+    flat_fname = str(tmp_path / 'flat.dat')
+    bad_fname = str(tmp_path / 'bad.chans')
+    builder.save(flat_fname, bad_fname)
+    assert list(load_flat_field(flat_fname)) == [1, 0, 1, 0, 1]
+    assert list(numpy.loadtxt(bad_fname, dtype=int)) == [1, 3]
+
+
+def test_noisy_channels():
+    builder = FlatFieldBuilder()
+    for index in range(10):
+        # same mean counts, only channel 2 jumps from frame to frame
+        builder.add(numpy.array([100, 100, 200 * (index % 2), 100]))
+    assert list(builder.bad_channels()) == [2]
@@ -0,0 +1,32 @@
+import json
+import urllib.request
+
+from sls.metrics import Registry
+
+
+def test_to_dict_is_json():
+    registry = Registry()
+    registry.gauge('unset')
+    registry.histogram('empty')
+    registry.histogram('latency').record(0.25)
+    result = json.loads(json.dumps(registry.to_dict(), allow_nan=False))
+    assert result['sls_unset'] is None
+    assert result['sls_empty']['mean'] is None
+    assert result['sls_latency']['count'] == 1
+    assert result['sls_latency']['max'] == 0.25
+
+
+def test_serve():
+    registry = Registry()
+    registry.counter('frames').inc(3)
+    server = registry.serve(0)
+    try:
+        host, port = server.server_address
+        assert host == '127.0.0.1'
+        url = 'http://127.0.0.1:{}/metrics'.format(port)
+        with urllib.request.urlopen(url, timeout=5) as reply:
+            body = reply.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'sls_frames_total 3' in body
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from sls import perf
+from sls.perf import DEFAULT_STATE, PerfModel, load_records, save_records
+
+# slow link
+TRUE_MODEL = PerfModel(readout_overhead=50E-6, cycle_time=30E-9,
+                       bandwidth=40E6)
+
+
+def record(host='mythen', **plan):
+    state = dict(DEFAULT_STATE, **plan)
+    frame_time = TRUE_MODEL.estimate(state).frame_time
+    result = {key: state[key] for key in perf.CALIBRATION_KEYS}
+    result.update(host=host, frame_time=frame_time)
+    return result
+
+
+def records(host='mythen'):
+    # readout bound at every dynamic range and one network bound
+    result = [record(host, exposure_time=1E-3, dynamic_range=dynamic_range)
+              for dynamic_range in (4, 8, 16, 24)]
+    result.append(record(host, exposure_time=0, dynamic_range=24))
+    return result
+
+
+def test_fit():
+    model = PerfModel.fit(records())
+    assert model.nb_records == 5
+    # lower than the nominal bandwidth
+    assert model.bandwidth == pytest.approx(40E6)
+    assert model.readout_overhead == pytest.approx(50E-6)
+    assert model.cycle_time == pytest.approx(30E-9)
+
+
+def test_fit_without_records():
+    model = PerfModel.fit([])
+    assert model.bandwidth == PerfModel().bandwidth
+    assert model.nb_records == 0
+
+
+def test_estimate():
+    model = PerfModel.fit(records())
+    state = dict(DEFAULT_STATE, exposure_time=0, dynamic_range=24,
+                 nb_frames=1000)
+    estimate = model.estimate(state)
+    assert estimate.limit == 'network'
+    assert estimate.frame_time == pytest.approx(30720 / 40E6)
+    assert estimate.duration == pytest.approx(1000 * 30720 / 40E6)
+    assert estimate.warnings
+    state['exposure_time'] = 1E-2
+    estimate = model.estimate(state)
+    assert estimate.limit == 'exposure'
+    assert estimate.frame_time == pytest.approx(
+        1E-2 + TRUE_MODEL.readout_time(state))
+    assert not estimate.warnings
+    # burst: the network only adds the bulk transfer at the end
+    state.update(exposure_time=0,
+                 readout=perf.ReadoutFlag.STORE_IN_RAM)
+    estimate = model.estimate(state)
+    assert estimate.limit == 'readout'
+    assert estimate.duration == pytest.approx(
+        1000 * (TRUE_MODEL.readout_time(state) + 30720 / 40E6))
+
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / 'sls' / 'perf.json')
+    assert load_records(path=path) == []
+    save_records(records('mythen') + records('other'), path)
+    # replaces the records of the same host only
+    save_records(records('mythen')[:2], path)
+    with open(path) as fobj:
+        assert len(json.load(fobj)) == 7
+    assert len(load_records('mythen', path)) == 2
+    model = PerfModel.load('other', path)
+    assert model.nb_records == 5
+    assert model.bandwidth == pytest.approx(40E6)
+
+
+def test_cli(tmp_path, capsys):
+    path = str(tmp_path / 'perf.json')
+    save_records(records(None), path)
+    perf.main(['--calibration', path, '-e', '0', '-n', '100',
+               '--dynamic-range', '24'])
+    output = capsys.readouterr().out
+    assert 'network' in output
+    with pytest.raises(SystemExit):
+        perf.main(['--calibrate'])
+
+
+def test_calibrate(mythen, tmp_path):
+    path = str(tmp_path / 'perf.json')
+    exposure_time = mythen.exposure_time
+    model = perf.calibrate(mythen, dynamic_ranges=(8, 16), nb_frames=20,
+                           path=path)
+    assert model.nb_records == 2
+    assert model.bandwidth > 0
+    assert PerfModel.load(mythen.host, path).nb_records == 2
+    assert mythen.exposure_time == exposure_time
@@ -0,0 +1,134 @@
+import io
+
+import numpy
+import pytest
+
+from sls import protocol
+
+DYNAMIC_RANGES = (4, 8, 16, 24, 32)
+NATIVE = {4: '<u1', 8: '<u1', 16: '<u2', 24: '<i4', 32: '<i4'}
+
+
+class Wire:
+    """connection reading from recorded bytes"""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self.stream.read(size)
+
+    def readinto(self, buff):
+        return self.stream.readinto(buff)
+
+
+def simulator_pack(counts, dynamic_range):
+    """counts encoded on the wire by the simulator"""
+    pytest.importorskip('gevent')
+    pytest.importorskip('scipy')
+    from sls.simulator import Acquisition
+
+    class Packer:
+        params = dict(dynamic_range=dynamic_range)
+
+    return Acquisition.pack(Packer(), counts).tobytes()
+
+
+def counts(dynamic_range, nb_channels=64):
+    top = min(1 << dynamic_range, 1 << 24)
+    data = numpy.random.RandomState(dynamic_range).randint(0, top,
+                                                           nb_channels)
+    # full scale: no scaling by the simulator
+    data[0] = top - 1
+    return data.astype('<i4')
+
+
+def test_nibble_order():
+    frame = protocol.decode_data(bytes([0x21, 0xF3]), 4)
+    assert frame.dtype == numpy.dtype('<u1')
+    assert list(frame) == [1, 2, 3, 15]
+
+
+def test_meta():
+    assert protocol._to_numpy_meta(8, 4) == ((16,), '<u1')
+    assert protocol._to_numpy_meta(8, 8) == ((8,), '<u1')
+    assert protocol._to_numpy_meta(8, 16) == ((4,), '<u2')
+    assert protocol._to_numpy_meta(8, 24) == ((2,), '<i4')
+    assert protocol._to_numpy_meta(8, 32) == ((2,), '<i4')
+    with pytest.raises(ValueError):
+        protocol._to_numpy_meta(8, 12)
+
+
+@pytest.mark.parametrize('dynamic_range', DYNAMIC_RANGES)
+def test_decode_simulator_frames(dynamic_range):
+    expected = counts(dynamic_range)
+    data = simulator_pack(expected, dynamic_range)
+    frame = protocol.decode_data(data, dynamic_range)
+    assert frame.dtype == numpy.dtype(NATIVE[dynamic_range])
+    numpy.testing.assert_array_equal(frame, expected)
+    wide = protocol.decode_data(data, dynamic_range, dtype='<i4')
+    assert wide.dtype == numpy.dtype('<i4')
+    numpy.testing.assert_array_equal(wide, expected)
+    out = numpy.empty(len(expected), dtype='<i4')
+    frame = protocol.decode_data(data, dynamic_range, dtype='<i4', out=out)
+    assert numpy.shares_memory(frame, out)
+    numpy.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('dynamic_range', DYNAMIC_RANGES)
+@pytest.mark.parametrize('dtype', [None, '<i4'])
+def test_read_data(dynamic_range, dtype):
+    expected = counts(dynamic_range)
+    data = simulator_pack(expected, dynamic_range)
+    frame = protocol.read_data(Wire(data), len(data), dynamic_range,
+                               dtype=dtype)
+    numpy.testing.assert_array_equal(frame, expected)
+    # into a caller buffer (in place when no decoding is needed)
+    out = numpy.zeros(len(expected),
+                      dtype=NATIVE[dynamic_range] if dtype is None else dtype)
+    frame = protocol.read_data(Wire(data), len(data), dynamic_range,
+                               out=out, dtype=dtype)
+    assert numpy.shares_memory(frame, out)
+    numpy.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('dynamic_range', DYNAMIC_RANGES)
+def test_read_data_wrong_out(dynamic_range):
+    expected = counts(dynamic_range)
+    data = simulator_pack(expected, dynamic_range)
+    native = NATIVE[dynamic_range]
+    short = numpy.empty(len(expected) - 1, dtype=native)
+    with pytest.raises(ValueError):
+        protocol.read_data(Wire(data), len(data), dynamic_range, out=short)
+    # narrower than the requested dtype: too few bytes
+    narrow = numpy.empty(len(expected), dtype='<u1')
+    with pytest.raises(ValueError):
+        protocol.read_data(Wire(data), len(data), dynamic_range, out=narrow,
+                           dtype='<i4' if dynamic_range != 32 else '<i8')
+
+
+def test_read_data_short_frame():
+    with pytest.raises(protocol.SLSError):
+        protocol.read_data(Wire(b'\x00' * 7), 8, 32)
+
+
+@pytest.mark.parametrize('dynamic_range', DYNAMIC_RANGES)
+def test_acquisition_dynamic_range(make_mythen, dynamic_range):
+    # few counts: no scaling into the counter range
+    mythen = make_mythen(beam=dict(energy=12000, flux=200, noise=300,
+                                   dispersion=0))
+    mythen.energy_threshold = 6000
+
+    def acquire(dynamic_range):
+        # same simulator random counts
+        numpy.random.seed(2)
+        event, = mythen.acquisition(nb_frames=1, exposure_time=0.01,
+                                    dynamic_range=dynamic_range,
+                                    progress_interval=None).run()
+        return event.data.copy()
+
+    expected = acquire(32)
+    frame = acquire(dynamic_range)
+    assert frame.dtype == numpy.dtype(NATIVE[dynamic_range])
+    assert frame.shape == (7680,)
+    numpy.testing.assert_array_equal(frame, expected)
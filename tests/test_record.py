@@ -0,0 +1,67 @@
+import numpy
+import pytest
+
+from sls.client import Detector
+from sls.record import Recorder, RecordingConnection, Replayer
+
+
+@pytest.fixture
+def loopback():
+    pytest.importorskip('gevent')
+    pytest.importorskip('scipy')
+    from sls.loopback import Loopback
+    from sls.simulator import detectors
+    with Loopback(detectors({'mythen': {}})) as loopback:
+        yield loopback
+
+
+def detector(loopback, connection_factory):
+    sim = loopback.detectors[0]
+    return Detector('127.0.0.1', ctrl_port=sim['ctrl_port'],
+                    stop_port=sim['stop_port'],
+                    connection_factory=connection_factory)
+
+
+def record(loopback, fname, acquire):
+    from sls.loopback import LoopbackConnection
+
+    class Connection(RecordingConnection, LoopbackConnection):
+        pass
+
+    with Recorder(fname) as recorder:
+        def factory(addr, timeout=None):
+            conn = Connection(addr, timeout=timeout, recorder=recorder)
+            conn.loopback = loopback
+            return conn
+        return acquire(detector(loopback, factory))
+
+
+def frames(mythen, progress_interval):
+    acq = mythen.acquisition(nb_frames=10, exposure_time=0.01,
+                             progress_interval=progress_interval)
+    return [event.data.copy() for event in acq if event.type == 'frame']
+
+
+@pytest.mark.parametrize('realtime', [False, True])
+def test_replay_with_progress_polls(loopback, tmp_path, realtime):
+    fname = str(tmp_path / 'session.slsrec')
+    recorded = record(loopback, fname, lambda m: frames(m, 0.02))
+    replayer = Replayer(fname, realtime=realtime)
+    mythen = detector(loopback, replayer.connection)
+    # polls more often than recorded
+    replayed = frames(mythen, 0.001)
+    assert len(replayed) == len(recorded) == 10
+    for a, b in zip(replayed, recorded):
+        numpy.testing.assert_array_equal(a, b)
+
+
+def test_replay_repeated_and_unknown_requests(loopback, tmp_path):
+    fname = str(tmp_path / 'session.slsrec')
+    recorded = record(loopback, fname,
+                      lambda m: (m.run_status, m.energy_threshold))
+    mythen = detector(loopback, Replayer(fname).connection)
+    for _ in range(3):
+        assert mythen.run_status == recorded[0]
+    assert mythen.energy_threshold == recorded[1]
+    with pytest.raises(ConnectionError):
+        mythen.dynamic_range
@@ -0,0 +1,124 @@
+import io
+import struct
+
+import numpy
+import pytest
+
+from sls import protocol, sparse
+from sls.protocol import ReadoutFlag, SLSError
+
+FRAME = numpy.array([0, 3, 0, 0, 1, 7, 0, 0, 0, 2], dtype='<i4')
+
+
+class Wire:
+    """connection reading from recorded bytes"""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self.stream.read(size)
+
+
+def wire(words):
+    words = numpy.asarray(words, dtype='<i4')
+    return Wire(struct.pack('<i', len(words)) + words.tobytes())
+
+
+def test_hits_round_trip():
+    words = sparse.encode_hits(FRAME)
+    assert list(words) == [1, 4, 5, 9]
+    frame = sparse.decode_hits(words, len(FRAME))
+    assert list(frame.channels) == [1, 4, 5, 9]
+    assert list(frame.to_dense()) == list(FRAME != 0)
+    assert frame.payload_bytes == 4 * 5
+
+
+def test_zero_compression_round_trip():
+    words = sparse.encode_zero_compression(FRAME)
+    assert list(words) == [-1, 3, -2, 1, 7, -3, 2]
+    frame = sparse.decode_zero_compression(words, len(FRAME))
+    assert list(frame.to_dense()) == list(FRAME)
+    assert frame.nb_hits == 4
+    # leading and trailing empty channels
+    frame = numpy.array([0, 0, 5, 0], dtype='<i4')
+    words = sparse.encode_zero_compression(frame)
+    assert list(words) == [-2, 5, -1]
+    decoded = sparse.decode_zero_compression(words, 4)
+    assert list(decoded.to_dense()) == list(frame)
+
+
+@pytest.mark.parametrize('encode, decode', [
+    (sparse.encode_hits, sparse.decode_hits),
+    (sparse.encode_zero_compression, sparse.decode_zero_compression)])
+def test_empty_frame(encode, decode):
+    empty = numpy.zeros(16, dtype='<i4')
+    frame = decode(encode(empty), 16)
+    assert frame.nb_hits == 0
+    assert not frame.to_dense().any()
+    assert len(frame.to_dense()) == 16
+
+
+def test_out_of_range():
+    with pytest.raises(ValueError):
+        sparse.decode_hits([2, 16], 16)
+    with pytest.raises(ValueError):
+        sparse.decode_hits([-1], 16)
+    with pytest.raises(ValueError):
+        sparse.decode_zero_compression([-15, 1, 1], 16)
+    with pytest.raises(SLSError):
+        protocol.read_sparse_data(wire([16]), 16 * 4, 32,
+                                  ReadoutFlag.READ_HITS)
+    # more words than channels
+    with pytest.raises(SLSError):
+        protocol.read_sparse_data(wire(numpy.ones(17)), 16 * 4, 32,
+                                  ReadoutFlag.ZERO_COMPRESSION)
+
+
+def test_to_dense_out():
+    frame = sparse.decode_zero_compression(
+        sparse.encode_zero_compression(FRAME), len(FRAME), dtype='<u2')
+    out = numpy.full(len(FRAME), 99, dtype='<u2')
+    dense = frame.to_dense(out=out)
+    assert numpy.shares_memory(dense, out)
+    assert list(out) == list(FRAME)
+    # bigger buffers are fine, smaller ones are not
+    assert list(frame.to_dense(out=bytearray(100))) == list(FRAME)
+    with pytest.raises(ValueError):
+        frame.to_dense(out=numpy.empty(len(FRAME) - 1, dtype='<u2'))
+
+
+def test_read_sparse_data():
+    words = sparse.encode_zero_compression(FRAME)
+    frame = protocol.read_sparse_data(wire(words), len(FRAME) * 4, 32,
+                                      ReadoutFlag.ZERO_COMPRESSION)
+    assert list(numpy.asarray(frame)) == list(FRAME)
+    frame = protocol.read_sparse_data(wire(sparse.encode_hits(FRAME)),
+                                      len(FRAME) * 4, 32,
+                                      ReadoutFlag.READ_HITS)
+    assert list(frame.channels) == [1, 4, 5, 9]
+
+
+@pytest.mark.parametrize('readout', [ReadoutFlag.ZERO_COMPRESSION,
+                                     ReadoutFlag.READ_HITS])
+def test_acquisition_matches_dense(make_mythen, readout):
+    # low flux beam: sparse frames
+    beam = dict(energy=12000, flux=20, noise=300, dispersion=0)
+    mythen = make_mythen(beam=beam)
+    mythen.energy_threshold = 6000
+
+    def acquire(**opts):
+        # same simulator random counts
+        numpy.random.seed(1)
+        events = mythen.acquisition(nb_frames=3, exposure_time=0.01,
+                                    progress_interval=None, **opts).run()
+        return [numpy.asarray(event.data) for event in events]
+
+    dense = acquire(readout=ReadoutFlag.NORMAL_READOUT)
+    frames = acquire(readout=readout)
+    assert all(frame.any() for frame in dense)
+    for frame, expected in zip(frames, dense):
+        if readout == ReadoutFlag.READ_HITS:
+            expected = (expected != 0).astype(expected.dtype)
+        numpy.testing.assert_array_equal(frame, expected)
+    assert mythen.readout == ReadoutFlag.NORMAL_READOUT
@@ -0,0 +1,30 @@
+import numpy
+
+from sls.threshold import fit_scurves, scan, scurve
+
+BEAM = dict(energy=12000, flux=1E5, noise=300, dispersion=200, seed=0)
+
+
+def test_fit_scurves():
+    thresholds = numpy.arange(10000, 14000, 100)
+    position = 12000 + numpy.random.RandomState(1).normal(0, 200, 128)
+    counts = scurve(thresholds[:, None], position, 300, 5000)
+    curves = fit_scurves(thresholds, counts)
+    assert curves.nb_valid == 128
+    assert numpy.allclose(curves.position, position, atol=1)
+    assert numpy.allclose(curves.width, 300, atol=1)
+    assert numpy.allclose(curves.amplitude, 5000, rtol=1E-3)
+
+
+def test_fit_scurves_on_simulator_beam(make_mythen):
+    mythen = make_mythen(beam=BEAM)
+    thresholds = numpy.arange(10000, 14000, 100)
+    previous = mythen.energy_threshold
+    counts = scan(mythen, thresholds, exposure_time=0.01)
+    assert counts.shape == (len(thresholds), 7680)
+    curves = fit_scurves(thresholds, counts)
+    assert curves.nb_valid > 0.99 * 7680
+    assert abs(curves.dispersion - 200) < 15
+    assert abs(curves.noise - 300) < 20
+    assert abs(numpy.median(curves.position) - 12000) < 20
+    assert mythen.energy_threshold == previous
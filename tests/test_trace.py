@@ -0,0 +1,34 @@
+import threading
+
+from sls import trace
+
+
+def test_concurrent_names():
+    tracer = trace.Tracer(capacity=10000)
+    barrier = threading.Barrier(8)
+
+    def record(index):
+        barrier.wait()
+        for n in range(100):
+            tracer.add('span-{}'.format(n % 50), 0.0, 1.0, index)
+
+    threads = [threading.Thread(target=record, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(tracer.name_list) == sorted(tracer.name_ids)
+    assert all(tracer.name_list[i] == name
+               for name, i in tracer.name_ids.items())
+    assert len(tracer.spans()) == 800
+
+
+def test_chrome_thread_names():
+    tracer = trace.Tracer(capacity=10)
+    with tracer.span('work', 3):
+        pass
+    chrome = tracer.to_chrome()
+    span, meta = chrome['traceEvents']
+    assert span['name'] == 'work' and span['args'] == dict(arg=3)
+    assert meta['tid'] == span['tid']
+    assert meta['args']['name'] == threading.current_thread().name
@@ -0,0 +1,27 @@
+import numpy
+
+from sls.threshold import fit_scurves, scan
+from sls.trim import read_modules, trim
+
+# each trimbit moves the channel threshold by 15eV: +-480eV range
+BEAM = dict(energy=12000, flux=1E5, noise=300, dispersion=150, seed=0,
+            trim_step=15)
+
+
+def test_trim_on_simulator_beam(make_mythen):
+    mythen = make_mythen(beam=BEAM)
+    previous = mythen.energy_threshold
+    result = trim(mythen, energy_threshold=12000, exposure_time=0.01)
+    assert mythen.energy_threshold == previous
+    assert result.saturated.sum() < 0.01 * 7680
+    assert result.spread < result.initial_spread / 3
+    # the detector is left trimmed
+    trimbits = numpy.array([channel & 0x3F
+                            for module in read_modules(mythen)
+                            for chip in module['chips']
+                            for channel in chip['channels']])
+    assert (trimbits == result.trimbits).all()
+    # the threshold dispersion is gone
+    thresholds = numpy.arange(10000, 14000, 100)
+    curves = fit_scurves(thresholds, scan(mythen, thresholds, 0.01))
+    assert curves.dispersion < 150 / 3
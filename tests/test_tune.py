@@ -0,0 +1,23 @@
+from sls.tune import get_speeds, tune
+
+
+def test_tune_returns_bisected_speeds(make_mythen):
+    mythen = make_mythen(clock_divider=12, wait_states=20, signal_length=6)
+    result = tune(mythen, repeats=1, nb_frames=20, exposure_time=1E-4,
+                  nb_runs=2)
+    # simulator: bit errors below these
+    expected = dict(clock_divider=4, wait_states=8, signal_length=2)
+    assert result.best.speeds == expected
+    assert result.best.valid
+    assert get_speeds(mythen) == expected
+    # the simulator frame rate hardly depends on the speeds: the measure
+    # is only a check
+    measured = [trial for trial in result.trials if trial.frame_time]
+    assert measured == [result.start, result.best]
+
+
+def test_tune_restores_speeds(make_mythen):
+    mythen = make_mythen(clock_divider=12, wait_states=20, signal_length=6)
+    result = tune(mythen, repeats=1, nb_frames=10, nb_runs=1, apply=False)
+    assert result.best.speeds['clock_divider'] == 4
+    assert get_speeds(mythen) == result.start.speeds